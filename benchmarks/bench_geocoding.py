@@ -1,46 +1,388 @@
-from timeit import repeat
+"""Benchmarks all `ReverseGeocode*` classes, including `ReverseGeocodeAuto` and `ShardedReverseGeocode`.
+
+Measures the import time, the time to parse the data file, the build and load time, the index size,
+the memory per point (city metadata, coordinates and index) and peak memory usage of every class,
+and latency percentiles of `query` over a sweep of batch sizes, k, input forms, thread and process counts.
+The modes `exact` and `track` measure `query(exact=True)` and `query_track` of random walks.
+Every class is benchmarked in a new process, so the peak memory usage includes only that class.
+
+Results are written as JSON using `--output`. When a `--baseline` file of a previous run is given,
+all measurements which are slower or larger by more than `--tolerance` are reported as regressions
+and the exit code is 1.
+
+Example:
+python benchmarks/bench_geocoding.py --classes ReverseGeocodeKdScipy --batch-sizes 1 1000 1000000 -o new.json
+python benchmarks/bench_geocoding.py --baseline new.json
+python benchmarks/bench_geocoding.py --data allCountries.txt.xz --classes ReverseGeocodeVpTreePython --batch-sizes 1000
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
 
 from houtu.geocoding import (
     ReverseGeocodeBallHaversine,
+    ReverseGeocodeBase,
     ReverseGeocodeBruteEuclidic,
     ReverseGeocodeBruteHaversine,
+    ReverseGeocodeGrid,
     ReverseGeocodeKdLearn,
     ReverseGeocodeKdScipy,
     ReverseGeocodeVpTreePython,
     ReverseGeocodeVpTreeSimd,
+    default_data_path,
+    get_data,
+    load_data,
 )
+from houtu.geonames import read_blocks
+from houtu.planner import ReverseGeocodeAuto
+from houtu.sharding import ShardedReverseGeocode
 from houtu.utils import rand_lat_lon
 
+try:
+    import resource
+except ImportError:  # windows
+    resource = None  # type: ignore[assignment]
 
-def benchmark():
-    geo_h1 = ReverseGeocodeBruteHaversine()
-    geo_h2 = ReverseGeocodeBallHaversine()
-    geo_e1 = ReverseGeocodeBruteEuclidic()
-    geo_e2 = ReverseGeocodeKdLearn()
-    geo_e3 = ReverseGeocodeKdScipy()
-    geo_e4 = ReverseGeocodeVpTreeSimd()
-    geo_e5 = ReverseGeocodeVpTreePython()
+# functions which build an index from the path of the data file
+CLASSES: Dict[str, Callable[[Optional[str]], Any]] = {
+    cls.__name__: cls
+    for cls in (
+        ReverseGeocodeBruteHaversine,
+        ReverseGeocodeBallHaversine,
+        ReverseGeocodeBruteEuclidic,
+        ReverseGeocodeKdLearn,
+        ReverseGeocodeKdScipy,
+        ReverseGeocodeVpTreeSimd,
+        ReverseGeocodeVpTreePython,
+        ReverseGeocodeGrid,
+        ReverseGeocodeAuto,
+    )
+}
+CLASSES["ShardedReverseGeocode"] = lambda path: ShardedReverseGeocode(ReverseGeocodeKdScipy, path)
 
-    geos = [geo_h1, geo_h2, geo_e1, geo_e2, geo_e3, geo_e4, geo_e5]
+# benchmarked modes: `query`, `query(exact=True)` and `query_track`. `ShardedReverseGeocode` only supports `query`.
+MODES = ("query", "exact", "track")
 
-    query = rand_lat_lon(2, "radians")
-    for geo in geos:
-        name = geo.__class__.__name__
-        try:
-            seconds = min(repeat("geo.query(query)", globals={"geo": geo, "query": query}, number=1000))
-        except MemoryError:
-            seconds = "MemoryError"
-        print(name, seconds)
-
-    query = rand_lat_lon(100, "radians")
-    for geo in geos:
-        name = geo.__class__.__name__
+# larger batches take minutes for these classes and are skipped
+MAX_BATCH_SIZE = {
+    "ReverseGeocodeBruteHaversine": 10000,
+    "ReverseGeocodeBruteEuclidic": 10000,
+}
+
+# lower is better for all of them
+METRICS = ("seconds", "load_seconds", "index_mb", "bytes_per_point", "peak_rss_mb", "p50", "p90", "p99")
+# higher is better
+THROUGHPUT_METRICS = ("rows_per_second", "mb_per_second")
+KEYS = ("benchmark", "class", "mode", "batch_size", "k", "form", "n_jobs", "processes")
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / 1024 / 1024  # bytes
+    return rss / 1024  # kilobytes
+
+
+def measure_import() -> Dict[str, Any]:
+    """Measures the time to import `houtu.geocoding` in a new interpreter."""
+
+    code = "import time; t = time.perf_counter(); import houtu.geocoding; print(time.perf_counter() - t)"
+    seconds = min(
+        float(subprocess.check_output([sys.executable, "-c", code], text=True)) for _ in range(5)  # nosec B603
+    )
+    return {"benchmark": "import", "seconds": seconds}
+
+
+def measure_get_data(path: Optional[str] = None) -> Dict[str, Any]:
+    """Measures parsing the data file and loading it from the binary cache.
+    Throughput is given in rows and megabytes of decompressed text per second.
+    """
+
+    if path is None:
+        path = default_data_path()
+
+    start = time.perf_counter()
+    get_data(path)
+    seconds = time.perf_counter() - start
+
+    rows = 0
+    num_bytes = 0
+    for block in read_blocks(path):
+        rows += block.count(b"\n")
+        num_bytes += len(block)
+
+    load_data(path)  # make sure the cache exists
+    start = time.perf_counter()
+    load_data(path)
+    load_seconds = time.perf_counter() - start
+
+    return {
+        "benchmark": "get_data",
+        "seconds": seconds,
+        "load_seconds": load_seconds,
+        "rows_per_second": rows / seconds,
+        "mb_per_second": num_bytes / 1024 / 1024 / seconds,
+    }
+
+
+def random_track(n: int, form: str) -> np.ndarray:
+    """Returns a random walk of `n` points with steps of about 100 meters, like a GPS track."""
+
+    steps = np.random.normal(scale=100.0 / 6371000.0, size=(n, 2))
+    steps[0] = rand_lat_lon(1, "radians")[0]
+    track = np.cumsum(steps, axis=0).astype(np.float32)
+    return np.rad2deg(track) if form == "degrees" else track
+
+
+def percentiles(func: Callable[[], Any], min_time: float, max_repeat: int) -> Dict[str, float]:
+    """Calls `func` repeatedly for at least `min_time` seconds (but at most `max_repeat` times)
+    and returns latency percentiles in seconds.
+    """
+
+    times: List[float] = []
+    total = 0.0
+    while len(times) < max_repeat and (total < min_time or len(times) < 3):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        times.append(seconds)
+        total += seconds
+        if seconds > min_time:  # slow configurations are only measured once
+            break
+
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]).tolist()
+    return {"p50": p50, "p90": p90, "p99": p99, "repeat": len(times)}
+
+
+def bench_class(name: str, args: Dict[str, Any]) -> List[Dict[str, Any]]:
+    from houtu.parallel import QueryPool
+
+    records: List[Dict[str, Any]] = []
+
+    start = time.perf_counter()
+    geo = CLASSES[name](args["data"])
+    seconds = time.perf_counter() - start
+
+    build: Dict[str, Any] = {"benchmark": "build", "class": name, "seconds": seconds}
+    shareable = False
+    if isinstance(geo, ReverseGeocodeBase):
+        build["bytes_per_point"] = sum(geo.memory_usage().values()) / len(geo.cities)
         try:
-            seconds = min(repeat("geo.query(query)", globals={"geo": geo, "query": query}, number=100))
-        except MemoryError:
-            seconds = "MemoryError"
-        print(name, seconds)
+            arrays, _ = geo._get_state()
+        except NotImplementedError:
+            pass
+        else:
+            shareable = True
+            build["index_mb"] = sum(arr.nbytes for arr in arrays.values()) / 1024 / 1024
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "index.bin")
+                geo.save(path)
+                start = time.perf_counter()
+                loaded = type(geo).load(path)
+                build["load_seconds"] = time.perf_counter() - start
+                del loaded
+    records.append(build)
+    modes = (
+        args["modes"] if isinstance(geo, ReverseGeocodeBase) else [mode for mode in args["modes"] if mode == "query"]
+    )
+
+    max_batch_size = MAX_BATCH_SIZE.get(name, max(args["batch_sizes"]))
+    for batch_size in args["batch_sizes"]:
+        if batch_size > max_batch_size:
+            continue
+        for form in args["forms"]:
+            query_arr = rand_lat_lon(batch_size, form)
+            track = random_track(batch_size, form)
+            for k in args["k"]:
+                if isinstance(geo, ReverseGeocodeGrid) and k > geo.grid.max_k:
+                    continue
+                record = {"benchmark": "query", "class": name, "batch_size": batch_size, "k": k, "form": form}
+
+                if "query" in modes:  # the records of this mode have no `mode` key, like older results
+                    for n_jobs in args["n_jobs"] if isinstance(geo, ReverseGeocodeBase) else [None]:
+                        kwargs = {} if n_jobs is None else {"n_jobs": n_jobs}
+                        times = percentiles(
+                            lambda: geo.query(query_arr, k, form, True, **kwargs),  # noqa: B023
+                            args["min_time"],
+                            args["max_repeat"],
+                        )
+                        records.append({**record, "n_jobs": n_jobs, **times})
+
+                if "exact" in modes:
+                    times = percentiles(
+                        lambda: geo.query(query_arr, k, form, True, exact=True),  # noqa: B023
+                        args["min_time"],
+                        args["max_repeat"],
+                    )
+                    records.append({**record, "mode": "exact", **times})
+
+                if "track" in modes:
+                    times = percentiles(
+                        lambda: geo.query_track(track, k, form, True),  # noqa: B023
+                        args["min_time"],
+                        args["max_repeat"],
+                    )
+                    records.append({**record, "mode": "track", **times})
+
+                if "query" not in modes or not shareable:
+                    continue
+
+                for processes in args["processes"]:
+                    with QueryPool(geo, processes) as pool:
+                        pool.query(query_arr[:1], k, form, True)  # start the workers
+                        times = percentiles(
+                            lambda: pool.query(query_arr, k, form, True),  # noqa: B023
+                            args["min_time"],
+                            args["max_repeat"],
+                        )
+                    records.append({**record, "processes": processes, **times})
+
+    build["peak_rss_mb"] = peak_rss_mb()
+    return records
+
+
+def _bench_class_worker(conn: Any, name: str, args: Dict[str, Any]) -> None:
+    try:
+        conn.send((True, bench_class(name, args)))
+    except Exception as e:
+        conn.send((False, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def bench_class_process(name: str, args: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Runs `bench_class` in a new process. Not a pool, since the worker starts its own `QueryPool`."""
+
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_bench_class_worker, args=(child_conn, name, args))
+    p.start()
+    child_conn.close()
+    try:
+        success, result = parent_conn.recv()
+    except EOFError:
+        success, result = False, "worker process died"
+    p.join()
+
+    if not success:
+        print(f"Skipping {name}: {result}", file=sys.stderr)
+        return []
+    return result
+
+
+def _key(record: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(record.get(key) for key in KEYS)
+
+
+def compare(records: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Returns a description of every metric which is more than `tolerance` (relative) worse than the baseline."""
+
+    old = {_key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        base = old.get(_key(record))
+        if base is None:
+            continue
+        for metric in METRICS + THROUGHPUT_METRICS:
+            new_value = record.get(metric)
+            old_value = base.get(metric)
+            if new_value is None or old_value is None:
+                continue
+            if metric in THROUGHPUT_METRICS:
+                worse = new_value * (1.0 + tolerance) < old_value
+            else:
+                worse = new_value > old_value * (1.0 + tolerance)
+            if worse:
+                name = ", ".join(f"{key}={value}" for key, value in zip(KEYS, _key(record)) if value is not None)
+                regressions.append(f"{name}: {metric} {old_value:.6g} -> {new_value:.6g}")
+    return regressions
+
+
+def print_records(records: List[Dict[str, Any]]) -> None:
+    for record in records:
+        keys = " ".join(f"{key}={record[key]}" for key in KEYS if record.get(key) is not None)
+        values = " ".join(
+            f"{metric}={record[metric]:.6g}"
+            for metric in METRICS + THROUGHPUT_METRICS
+            if record.get(metric) is not None
+        )
+        print(keys, values)
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Benchmarks the ReverseGeocode classes")
+    parser.add_argument("--classes", nargs="+", choices=sorted(CLASSES), default=list(CLASSES))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 100, 10000, 1000000])
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 2, 10])
+    parser.add_argument("--forms", nargs="+", choices=("radians", "degrees"), default=["radians"])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--n-jobs", nargs="+", type=int, default=[1, -1], help="Thread counts passed to `query`")
+    parser.add_argument("--processes", nargs="+", type=int, default=[], help="Process counts used for `QueryPool`")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Minimum measuring time per configuration")
+    parser.add_argument("--max-repeat", type=int, default=1000, help="Maximum number of calls per configuration")
+    parser.add_argument("--data", help="GeoNames file to use instead of the included cities1000 file")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    config = {
+        "batch_sizes": args.batch_sizes,
+        "k": args.k,
+        "forms": args.forms,
+        "modes": args.modes,
+        "n_jobs": args.n_jobs,
+        "processes": args.processes,
+        "min_time": args.min_time,
+        "max_repeat": args.max_repeat,
+        "data": args.data,
+    }
+
+    records = [measure_import(), measure_get_data(args.data)]
+    print_records(records)
+    for name in args.classes:
+        class_records = bench_class_process(name, config)
+        print_records(class_records)
+        records.extend(class_records)
+
+    if args.output:
+        result = {
+            "machine": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpu_count": os.cpu_count(),
+            },
+            "config": config,
+            "records": records,
+        }
+        with open(args.output, "w", encoding="utf-8") as fw:
+            json.dump(result, fw, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fr:
+            baseline = json.load(fr)["records"]
+        regressions = compare(records, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            return 1
+
+    return 0
 
 
 if __name__ == "__main__":
-    benchmark()
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import bz2
+import csv
+import gzip
+import lzma
+import multiprocessing
+import sys
+import time
+from argparse import ArgumentParser
+from contextlib import ExitStack, nullcontext
+from itertools import islice
+from typing import IO, Any, Callable, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple, Type, cast
+
+import numpy as np
+
+from .geocoding import (
+    ReverseGeocodeBallHaversine,
+    ReverseGeocodeBase,
+    ReverseGeocodeGrid,
+    ReverseGeocodeKdLearn,
+    ReverseGeocodeKdScipy,
+)
+from .parallel import QueryPool
+from .utils import prefetch
+
+BACKENDS: Dict[str, Type[ReverseGeocodeBase]] = {
+    "ball": ReverseGeocodeBallHaversine,
+    "grid": ReverseGeocodeGrid,
+    "kd-learn": ReverseGeocodeKdLearn,
+    "kd-scipy": ReverseGeocodeKdScipy,
+}
+
+OUTPUT_COLUMNS = (
+    "name",
+    "country_code",
+    "admin1_code",
+    "admin2_code",
+    "admin3_code",
+    "admin4_code",
+    "timezone",
+)
+
+COMPRESSION: Dict[str, Callable[..., Any]] = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def _split_suffix(path: str) -> Tuple[str, Optional[str]]:
+    for suffix in COMPRESSION:
+        if path.endswith(suffix):
+            return path[: -len(suffix)], suffix
+    return path, None
+
+
+def open_text(path: str, mode: str) -> ContextManager[IO[str]]:
+    """Opens `path` in text mode, using compression based on the file extension. `-` is stdin/stdout."""
+
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+
+    _, suffix = _split_suffix(path)
+    if suffix is None:
+        return open(path, mode, encoding="utf-8", newline="")
+    return cast(IO[str], COMPRESSION[suffix](path, mode + "t", encoding="utf-8", newline=""))
+
+
+def default_delimiter(path: str) -> str:
+    return "\t" if _split_suffix(path)[0].endswith(".tsv") else ","
+
+
+def read_chunks(reader: Iterator[List[str]], chunk_size: int) -> Iterator[List[List[str]]]:
+    while True:
+        rows = list(islice(reader, chunk_size))
+        if not rows:
+            break
+        yield rows
+
+
+def parse_coords(rows: List[List[str]], lat_idx: int, lon_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns float32 coordinates and a mask of the rows with valid coordinates."""
+
+    coords = np.zeros((len(rows), 2), dtype=np.float32)
+    valid = np.ones(len(rows), dtype=np.bool_)
+    for i, row in enumerate(rows):
+        try:
+            coords[i] = (float(row[lat_idx]), float(row[lon_idx]))
+        except (ValueError, IndexError):
+            valid[i] = False
+
+    valid &= np.isfinite(coords).all(axis=1)
+    return coords, valid
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = ArgumentParser(
+        prog="python -m houtu",
+        description="Adds the nearest city to every row of a CSV or TSV file. "
+        "Files ending with .gz, .bz2 or .xz are (de)compressed.",
+    )
+    parser.add_argument("input", help="Input file or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="Output file or - for stdout")
+    parser.add_argument("--lat", default="lat", help="Name of the latitude column (in degrees)")
+    parser.add_argument("--lon", default="lon", help="Name of the longitude column (in degrees)")
+    parser.add_argument("--delimiter", help="Field delimiter. Defaults to tab for .tsv files and comma otherwise.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="ball")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes. -1 uses all cores.")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Number of rows queried at once")
+    parser.add_argument("--no-cache", action="store_true", help="Don't load the index from the cache directory")
+    args = parser.parse_args(argv)
+
+    in_delimiter = args.delimiter or default_delimiter(args.input)
+    out_delimiter = args.delimiter or default_delimiter(args.output)
+
+    with ExitStack() as stack:
+        # the header is validated before the index is loaded and the output is opened, so an invalid input
+        # doesn't truncate an existing output file
+        fr = stack.enter_context(open_text(args.input, "r"))
+        reader = csv.reader(fr, delimiter=in_delimiter)
+        header = next(reader, None)
+        if header is None:
+            parser.error("Input doesn't contain a header row")
+        try:
+            lat_idx = header.index(args.lat)
+            lon_idx = header.index(args.lon)
+        except ValueError:
+            parser.error(f"Input doesn't contain the columns {args.lat} and {args.lon}: {header}")
+
+        cls = BACKENDS[args.backend]
+        geo = cls() if args.no_cache else cls.from_cache()
+        if args.processes == 1:
+            query = geo.query
+        else:
+            # the reader thread is already running when the workers are started, so don't fork
+            pool = QueryPool(geo, args.processes, multiprocessing.get_context("spawn"))
+            query = stack.enter_context(pool).query
+
+        fw = stack.enter_context(open_text(args.output, "w"))
+        writer = csv.writer(fw, delimiter=out_delimiter, lineterminator="\n")
+        writer.writerow(header + list(OUTPUT_COLUMNS) + ["distance"])
+
+        start = time.perf_counter()
+        num_rows = 0
+        for rows in prefetch(read_chunks(reader, args.chunk_size)):
+            coords, valid = parse_coords(rows, lat_idx, lon_idx)
+            columns = [np.full(len(rows), "", dtype=object) for _ in range(len(OUTPUT_COLUMNS) + 1)]
+
+            if valid.any():
+                _, distances, cities = query(coords[valid], 1, "degrees", True, return_coords=False)
+                for column, name in zip(columns, OUTPUT_COLUMNS):
+                    column[valid] = cities.column(name)[:, 0]
+                columns[-1][valid] = [f"{d:.1f}" for d in distances[:, 0].tolist()]
+
+            writer.writerows(row + list(values) for row, values in zip(rows, zip(*columns)))
+            num_rows += len(rows)
+
+        seconds = time.perf_counter() - start
+
+    print(f"Geocoded {num_rows} rows in {seconds:.1f}s ({num_rows / max(seconds, 1e-9):.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from .cities import City
+from .geocoding import ReverseGeocodeBase
+
+LookupResult = Tuple[List[float], float, City]
+
+
+class AsyncReverseGeocoder:
+    """Coalesces concurrent single point lookups into batch queries.
+
+    Lookups are collected until `max_batch` points are pending or the first pending point has waited
+    for `max_latency` seconds. Then all pending points are queried at once using `executor`
+    (the default executor of the event loop if None), so the event loop is not blocked.
+
+    Example:
+    >>> async with AsyncReverseGeocoder(ReverseGeocode()) as geocoder:
+    ...     coords, distance, city = await geocoder.lookup(25.04776, 121.53185)
+    """
+
+    def __init__(
+        self,
+        geo: ReverseGeocodeBase,
+        form: str = "degrees",
+        max_batch: int = 1024,
+        max_latency: float = 0.002,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be >= 1, not {max_batch}")
+
+        self.geo = geo
+        self.form = form
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.executor = executor
+        self.batches = 0  # number of batch queries so far
+
+        self._pending: List[Tuple[float, float, "asyncio.Future[LookupResult]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def lookup(self, lat: float, lon: float) -> LookupResult:
+        """Returns the coordinates (in radians), the distance (in meters) and the nearest city of the point."""
+
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[LookupResult]" = loop.create_future()
+        self._pending.append((lat, lon, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_latency, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _query(self, query_arr: np.ndarray) -> List[LookupResult]:
+        coords, distances, cities = self.geo.query(query_arr, 1, self.form, True)
+        return [
+            (point_coords, distance, city)
+            for point_coords, distance, (city,) in zip(coords[:, 0].tolist(), distances[:, 0].tolist(), cities.tolist())
+        ]
+
+    async def _run(self, batch: List[Tuple[float, float, "asyncio.Future[LookupResult]"]]) -> None:
+        query_arr = np.array([(lat, lon) for lat, lon, _ in batch], dtype=np.float32)
+        self.batches += 1
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._query, query_arr)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():  # the caller might have been cancelled
+                    future.set_result(result)
+        finally:
+            # the batch was cancelled (CancelledError is no `Exception`), cancel its lookups so none stay pending
+            for _, _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    async def close(self) -> None:
+        """Queries the pending points and waits for all running batches."""
+
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def __aenter__(self) -> "AsyncReverseGeocoder":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
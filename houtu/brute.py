@@ -0,0 +1,253 @@
+from typing import Tuple
+
+import numpy as np
+
+from .utils import haversine, unit_vectors
+
+
+def _merge_topk(
+    values: np.ndarray, indices: np.ndarray, new_values: np.ndarray, new_indices: np.ndarray, m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Keeps the `m` largest values per row out of both sets of candidates (unsorted)."""
+
+    values = np.concatenate([values, new_values], axis=1)
+    indices = np.concatenate([indices, new_indices], axis=1)
+    if values.shape[1] > m:
+        part = np.argpartition(values, -m, axis=1)[:, -m:]
+        values = np.take_along_axis(values, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+    return values, indices
+
+
+def _merge_block(
+    values: np.ndarray, indices: np.ndarray, block: np.ndarray, offset: int, m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merges the scores of a block of points (with indices starting at `offset`) into the running top-m.
+    Only the entries of the block which are larger than the current m-th largest value are considered,
+    which usually are very few once some blocks have been processed.
+    """
+
+    if values.shape[1] < m:
+        block_indices = np.broadcast_to(np.arange(offset, offset + block.shape[1]), block.shape)
+        return _merge_topk(values, indices, block, block_indices, m)
+
+    # finding the few rows with hits using a reduction first is much faster than `nonzero` on the whole block
+    threshold = values.min(axis=1)
+    candidates = np.flatnonzero(block.max(axis=1) > threshold)
+    if candidates.size == 0:
+        return values, indices
+    sub_rows, cols = np.nonzero(block[candidates] > threshold[candidates, None])
+    rows = candidates[sub_rows]
+    if rows.size > block.size // 16:
+        block_indices = np.broadcast_to(np.arange(offset, offset + block.shape[1]), block.shape)
+        return _merge_topk(values, indices, block, block_indices, m)
+
+    # scatter the hits of each row into a padded array
+    hit_rows, starts, counts = np.unique(rows, return_index=True, return_counts=True)
+    pos = np.arange(rows.size) - np.repeat(starts, counts)
+    sub = np.repeat(np.arange(hit_rows.size), counts)
+    new_values = np.full((hit_rows.size, counts.max()), -np.inf, dtype=values.dtype)
+    new_indices = np.zeros((hit_rows.size, counts.max()), dtype=indices.dtype)
+    new_values[sub, pos] = block[rows, cols]
+    new_indices[sub, pos] = cols + offset
+
+    values[hit_rows], indices[hit_rows] = _merge_topk(values[hit_rows], indices[hit_rows], new_values, new_indices, m)
+    return values, indices
+
+
+class BlockedKnn:
+    """Exact brute force k-nearest-neighbour search with memory usage bounded by the block sizes.
+
+    Queries and points are processed in blocks. For each block, float32 matrix products of query and point vectors
+    compute scores which are larger for closer points, and a running top-(k + extra) is kept per query.
+    These candidates are re-ranked using exact float64 distances.
+    The error of the float32 scores is bounded by `tolerance`, so queries where a point outside of the candidates
+    could be closer than the k-th neighbour are detected and searched again using exact distances.
+    """
+
+    query_block = 512
+    point_block = 4096
+    extra = 8  # additional candidates kept from the float32 pass
+    tolerance = 1e-6  # upper bound of the absolute error of the float32 scores
+
+    def __init__(self, points: np.ndarray) -> None:
+        self.points = points
+        # a random order makes the running top-k converge quickly, no matter how the points are sorted
+        self.order = np.random.default_rng(0).permutation(points.shape[0])
+        self.vectors = self._point_vectors(points[self.order])
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the arrays built from the points, excluding the points themselves."""
+
+        return self.order.nbytes + self.vectors.nbytes
+
+    def _query_vectors(self, queries: np.ndarray) -> np.ndarray:
+        """Returns float32 vectors of shape (n, 4) for the queries."""
+
+        raise NotImplementedError
+
+    def _point_vectors(self, points: np.ndarray) -> np.ndarray:
+        """Returns float32 vectors of shape (n, 4) for the points.
+        The dot product with a query vector must be larger the closer the point is to the query.
+        """
+
+        raise NotImplementedError
+
+    def _distances(self, queries: np.ndarray, points: np.ndarray) -> np.ndarray:
+        """Computes exact float64 distances between broadcastable arrays of queries and points."""
+
+        raise NotImplementedError
+
+    def _scores(self, queries: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        """Converts exact distances to the exact value of the score which the vectors approximate."""
+
+        raise NotImplementedError
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted distances and indices of the `k` nearest points for each query."""
+
+        n = self.points.shape[0]
+        if k > n:
+            raise ValueError(f"k must be <= number of points ({n}), not {k}")
+
+        m = min(k + self.extra, n)
+        query_vectors = self._query_vectors(queries)
+        out_distances = np.empty((queries.shape[0], k), dtype=np.float64)
+        out_indices = np.empty((queries.shape[0], k), dtype=np.intp)
+
+        for qstart in range(0, queries.shape[0], self.query_block):
+            qend = min(qstart + self.query_block, queries.shape[0])
+            qvectors = query_vectors[qstart:qend]
+
+            scores = np.empty((qend - qstart, 0), dtype=np.float32)
+            indices = np.empty((qend - qstart, 0), dtype=np.intp)
+            for pstart in range(0, n, self.point_block):
+                pend = min(pstart + self.point_block, n)
+                block = qvectors @ self.vectors[pstart:pend].T
+                scores, indices = _merge_block(scores, indices, block, pstart, m)
+
+            indices = self.order[indices]
+            qs = queries[qstart:qend]
+            distances = self._distances(qs[:, None, :], self.points[indices])
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            out_distances[qstart:qend] = distances
+            out_indices[qstart:qend] = np.take_along_axis(indices, order, axis=1)
+
+            if m < n:
+                # points which are not candidates have a true score of at most min(scores) + tolerance.
+                # if that's not less than the true score of the k-th neighbour, search again.
+                bound = scores.min(axis=1).astype(np.float64) + self.tolerance
+                for i in np.flatnonzero(~(self._scores(qs, distances[:, -1]) > bound)).tolist():
+                    out_distances[qstart + i], out_indices[qstart + i] = self._query_exact(qs[i], k)
+
+        return out_distances, out_indices
+
+    def query_radius(self, queries: np.ndarray, radii: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Finds all points within distance `radii[i]` of query `i`.
+        Returns offsets, indices and distances in CSR layout, ie. the results of query `i` are
+        `indices[offsets[i] : offsets[i + 1]]`. The results of each query are sorted by index.
+        """
+
+        query_vectors = self._query_vectors(queries)
+        # float32 bounds which are rounded down, so no point within the radius is missed
+        bounds = (self._scores(queries, radii) - self.tolerance).astype(np.float32)
+        bounds = np.nextafter(bounds, np.float32(-np.inf))
+
+        all_rows = []
+        all_indices = []
+        all_distances = []
+        for qstart in range(0, queries.shape[0], self.query_block):
+            qend = min(qstart + self.query_block, queries.shape[0])
+            qvectors = query_vectors[qstart:qend]
+            qbounds = bounds[qstart:qend]
+
+            for pstart in range(0, self.points.shape[0], self.point_block):
+                pend = min(pstart + self.point_block, self.points.shape[0])
+                block = qvectors @ self.vectors[pstart:pend].T
+                candidates = np.flatnonzero(block.max(axis=1) >= qbounds)
+                if candidates.size == 0:
+                    continue
+                sub_rows, cols = np.nonzero(block[candidates] >= qbounds[candidates, None])
+                rows = qstart + candidates[sub_rows]
+                indices = self.order[pstart + cols]
+                distances = self._distances(queries[rows], self.points[indices])
+                mask = distances <= radii[rows]
+                all_rows.append(rows[mask])
+                all_indices.append(indices[mask])
+                all_distances.append(distances[mask])
+
+        if not all_rows:
+            return np.zeros(queries.shape[0] + 1, dtype=np.int64), np.empty(0, np.intp), np.empty(0, np.float64)
+
+        rows = np.concatenate(all_rows)
+        indices = np.concatenate(all_indices)
+        distances = np.concatenate(all_distances)
+        order = np.lexsort((indices, rows))
+        offsets = np.zeros(queries.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=queries.shape[0]), out=offsets[1:])
+        return offsets, indices[order], distances[order]
+
+    def _query_exact(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        n = self.points.shape[0]
+        scores = np.empty((1, 0), dtype=np.float64)
+        indices = np.empty((1, 0), dtype=np.intp)
+        for pstart in range(0, n, self.point_block):
+            pend = min(pstart + self.point_block, n)
+            block = -self._distances(query[None, None, :], self.points[None, pstart:pend])
+            scores, indices = _merge_topk(scores, indices, block, np.arange(pstart, pend)[None, :], k)
+
+        order = np.argsort(-scores[0], kind="stable")
+        return -scores[0, order], indices[0, order]
+
+
+class HaversineKnn(BlockedKnn):
+    """Points are (latitude, longitude) in radians, distances are great-circle angles in radians.
+    Scores are dot products of unit vectors, ie. the cosine of the angle.
+    """
+
+    def _query_vectors(self, queries: np.ndarray) -> np.ndarray:
+        out = np.zeros((queries.shape[0], 4), dtype=np.float32)
+        out[:, :3] = unit_vectors(queries)
+        return out
+
+    def _point_vectors(self, points: np.ndarray) -> np.ndarray:
+        return self._query_vectors(points)
+
+    def _distances(self, queries: np.ndarray, points: np.ndarray) -> np.ndarray:
+        return haversine(queries, points)
+
+    def _scores(self, queries: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        return np.cos(distances)
+
+
+class EuclideanKnn(BlockedKnn):
+    """Points are cartesian coordinates (x, y, z) in meters, distances are euclidean distances in meters.
+    Scores are `q.p - |p|^2 / 2` which is `(|q|^2 - |q-p|^2) / 2`.
+    Coordinates are scaled by a power of two so float32 inputs are represented exactly.
+    """
+
+    scale = 2.0**-23  # brings earth sized coordinates close to 1
+
+    def _query_vectors(self, queries: np.ndarray) -> np.ndarray:
+        out = np.empty((queries.shape[0], 4), dtype=np.float32)
+        out[:, :3] = queries * self.scale
+        out[:, 3] = 1.0
+        return out
+
+    def _point_vectors(self, points: np.ndarray) -> np.ndarray:
+        scaled = points.astype(np.float64) * self.scale
+        out = np.empty((points.shape[0], 4), dtype=np.float32)
+        out[:, :3] = scaled
+        out[:, 3] = -0.5 * np.einsum("ij,ij->i", scaled, scaled)
+        return out
+
+    def _distances(self, queries: np.ndarray, points: np.ndarray) -> np.ndarray:
+        diff = queries.astype(np.float64) - points.astype(np.float64)
+        return np.sqrt(np.sum(diff * diff, axis=-1))
+
+    def _scores(self, queries: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        scaled = queries.astype(np.float64) * self.scale
+        distances = distances * self.scale
+        return 0.5 * (np.einsum("ij,ij->i", scaled, scaled) - distances * distances)
@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+from typing import List, Literal, NamedTuple, Tuple, overload
+
+import numpy as np
+
+from .cities import City, CityTable
+from .geocoding import QueryResult, ReverseGeocodeBase, _check_input
+
+MAX_DECIMALS = 7  # quantized longitudes in [-180, 180) must fit into 32 bits
+
+
+class CacheInfo(NamedTuple):
+    hits: int  # points which were answered without querying the index
+    misses: int  # points which were queried
+    maxsize: int
+    currsize: int
+
+
+class QueryCache:
+    """LRU cache of query results for repeatedly queried coordinates.
+
+    Coordinates are rounded to `decimals` decimal places in degrees (5 decimals are about 1 meter)
+    and the index is queried for the rounded coordinates, so all points which round to the same
+    coordinates get the same results. Duplicate points within a batch are only queried once.
+    At most `maxsize` results are kept, the least recently used ones are evicted first.
+    The cache is thread-safe.
+
+    Example:
+    >>> cached = QueryCache(ReverseGeocode(), decimals=4, maxsize=100000)
+    >>> coords, distances, cities = cached.query(query_arr, k=1, form="degrees")
+    >>> cached.cache_info()
+    """
+
+    def __init__(self, geo: ReverseGeocodeBase, decimals: int = 5, maxsize: int = 65536) -> None:
+        if not 0 <= decimals <= MAX_DECIMALS:
+            raise ValueError(f"decimals must be in [0, {MAX_DECIMALS}], not {decimals}")
+        if maxsize < 0:
+            raise ValueError(f"maxsize must be >= 0, not {maxsize}")
+
+        self.geo = geo
+        self.decimals = decimals
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[Tuple[int, int], Tuple[np.ndarray, np.ndarray, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _quantize(self, query_arr: np.ndarray, form: str) -> np.ndarray:
+        degrees = _check_input(query_arr, 1, form, "degrees").astype(np.float64)
+        quantized = np.round(degrees * 10.0**self.decimals).astype(np.int64)
+        # longitudes like 300 degrees (as returned by `rand_lat_lon`) are wrapped, so they fit into 32 bits
+        half_turn = 180 * 10**self.decimals
+        lon = (quantized[:, 1] + half_turn) % (2 * half_turn) - half_turn
+        return quantized[:, 0] * 2**32 + lon
+
+    def _dequantize(self, keys: np.ndarray) -> np.ndarray:
+        lat = (keys + 2**31) >> 32  # floor division which undoes the negative longitudes
+        lon = keys - lat * 2**32
+        degrees = np.stack([lat, lon], axis=-1) / 10.0**self.decimals
+        return np.deg2rad(degrees).astype(np.float32)
+
+    @overload
+    def query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
+    ) -> Tuple[np.ndarray, np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
+    ) -> Tuple[np.ndarray, CityTable]: ...
+
+    @overload
+    def query(self, query_arr: np.ndarray, k: int, form: str, return_distance: bool) -> QueryResult: ...
+
+    def query(self, query_arr, k=2, form="radians", return_distance=True):
+        """See `ReverseGeocodeBase.query`. Distances are relative to the rounded coordinates."""
+
+        _check_input(query_arr, k, form, form)
+        keys, inverse = np.unique(self._quantize(query_arr, form), return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        hits: List[Tuple[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]] = []
+        missing: List[int] = []
+        with self._lock:
+            for i, key in enumerate(keys.tolist()):
+                entry = self._cache.get((key, k))
+                if entry is None:
+                    missing.append(i)
+                else:
+                    hits.append((i, entry))
+                    self._cache.move_to_end((key, k))
+            self._hits += query_arr.shape[0] - len(missing)
+            self._misses += len(missing)
+
+        if missing:
+            missing_coords, missing_distances, missing_cities = self.geo.query(
+                self._dequantize(keys[missing]), k, "radians", True
+            )
+            assert missing_cities.indices is not None
+            dtypes = missing_coords.dtype, missing_distances.dtype
+        elif hits:
+            dtypes = hits[0][1][0].dtype, hits[0][1][1].dtype
+        else:
+            dtypes = np.dtype(np.float32), np.dtype(np.float64)
+
+        # cached results keep the dtypes of the backend
+        coords = np.empty((keys.size, k, 2), dtype=dtypes[0])
+        distances = np.empty((keys.size, k), dtype=dtypes[1])
+        indices = np.empty((keys.size, k), dtype=np.intp)
+        for i, entry in hits:
+            coords[i], distances[i], indices[i] = entry
+
+        if missing:
+            coords[missing] = missing_coords
+            distances[missing] = missing_distances
+            indices[missing] = missing_cities.indices
+
+            with self._lock:
+                for i in missing:
+                    self._cache[(int(keys[i]), k)] = (coords[i].copy(), distances[i].copy(), indices[i].copy())
+                    self._cache.move_to_end((int(keys[i]), k))
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        cities = self.geo.cities.take(indices[inverse])
+        if return_distance:
+            return coords[inverse], distances[inverse], cities
+        else:
+            return coords[inverse], cities
+
+    def lat_lon(self, lat: float, lon: float, form: str) -> Tuple[List[float], float, City]:
+        query_arr = np.array([[lat, lon]], dtype=np.float32)
+        coords, distances, cities = self.query(query_arr, 1, form, True)
+        return coords[0, 0].tolist(), distances[0, 0], cities[0][0]
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
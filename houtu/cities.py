@@ -0,0 +1,339 @@
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union, overload
+
+import numpy as np
+
+ELEVATION_MISSING = np.iinfo(np.int32).min
+
+STRING_COLUMNS = (
+    "feature_class",
+    "feature_code",
+    "country_code",
+    "admin1_code",
+    "admin2_code",
+    "admin3_code",
+    "admin4_code",
+    "timezone",
+)
+
+
+class City(NamedTuple):
+    name: str
+    feature_class: str
+    feature_code: str
+    country_code: str
+    admin1_code: str
+    admin2_code: str
+    admin3_code: str
+    admin4_code: str
+    population: int
+    elevation: Optional[int]
+    timezone: str
+
+
+def pack_strings(strings: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes strings as one utf-8 buffer and an array of offsets into it."""
+
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def unpack_strings(data: np.ndarray, offsets: np.ndarray) -> List[str]:
+    buf = data.tobytes()
+    return [buf[start:end].decode("utf-8") for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def code_dtype(size: int) -> np.dtype:
+    """Returns the smallest integer type which can index a vocabulary of `size` values."""
+
+    for dtype in (np.uint8, np.uint16):
+        if size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.int32)
+
+
+def dict_encode(values: Iterable[str]) -> Tuple[np.ndarray, List[str]]:
+    """Returns integer codes and the vocabulary they index into. The codes use the smallest type which fits."""
+
+    vocab: Dict[str, int] = {}
+    codes = [vocab.setdefault(v, len(vocab)) for v in values]
+    return np.array(codes, dtype=code_dtype(len(vocab))), list(vocab)
+
+
+class CityFilter(NamedTuple):
+    """Selects cities by their attributes. Fields which are None (or 0 for `min_population`) match all cities.
+    Filters are hashable, so they can be used as keys for cached indices.
+
+    Example:
+    >>> CityFilter(country_codes=("DE", "AT"), min_population=100000)
+    """
+
+    country_codes: Optional[Tuple[str, ...]] = None
+    feature_classes: Optional[Tuple[str, ...]] = None
+    feature_codes: Optional[Tuple[str, ...]] = None
+    min_population: int = 0
+
+    def normalized(self) -> "CityFilter":
+        """Converts single strings and other collections to sorted tuples, so equal filters have the same hash."""
+
+        def _norm(values: Union[None, str, Iterable[str]]) -> Optional[Tuple[str, ...]]:
+            if values is None:
+                return None
+            if isinstance(values, str):
+                return (values,)
+            return tuple(sorted(set(values)))
+
+        return CityFilter(
+            _norm(self.country_codes), _norm(self.feature_classes), _norm(self.feature_codes), self.min_population
+        )
+
+    def mask(self, cities: "CityTable") -> np.ndarray:
+        """Returns a boolean mask of the cities which match the filter."""
+
+        mask = np.ones(cities.shape, dtype=np.bool_)
+        if self.country_codes is not None:
+            mask &= cities.isin("country_code", self.country_codes)
+        if self.feature_classes is not None:
+            mask &= cities.isin("feature_class", self.feature_classes)
+        if self.feature_codes is not None:
+            mask &= cities.isin("feature_code", self.feature_codes)
+        if self.min_population > 0:
+            mask &= cities.column("population") >= self.min_population
+        return mask
+
+
+class CityTable(Sequence[City]):
+    """Struct-of-arrays storage for city metadata.
+
+    Names are stored in one packed utf-8 buffer, the other string columns are dictionary-encoded
+    (with uint8 or uint16 codes if the vocabulary is small enough) and population and elevation are stored
+    as integer arrays (missing elevations are `ELEVATION_MISSING`).
+    Tables can be indexed with integer arrays of any shape, which returns a view that shares the columns.
+    This is how the backends return query results. `City` objects are only created when rows are accessed.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], indices: Optional[np.ndarray] = None) -> None:
+        self.arrays = arrays
+        self.indices = indices
+        self._vocabs: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_columns(cls, columns: Mapping[str, Sequence[Any]]) -> "CityTable":
+        """Creates a table from a dict of column name to list of values, using the field names of `City`."""
+
+        arrays = {}
+        arrays["name.data"], arrays["name.offsets"] = pack_strings(columns["name"])
+
+        for col in STRING_COLUMNS:
+            arrays[f"{col}.codes"], vocab = dict_encode(columns[col])
+            arrays[f"{col}.vocab.data"], arrays[f"{col}.vocab.offsets"] = pack_strings(vocab)
+
+        arrays["population"] = np.array(columns["population"], dtype=np.int64)
+        arrays["elevation"] = np.array(
+            [ELEVATION_MISSING if e is None else e for e in columns["elevation"]], dtype=np.int32
+        )
+
+        return cls(arrays)
+
+    @classmethod
+    def from_cities(cls, cities: Iterable[City]) -> "CityTable":
+        rows = list(cities)
+        return cls.from_columns({field: [getattr(city, field) for city in rows] for field in City._fields})
+
+    def concat(self, *others: "CityTable") -> "CityTable":
+        """Returns a new table with the rows of `others` appended. None of the tables can be a view."""
+
+        tables = (self,) + others
+        if any(table.indices is not None for table in tables):
+            raise ValueError("Views can't be concatenated")
+
+        offsets = [self.arrays["name.offsets"]]
+        end = self.arrays["name.offsets"][-1]
+        for table in others:
+            offsets.append(table.arrays["name.offsets"][1:] + end)
+            end = end + table.arrays["name.offsets"][-1]
+        arrays = {
+            "name.data": np.concatenate([table.arrays["name.data"] for table in tables]),
+            "name.offsets": np.concatenate(offsets),
+        }
+
+        for col in STRING_COLUMNS:
+            vocab = self._vocab(col).tolist()
+            codes = {value: i for i, value in enumerate(vocab)}
+            remaps = []
+            for table in others:
+                for value in table._vocab(col).tolist():
+                    if value not in codes:
+                        codes[value] = len(vocab)
+                        vocab.append(value)
+                remaps.append([codes[value] for value in table._vocab(col).tolist()])
+            dtype = code_dtype(len(vocab))
+            parts = [self.arrays[f"{col}.codes"].astype(dtype)]
+            for table, remap in zip(others, remaps):
+                parts.append(np.array(remap, dtype=dtype)[table.arrays[f"{col}.codes"]])
+            arrays[f"{col}.codes"] = np.concatenate(parts)
+            arrays[f"{col}.vocab.data"], arrays[f"{col}.vocab.offsets"] = pack_strings(vocab)
+
+        arrays["population"] = np.concatenate([table.arrays["population"] for table in tables])
+        arrays["elevation"] = np.concatenate([table.arrays["elevation"] for table in tables])
+
+        return CityTable(arrays)
+
+    @property
+    def num_rows(self) -> int:
+        """Number of rows in the underlying columns."""
+
+        return len(self.arrays["population"])
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self.indices is None:
+            return (self.num_rows,)
+        return self.indices.shape
+
+    def _vocab(self, col: str) -> np.ndarray:
+        try:
+            return self._vocabs[col]
+        except KeyError:
+            vocab = unpack_strings(self.arrays[f"{col}.vocab.data"], self.arrays[f"{col}.vocab.offsets"])
+            out = self._vocabs[col] = np.array(vocab, dtype=object)
+            return out
+
+    def _row(self, idx: int) -> City:
+        arrays = self.arrays
+        start, end = arrays["name.offsets"][idx : idx + 2].tolist()
+        name = arrays["name.data"][start:end].tobytes().decode("utf-8")
+        feature_class, feature_code, country_code, admin1, admin2, admin3, admin4, timezone = (
+            self._vocab(col)[arrays[f"{col}.codes"][idx]] for col in STRING_COLUMNS
+        )
+        elevation = arrays["elevation"][idx].item()
+
+        return City(
+            name,
+            feature_class,
+            feature_code,
+            country_code,
+            admin1,
+            admin2,
+            admin3,
+            admin4,
+            arrays["population"][idx].item(),
+            None if elevation == ELEVATION_MISSING else elevation,
+            timezone,
+        )
+
+    def take(self, indices: np.ndarray) -> "CityTable":
+        """Selects rows using an integer array of any shape. Indices are relative to this table."""
+
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+
+        out = CityTable(self.arrays, indices)
+        out._vocabs = self._vocabs  # share decoded vocabularies between views
+        return out
+
+    def _rows(self) -> np.ndarray:
+        if self.indices is None:
+            return np.arange(self.num_rows)
+        return self.indices
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns the values of column `name` for all rows, with the same shape as the table.
+        String columns are returned as object arrays.
+        """
+
+        rows = self._rows()
+        if name == "name":
+            offsets = self.arrays["name.offsets"]
+            buf = self.arrays["name.data"].tobytes()
+            names = [buf[start:end].decode("utf-8") for start, end in zip(offsets[rows].flat, offsets[rows + 1].flat)]
+            return np.array(names, dtype=object).reshape(rows.shape)
+        elif name in STRING_COLUMNS:
+            return self._vocab(name)[self.arrays[f"{name}.codes"][rows]]
+        elif name in ("population", "elevation"):
+            return self.arrays[name][rows]
+        else:
+            raise ValueError(f"Invalid column: {name}")
+
+    def isin(self, name: str, values: Iterable[str]) -> np.ndarray:
+        """Returns a boolean mask with the same shape as the table of the rows whose string column `name`
+        is one of `values`. Only the vocabulary of the column is compared with `values`.
+        """
+
+        if name not in STRING_COLUMNS:
+            raise ValueError(f"Invalid string column: {name}")
+
+        codes = np.flatnonzero(np.isin(self._vocab(name), list(values)))
+        return np.isin(self.arrays[f"{name}.codes"][self._rows()], codes)
+
+    def take_rows(self, rows: np.ndarray) -> "CityTable":
+        """Like `take`, but `rows` are indices into the underlying columns (like `indices`), not this table."""
+
+        out = CityTable(self.arrays, np.asarray(rows))
+        out._vocabs = self._vocabs
+        return out
+
+    def tolist(self) -> List[Any]:
+        """Returns (possibly nested) lists of `City` objects."""
+
+        if self.indices is None:
+            return [self._row(i) for i in range(self.num_rows)]
+        if self.indices.ndim == 0:
+            return self._row(self.indices.item())  # type: ignore[return-value]
+        return self._tolist(self.indices)
+
+    def _tolist(self, indices: np.ndarray) -> List[Any]:
+        if indices.ndim == 1:
+            return [self._row(i) for i in indices.tolist()]
+        return [self._tolist(sub) for sub in indices]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @overload
+    def __getitem__(self, key: int) -> Any: ...
+
+    @overload
+    def __getitem__(self, key: Union[slice, np.ndarray]) -> "CityTable": ...
+
+    def __getitem__(self, key):
+        if self.indices is None:
+            if isinstance(key, (int, np.integer)):
+                if not -self.num_rows <= key < self.num_rows:
+                    raise IndexError("CityTable index out of range")
+                return self._row(int(key) % self.num_rows)
+            return self.take(np.arange(self.num_rows)[key])
+
+        sub = self.indices[key]
+        if np.ndim(sub) == 0:
+            return self._row(int(sub))
+        out = CityTable(self.arrays, sub)
+        out._vocabs = self._vocabs
+        return out
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CityTable):
+            return self.tolist() == other.tolist()
+        if isinstance(other, (list, tuple)):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        if len(self) > 20:
+            return f"<CityTable shape={self.shape}>"
+        return f"CityTable({self.tolist()!r})"
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"arrays": self.arrays, "indices": self.indices}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["arrays"], state["indices"])  # type: ignore[misc]
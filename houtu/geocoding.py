@@ -1,29 +1,62 @@
-import csv
-import lzma
-from typing import List, Literal, NamedTuple, Optional, Set, Tuple, overload
+import logging
+import os
+import pickle  # nosec B403
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+    overload,
+)
 
 import numpy as np
-from importlib_resources import files
-from sklearn.metrics.pairwise import euclidean_distances, haversine_distances
 
+from .cities import City, CityFilter, CityTable
+from .stats import QueryStats, stage
+from .storage import (
+    PathType,
+    StorageError,
+    attach_shared_memory,
+    create_shared_memory,
+    file_hash,
+    get_cache_dir,
+    read_arrays,
+    write_arrays,
+)
+from .utils import haversine, prefetch, ragged_to_csr, unit_vectors
 
-class City(NamedTuple):
-    name: str
-    feature_class: str
-    feature_code: str
-    country_code: str
-    admin1_code: str
-    admin2_code: str
-    admin3_code: str
-    admin4_code: str
-    population: int
-    elevation: Optional[int]
-    timezone: str
+if TYPE_CHECKING:
+    from multiprocessing.shared_memory import SharedMemory
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2  # increase when the layout of the cached arrays changes
+INDEX_VERSION = 4  # increase when the layout of saved indices changes
 
 
 class Cities(NamedTuple):
     coords: np.ndarray
-    info: List[City]
+    info: CityTable
+
+
+class Dataset(NamedTuple):
+    coords: np.ndarray  # geodetic coordinates (latitude, longitude) in radians
+    ecef: np.ndarray  # ECEF coordinates (x, y, z) in meters
+    info: CityTable
 
 
 earth_radii = {
@@ -140,6 +173,82 @@ class WGS84:
         assert lat.shape == lon.shape == alt.shape
         return np.stack([lat, lon, alt], axis=-1)
 
+    @classmethod
+    def geodesic_distance(cls, a: np.ndarray, b: np.ndarray, max_iter: int = 100) -> np.ndarray:
+        """Distances in meters on the ellipsoid between broadcastable arrays of geodetic coordinates
+        (latitude, longitude) in radians, using Vincenty's inverse formula.
+        The formula is inaccurate for nearly antipodal points. Pairs for which it doesn't converge
+        get great-circle distances instead.
+
+        See `pymap3d.vincenty.vdist` for a scalar implementation.
+        """
+
+        lat1, lon1 = a[..., 0].astype(np.float64), a[..., 1].astype(np.float64)
+        lat2, lon2 = b[..., 0].astype(np.float64), b[..., 1].astype(np.float64)
+        lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+
+        L = lon2 - lon1
+        U1 = np.arctan((1.0 - cls.F) * np.tan(lat1))
+        U2 = np.arctan((1.0 - cls.F) * np.tan(lat2))
+        sinU1, cosU1 = np.sin(U1), np.cos(U1)
+        sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+        def terms(idx: Any, lam: np.ndarray) -> Tuple[np.ndarray, ...]:
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            t1 = cosU2[idx] * sin_lam
+            t2 = cosU1[idx] * sinU2[idx] - sinU1[idx] * cosU2[idx] * cos_lam
+            sin_sigma = np.sqrt(t1 * t1 + t2 * t2)
+            cos_sigma = sinU1[idx] * sinU2[idx] + cosU1[idx] * cosU2[idx] * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sin_alpha = np.where(sin_sigma == 0.0, 0.0, cosU1[idx] * cosU2[idx] * sin_lam / sin_sigma)
+                cos2_alpha = 1.0 - sin_alpha * sin_alpha
+                # points on the equator have cos2_alpha == 0
+                cos_2sigma_m = np.where(cos2_alpha == 0.0, 0.0, cos_sigma - 2.0 * sinU1[idx] * sinU2[idx] / cos2_alpha)
+            return sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m
+
+        lam = L.copy()
+        active = np.arange(L.size)
+        for _ in range(max_iter):
+            idx = np.unravel_index(active, L.shape)
+            sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms(idx, lam[idx])
+            C = cls.F / 16.0 * cos2_alpha * (4.0 + cls.F * (4.0 - 3.0 * cos2_alpha))
+            new_lam = L[idx] + (1.0 - C) * cls.F * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1.0 + 2.0 * cos_2sigma_m * cos_2sigma_m))
+            )
+            converged = np.abs(new_lam - lam[idx]) <= 1e-12
+            lam[idx] = new_lam
+            active = active[~converged]
+            if active.size == 0:
+                break
+
+        sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms(..., lam)
+        u2 = cos2_alpha * (cls.A**2 - cls.B**2) / cls.B**2
+        A = 1.0 + u2 / 16384.0 * (4096.0 + u2 * (-768.0 + u2 * (320.0 - 175.0 * u2)))
+        B = u2 / 1024.0 * (256.0 + u2 * (-128.0 + u2 * (74.0 - 47.0 * u2)))
+        cos2 = cos_2sigma_m * cos_2sigma_m
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos_2sigma_m
+                + B
+                / 4.0
+                * (
+                    cos_sigma * (-1.0 + 2.0 * cos2)
+                    - B / 6.0 * cos_2sigma_m * (-3.0 + 4.0 * sin_sigma * sin_sigma) * (-3.0 + 4.0 * cos2)
+                )
+            )
+        )
+        out = cls.B * A * (sigma - delta_sigma)
+
+        if active.size > 0:
+            idx = np.unravel_index(active, L.shape)
+            angles = haversine(np.stack([lat1[idx], lon1[idx]], axis=-1), np.stack([lat2[idx], lon2[idx]], axis=-1))
+            out[idx] = angles * earth_radii["IUGG mean radius (R1)"]
+
+        return out
+
 
 def toint(s: str) -> Optional[int]:
     if s:
@@ -147,7 +256,7 @@ def toint(s: str) -> Optional[int]:
     return None
 
 
-def get_data(path: str, keep_dups: bool = False) -> Cities:
+def get_data(path: PathType, keep_dups: bool = False) -> Cities:
     """Read data from tsv file. Expect the following columns:
 
     cols = ("geonameid", "name", "asciiname", "alternatenames", "latitude", "longitude", "feature class",
@@ -159,44 +268,74 @@ def get_data(path: str, keep_dups: bool = False) -> Cities:
     This ensures more consistent results and should probably be fixed in the source data file.
     """
 
-    with lzma.open(path, "rt", encoding="utf-8", newline="") as fr:
-        lats = []
-        lons = []
-        cities = []
+    from .geonames import read_geonames
 
-        known: Set[Tuple[float, float]] = set()
-        for row in csv.reader(fr, delimiter="\t", quoting=csv.QUOTE_NONE):
-            lat = float(row[4])
-            lon = float(row[5])
+    coords, arrays = read_geonames(path, keep_dups)
+    arr = np.ascontiguousarray(np.deg2rad(coords.astype(np.float32)))
+
+    return Cities(arr, CityTable(arrays))
+
+
+def _dataset_to_arrays(cities: Cities) -> Dict[str, np.ndarray]:
+    assert cities.info.indices is None
+    arrays = {"coords": cities.coords, "ecef": WGS84.geodetic2ecef(cities.coords)}
+    arrays.update(cities.info.arrays)
+    return arrays
+
+
+def _arrays_to_dataset(arrays: Dict[str, np.ndarray]) -> Dataset:
+    info = {name: arr for name, arr in arrays.items() if name not in ("coords", "ecef")}
+    return Dataset(arrays["coords"], arrays["ecef"], CityTable(info))
 
-            if not keep_dups:
-                if (lat, lon) in known:
-                    continue
-                else:
-                    known.add((lat, lon))
-
-            city = City(
-                row[1],
-                row[6],
-                row[7],
-                row[8],
-                row[10],
-                row[11],
-                row[12],
-                row[13],
-                int(row[14]),
-                toint(row[15]),
-                row[17],
-            )
 
-            lats.append(lat)
-            lons.append(lon)
-            cities.append(city)
+def default_data_path() -> PathType:
+    from importlib_resources import files
 
-    arr = np.array([lats, lons], dtype=np.float32).T
-    arr = np.ascontiguousarray(np.deg2rad(arr))
+    return cast(PathType, files(__package__).joinpath("data/cities1000.txt.xz"))
 
-    return Cities(arr, cities)
+
+def load_data(path: Optional[PathType] = None, keep_dups: bool = False, cache: bool = True) -> Dataset:
+    """Like `get_data`, but also returns ECEF coordinates and uses an on-disk cache.
+
+    The cache file stores the coordinates and columnar city metadata in a binary format which is memory-mapped
+    when loading, so processes which load the same file share the same page-cache pages.
+    It is invalidated when the sha256 hash of the source file or `CACHE_VERSION` changes.
+    The cache directory can be set using the `HOUTU_CACHE_DIR` environment variable.
+    """
+
+    if path is None:
+        path = default_data_path()
+
+    if not cache:
+        cities = get_data(path, keep_dups)
+        return Dataset(cities.coords, WGS84.geodetic2ecef(cities.coords), cities.info)
+
+    source_hash = file_hash(path)
+    meta = {"cache_version": CACHE_VERSION, "source_sha256": source_hash, "keep_dups": keep_dups}
+    dups = "dups" if keep_dups else "nodups"
+    cachepath = get_cache_dir() / f"{os.path.basename(path)}-{source_hash[:16]}-{dups}-v{CACHE_VERSION}.bin"
+
+    try:
+        arrays, cached_meta = read_arrays(cachepath)
+        if cached_meta != meta:
+            raise StorageError(f"Outdated cache file {cachepath}")
+    except FileNotFoundError:
+        pass
+    except (OSError, StorageError, ValueError) as e:
+        logger.warning("Ignoring invalid cache file: %s", e)
+    else:
+        return _arrays_to_dataset(arrays)
+
+    cities = get_data(path, keep_dups)
+    arrays = _dataset_to_arrays(cities)
+
+    try:
+        cachepath.parent.mkdir(parents=True, exist_ok=True)
+        write_arrays(cachepath, arrays, meta)
+    except OSError as e:
+        logger.warning("Could not write cache file %s: %s", cachepath, e)
+
+    return Dataset(arrays["coords"], arrays["ecef"], cities.info)
 
 
 def _check_input(arr: np.ndarray, k: int, in_form: str, out_form: str) -> np.ndarray:
@@ -223,350 +362,1365 @@ def _check_input(arr: np.ndarray, k: int, in_form: str, out_form: str) -> np.nda
     return arr
 
 
-def _select_cities(cities: List[City], indices: np.ndarray) -> List[List[City]]:
-    out = []
-    for i in range(indices.shape[0]):
-        out.append([cities[idx] for idx in indices[i]])
-    return out
+def _select_cities(cities: CityTable, indices: np.ndarray) -> CityTable:
+    return cities.take(indices)
+
+
+def _dump_state(prefix: str, state: tuple) -> Tuple[Dict[str, np.ndarray], List[Dict[str, Any]]]:
+    """Splits the pickle state tuple of a tree object into arrays and json serializable items."""
+
+    arrays = {}
+    items: List[Dict[str, Any]] = []
+    for i, value in enumerate(state):
+        name = f"{prefix}.{i}"
+        if isinstance(value, np.ndarray):
+            arrays[name] = value
+            items.append({"array": name})
+        elif isinstance(value, bytes):
+            arrays[name] = np.frombuffer(value, dtype=np.uint8)
+            items.append({"bytes": name})
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            items.append({"value": value})
+        else:
+            arrays[name] = np.frombuffer(pickle.dumps(value), dtype=np.uint8)
+            items.append({"pickle": name})
+
+    return arrays, items
+
+
+def _load_state(arrays: Dict[str, np.ndarray], items: List[Dict[str, Any]]) -> tuple:
+    state: List[Any] = []
+    for item in items:
+        if "array" in item:
+            state.append(arrays[item["array"]])
+        elif "bytes" in item:
+            state.append(arrays[item["bytes"]].tobytes())
+        elif "pickle" in item:
+            state.append(pickle.loads(arrays[item["pickle"]].tobytes()))  # nosec B301
+        else:
+            state.append(item["value"])
+
+    return tuple(state)
+
+
+T = TypeVar("T", bound="ReverseGeocodeBase")
+QueryResult = Union[Tuple[Optional[np.ndarray], np.ndarray, CityTable], Tuple[Optional[np.ndarray], CityTable]]
+
+MIN_CHUNK_SIZE = 1024  # smaller batches are not split between workers
+
+CHORD_MARGIN = 4.0  # meters, covers the rounding errors of float32 ECEF coordinates
+
+EXACT_CANDIDATES = 2  # times k, number of candidates which are re-ranked by `query(exact=True)`
+
+TRACK_STRIDE = 32  # every this many points of `query_track` are queried using the index at first
+TRACK_CANDIDATES = 4  # times k, number of candidates which are reused for the following points by `query_track`
+TRACK_SLACK = 1e-9  # relative, covers rounding errors of the triangle inequality of `query_track`
+
+
+class RangeResult(NamedTuple):
+    """Results of `query_radius` and `query_bbox` in CSR layout.
+    The results of query `i` are `indices[offsets[i] : offsets[i + 1]]` (see `row`), sorted by distance.
+    """
+
+    offsets: np.ndarray  # shape (n + 1,)
+    indices: np.ndarray  # city indices of shape (m,)
+    distances: np.ndarray  # great-circle distances in meters of shape (m,)
+    coords: np.ndarray  # coordinates (in radians) of shape (m, 2)
+    cities: CityTable  # shape (m,)
+
+    def row(self, i: int) -> slice:
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+
+def _distance_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Euclidean distances between all rows of `a` and `b`, using a matrix product."""
+
+    sq = np.sum(a * a, axis=1)[:, None] + np.sum(b * b, axis=1)[None, :] - 2.0 * (a @ b.T)
+    return np.sqrt(np.maximum(sq, 0.0))
+
+
+def _euclidean(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Euclidean distances between broadcastable arrays of points, computed in float64 and rounded
+    like the trees of scipy and scikit-learn.
+    """
+
+    diff = a.astype(np.float64, copy=False) - b.astype(np.float64, copy=False)
+    squared = diff[..., 0] * diff[..., 0]
+    for i in range(1, diff.shape[-1]):
+        squared += diff[..., i] * diff[..., i]  # in the same order as `np.sum`, but faster for few dimensions
+    return np.sqrt(squared)
+
+
+def _chord_bound(angles: np.ndarray) -> np.ndarray:
+    """Returns an upper bound of the ECEF distance between points on the WGS84 ellipsoid
+    whose great-circle angle is at most `angles`.
+    The ellipsoid's radius of curvature is at most a^2 / b, so the chord is never longer than that times the angle.
+    """
+
+    return np.minimum(angles * (WGS84.A**2 / WGS84.B), 2 * WGS84.A) + CHORD_MARGIN
+
+
+def _check_boxes(boxes: np.ndarray, form: str) -> np.ndarray:
+    if boxes.ndim != 2 or boxes.shape[0] < 1 or boxes.shape[1] != 4 or boxes.dtype != np.float32:
+        raise ValueError("Expected numpy array of bounding boxes with shape (x>0, 4) and dtype float32")
+
+    if form == "degrees":
+        boxes = np.deg2rad(boxes)
+    elif form != "radians":
+        raise ValueError(f"Invalid input form: {form}")
+
+    if np.any(boxes[:, 0] > boxes[:, 2]):
+        raise ValueError("min_lat must be <= max_lat")
+
+    return boxes
+
+
+def _num_jobs(n_jobs: int) -> int:
+    if n_jobs == -1:
+        return os.cpu_count() or 1
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be >= 1 or -1, not {n_jobs}")
+    return n_jobs
+
+
+def _split_batch(n: int, n_jobs: int) -> List[slice]:
+    """Splits `n` points into a few chunks per job, so uneven chunks are balanced out."""
+
+    num_chunks = max(1, min(n_jobs * 4, n // MIN_CHUNK_SIZE))
+    bounds = np.linspace(0, n, num_chunks + 1).astype(np.int64).tolist()
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _rechunk(points: Iterable[Any], chunk_size: int) -> Iterator[np.ndarray]:
+    """Collects points and arrays of points from `points` into float32 arrays of at most `chunk_size` rows."""
+
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be >= 1, not {chunk_size}")
+
+    buf = np.empty((chunk_size, 2), dtype=np.float32)
+    pos = 0
+
+    for item in points:
+        arr = np.asarray(item, dtype=np.float32)
+        if arr.ndim == 1:
+            arr = arr[None, :]
+        if arr.ndim != 2 or arr.shape[1] != 2:
+            raise ValueError(f"Expected points or arrays of points with shape (x, 2), not shape {arr.shape}")
+
+        start = 0
+        if pos == 0:  # pass full chunks through without copying
+            while arr.shape[0] - start >= chunk_size:
+                yield arr[start : start + chunk_size]
+                start += chunk_size
+
+        while start < arr.shape[0]:
+            n = min(chunk_size - pos, arr.shape[0] - start)
+            buf[pos : pos + n] = arr[start : start + n]
+            pos += n
+            start += n
+            if pos == chunk_size:
+                yield buf
+                buf = np.empty((chunk_size, 2), dtype=np.float32)
+                pos = 0
+
+    if pos > 0:
+        yield buf[:pos]
+
+
+def _merge_results(cities: CityTable, results: List[QueryResult], return_distance: bool) -> QueryResult:
+    """Concatenates the results of consecutive chunks. `cities` can be a view, like the cities of filtered indices,
+    since the indices of the results refer to the rows of the underlying table.
+    """
+
+    coords = None if results[0][0] is None else np.concatenate([result[0] for result in results])
+    indices = np.concatenate([result[-1].indices for result in results])
+    if return_distance:
+        distances = np.concatenate([result[1] for result in results])
+        return coords, distances, cities.take_rows(indices)
+    else:
+        return coords, cities.take_rows(indices)
 
 
 class ReverseGeocodeBase:
-    cities: List[City]
+    cities: CityTable
+    _shm: "Optional[SharedMemory]" = None
+    library: Optional[str] = None  # distribution which implements the index. saved indices are tied to its version.
+    stats: Optional[QueryStats] = None  # set to a `QueryStats` object to measure the query stages
+    max_filter_indices = 16  # number of indices for `query(filter=...)` which are kept
+    _filter_indices: "Optional[OrderedDict[CityFilter, ReverseGeocodeBase]]" = None
+    _full_index: "Optional[ReverseGeocodeBase]" = None  # index over all cities for `query(exact=True)`
+    _filter_lock: Optional[threading.Lock] = None  # guards `_filter_indices`
+    radius = earth_radii["Spherical Earth Approx. of Radius (RE)"]  # see opt_geocoding.py
+    metric = "chord"  # distances of the results, indices with the same metric find the same cities
 
-    def __init__(self, path: Optional[str] = None) -> None:
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
         pass
 
+    @classmethod
+    def lazy(cls: Type[T], *args: Any, **kwargs: Any) -> T:
+        """Returns an instance which loads the data and builds the index on first use (or `warmup()`)
+        by calling `__init__(*args, **kwargs)`. Creating it is free, which helps short-lived processes
+        that might not need the index at all.
+        """
+
+        obj = cls.__new__(cls)
+        obj.__dict__["_pending_init"] = (args, kwargs)
+        obj.__dict__["_init_lock"] = threading.RLock()
+        return obj
+
+    def warmup(self) -> None:
+        """Loads the data and builds the index of an instance created by `lazy()` now. Thread-safe."""
+
+        if "_pending_init" not in self.__dict__:
+            return
+
+        with self.__dict__["_init_lock"]:
+            pending = self.__dict__.get("_pending_init")
+            if pending is None:  # built by another thread or the build is running in this one
+                return
+            self.__dict__["_pending_init"] = None
+            args, kwargs = pending
+            try:
+                type(self).__init__(self, *args, **kwargs)
+            except BaseException:
+                self.__dict__["_pending_init"] = pending
+                raise
+            del self.__dict__["_pending_init"]
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for missing attributes, which the deferred `__init__` of `lazy()` instances sets
+        if name.startswith("__") or "_pending_init" not in self.__dict__:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        self.warmup()
+        if "_pending_init" in self.__dict__:  # accessed by `__init__` itself
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        return getattr(self, name)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the indices built for filtered and exact queries are rebuilt on demand, locks can't be pickled
+        state = self.__dict__.copy()
+        for name in ("_filter_lock", "_filter_indices", "_full_index", "_init_lock"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._filter_lock = threading.Lock()
+        if "_pending_init" in state:  # a `lazy()` instance which wasn't built yet
+            self.__dict__["_init_lock"] = threading.RLock()
+
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """Returns arrays and a json serializable dict which describe the built index (excluding cities)."""
+
+        raise NotImplementedError(f"{type(self).__name__} doesn't support saving")
+
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        raise NotImplementedError(f"{type(self).__name__} doesn't support loading")
+
+    def _meta(self) -> Dict[str, Any]:
+        from importlib.metadata import version
+
+        return {
+            "index_version": INDEX_VERSION,
+            "class": type(self).__name__,
+            "library_version": None if self.library is None else version(self.library),
+        }
+
+    def _to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, meta = self._get_state()
+        assert self.cities.indices is None
+        arrays.update({f"cities.{name}": arr for name, arr in self.cities.arrays.items()})
+        meta.update(self._meta())
+        return arrays, meta
+
+    @classmethod
+    def _from_arrays(cls: Type[T], arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> T:
+        obj = cls.__new__(cls)
+        expected = obj._meta()
+        for key, value in expected.items():
+            if meta.get(key) != value:
+                raise StorageError(f"{key} of saved index is {meta.get(key)}, expected {value}")
+
+        prefix = "cities."
+        obj.cities = CityTable({name[len(prefix) :]: arr for name, arr in arrays.items() if name.startswith(prefix)})
+        obj._set_state({name: arr for name, arr in arrays.items() if not name.startswith(prefix)}, meta)
+        return obj
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Returns the size in bytes of the arrays of the index.
+
+        coords: coordinates stored next to the index
+        index: the index itself, including the coordinates it stores internally
+        cities: the city metadata
+
+        Backends which don't support saving only report the city metadata.
+        """
+
+        usage = {"cities": sum(arr.nbytes for arr in self.cities.arrays.values())}
+        try:
+            usage.update(self._nbytes())
+        except NotImplementedError:
+            pass
+        return usage
+
+    def _nbytes(self) -> Dict[str, int]:
+        """Returns the size in bytes of the coordinates and the index, see `memory_usage`.
+        Backends which hold their arrays override this, the default sums the arrays of `_get_state`
+        which copies the trees of some libraries.
+        """
+
+        arrays, _ = self._get_state()
+        return {
+            "coords": sum(arr.nbytes for name, arr in arrays.items() if name in ("coords", "arr")),
+            "index": sum(arr.nbytes for name, arr in arrays.items() if name not in ("coords", "arr")),
+        }
+
+    def save(self, path: PathType) -> None:
+        """Saves the built index and the city data to `path`. See `load`."""
+
+        arrays, meta = self._to_arrays()
+        write_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls: Type[T], path: PathType) -> T:
+        """Loads an index saved by `save` from `path`. The file is memory-mapped and the arrays are used
+        without copying where the underlying library allows it.
+        Raises `StorageError` if the file was saved by a different class or library version.
+        """
+
+        arrays, meta = read_arrays(path)
+        return cls._from_arrays(arrays, meta)
+
+    def share(self) -> "SharedMemory":
+        """Copies the built index and the city data into a new shared memory block.
+        Other processes can create read-only instances which use the shared arrays without copying
+        by passing the `name` of the returned block to `attach`.
+        The caller owns the block and must `close()` and `unlink()` it when it's no longer needed.
+
+        Alternatively `save` the index to a file and `load` it in every process,
+        which shares the memory through the page cache.
+        """
+
+        arrays, meta = self._to_arrays()
+        return create_shared_memory(arrays, meta)
+
+    @classmethod
+    def attach(cls: Type[T], name: str) -> T:
+        """Creates a read-only instance from the shared memory block `name` created by `share`.
+        The instance keeps the block mapped as long as it exists.
+        """
+
+        shm, arrays, meta = attach_shared_memory(name)
+        obj = cls._from_arrays(arrays, meta)
+        obj._shm = shm
+        return obj
+
+    @classmethod
+    def from_cache(cls: Type[T], path: Optional[PathType] = None) -> T:
+        """Loads the index for the data file `path` from the cache directory.
+        If it doesn't exist yet, it's built and saved to the cache.
+        """
+
+        if path is None:
+            path = default_data_path()
+
+        source_hash = file_hash(path)
+        cachepath = get_cache_dir() / f"{cls.__name__}-{source_hash[:16]}-v{INDEX_VERSION}.bin"
+
+        try:
+            return cls.load(cachepath)
+        except FileNotFoundError:
+            pass
+        except (OSError, StorageError, ValueError) as e:
+            logger.warning("Ignoring invalid index file: %s", e)
+
+        obj = cls(path)
+        try:
+            cachepath.parent.mkdir(parents=True, exist_ok=True)
+            obj.save(cachepath)
+        except OSError as e:
+            logger.warning("Could not write index file %s: %s", cachepath, e)
+
+        return obj
+
     @overload
     def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[True],
+        n_jobs: int = 1,
+        exact: bool = False,
+        return_coords: Literal[True] = True,
+        filter: Optional[CityFilter] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, CityTable]: ...
 
     @overload
     def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[False],
+        n_jobs: int = 1,
+        exact: bool = False,
+        return_coords: Literal[True] = True,
+        filter: Optional[CityFilter] = None,
+    ) -> Tuple[np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: bool,
+        n_jobs: int = 1,
+        exact: bool = False,
+        return_coords: bool = True,
+        filter: Optional[CityFilter] = None,
+    ) -> QueryResult: ...
+
+    def query(
+        self,
+        query_arr,
+        k=2,
+        form="radians",
+        return_distance=True,
+        n_jobs=1,
+        exact=False,
+        return_coords=True,
+        filter=None,
+    ):
+        """Find the `k` nearest cities for each point of `query_arr`.
+
+        query_arr: float32 array of shape (n, 2) with latitude and longitude
+        form: "radians" or "degrees"
+        return_distance: return distances in meters
+        n_jobs: number of threads used for large batches. -1 uses all cores.
+            Use `houtu.parallel.QueryPool` for a process pool.
+        exact: rank the cities by their geodesic distance on the WGS84 ellipsoid instead of the distance
+            used by the index. See `_query_exact`.
+        return_coords: if False, None is returned instead of the coordinates, which saves gathering them.
+        filter: only find cities which match this `CityFilter`. An index of the matching cities is built
+            on first use and cached, so filtered queries are as fast as unfiltered ones.
+
+        Returns coordinates (in radians) of shape (n, k, 2), distances of shape (n, k) if `return_distance` is True,
+            and a `CityTable` of shape (n, k).
+        """
+
+        with stage(self.stats, "query", query_arr.shape[0]):
+            geo = self if filter is None else self._filtered(filter, k)
+            if exact:
+                return geo._query_exact(query_arr, k, form, return_distance, n_jobs, return_coords)
+            return geo._query_jobs(query_arr, k, form, return_distance, n_jobs, return_coords)
+
+    def _build(self, data: Dataset) -> None:
+        raise NotImplementedError
+
+    def _subset(self, indices: np.ndarray) -> "ReverseGeocodeBase":
+        """Builds an index of the same class over the cities at `indices`.
+        Its `cities` are a view of this table, so its results refer to the rows of this table.
+        """
+
+        return self._build_like(self._coords(indices).astype(np.float32), self.cities.take(indices))
+
+    def _build_like(self, coords: np.ndarray, cities: CityTable) -> "ReverseGeocodeBase":
+        """Builds an index of the same kind over `coords` in radians and `cities`."""
+
+        obj = type(self).__new__(type(self))
+        obj._build(Dataset(coords, WGS84.geodetic2ecef(coords), cities))
+        return obj
+
+    def _filtered(self, city_filter: CityFilter, k: int) -> "ReverseGeocodeBase":
+        """Returns the index of the cities matching `city_filter`. It's built on first use and
+        the `max_filter_indices` most recently used ones are kept.
+        """
+
+        key = city_filter.normalized()
+        if self._filter_lock is None:
+            self.__dict__.setdefault("_filter_lock", threading.Lock())  # atomic, racing threads get the same lock
+        with self._filter_lock:
+            if self._filter_indices is None:
+                self._filter_indices = OrderedDict()
+            try:
+                geo = self._filter_indices[key]
+                self._filter_indices.move_to_end(key)
+            except KeyError:
+                indices = np.flatnonzero(key.mask(self.cities))
+                if indices.size == 0:
+                    raise ValueError(f"No cities match {key}")
+                geo = self._filter_indices[key] = self._subset(indices)
+                while len(self._filter_indices) > self.max_filter_indices:
+                    self._filter_indices.popitem(last=False)
+
+        if k > len(geo.cities):
+            raise ValueError(f"k must be <= {len(geo.cities)} (the number of cities matching the filter), not {k}")
+        geo.stats = self.stats
+        return geo
+
+    def _query_jobs(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, n_jobs: int, return_coords: bool
+    ) -> QueryResult:
+        n_jobs = _num_jobs(n_jobs)
+        if n_jobs == 1 or query_arr.shape[0] < 2 * MIN_CHUNK_SIZE:
+            return self._query(query_arr, k, form, return_distance, return_coords)
+
+        _check_input(query_arr, k, form, form)
+        return self._query_parallel(query_arr, k, form, return_distance, n_jobs, return_coords)
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        raise NotImplementedError
+
+    def _max_k(self) -> int:
+        """Returns the largest `k` which can be queried."""
+
+        return len(self.cities)
+
+    def _min_geodesic(self, distances: np.ndarray) -> np.ndarray:
+        """Returns a lower bound of the geodesic distance in meters of cities at the index distances `distances`.
+        The default is for ECEF indices, where the chord is never longer than the geodesic.
+        """
+
+        return distances - CHORD_MARGIN
+
+    def _distances(self, query_arr: np.ndarray, coords: np.ndarray) -> np.ndarray:
+        """Returns the distances in meters, as the index computes them, between all points of `query_arr` and
+        `coords` (both of shape (n, 2) in radians) as an array of shape (len(query_arr), len(coords)).
+        """
+
+        return self._from_chords(_distance_matrix(self._points(query_arr), self._points(coords)))
+
+    def _points(self, coords: np.ndarray) -> np.ndarray:
+        """Returns float64 points of shape (n, 3) for `coords` in radians, whose euclidean distances
+        the distances of the index increase with (see `_from_chords`). The default are ECEF coordinates.
+        """
+
+        return WGS84.geodetic2ecef(coords.astype(np.float64))
+
+    def _from_chords(self, chords: np.ndarray) -> np.ndarray:
+        """Converts euclidean distances between `_points` to the distances of the index.
+        The default is the identity for ECEF indices.
+        """
+
+        return chords
+
+    def _query_exact(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, n_jobs: int, return_coords: bool
+    ) -> QueryResult:
+        """Queries `EXACT_CANDIDATES` times `k` candidates from the index and re-ranks them by their geodesic
+        distance (see `WGS84.geodesic_distance`). Points where a city which wasn't fetched could be closer
+        than the k-th candidate (according to `_min_geodesic` of the last candidate) are queried again
+        with twice as many candidates, so the results are the true geodesic top-k.
+        Indices which can't return that many candidates (see `_max_k`) query the remaining points using
+        an index over all cities from `_build_like` instead, which is built on first use.
+        The returned distances are geodesic distances in meters.
+        """
+
+        query_arr = _check_input(query_arr, k, form, "radians")
+        num_cities = len(self.cities)
+        if k > num_cities:
+            raise ValueError(f"k must be <= {num_cities}, not {k}")
+
+        n = query_arr.shape[0]
+        out_coords = np.empty((n, k, 2), dtype=np.float32)
+        out_distances = np.empty((n, k), dtype=np.float64)
+        out_indices = np.empty((n, k), dtype=np.intp)
+
+        geo: ReverseGeocodeBase = self if k <= self._max_k() else self._exact_index()
+        pending = np.arange(n)
+        num = min(k * EXACT_CANDIDATES, geo._max_k())
+        while pending.size > 0:
+            points = query_arr[pending]
+            coords, distances, cities = geo._query_jobs(points, num, "radians", True, n_jobs, True)
+            with stage(self.stats, "geodesic", points.shape[0]):
+                geodesic = WGS84.geodesic_distance(points[:, None, :], coords)
+
+            order = np.argsort(geodesic, axis=1, kind="stable")[:, :k]
+            geodesic = np.take_along_axis(geodesic, order, axis=1)
+            done = geodesic[:, -1] <= geo._min_geodesic(distances[:, -1])
+            if num == num_cities:
+                done[:] = True
+
+            rows = pending[done]
+            out_coords[rows] = np.take_along_axis(coords, order[..., None], axis=1)[done]
+            out_distances[rows] = geodesic[done]
+            out_indices[rows] = np.take_along_axis(cities.indices, order, axis=1)[done]
+
+            pending = pending[~done]
+            if pending.size > 0 and num == geo._max_k():
+                geo = self._exact_index()
+            num = min(num * 2, geo._max_k())
+
+        cities = self.cities.take_rows(out_indices)
+        coords = out_coords if return_coords else None
+        if return_distance:
+            return coords, out_distances, cities
+        else:
+            return coords, cities
+
+    def _exact_index(self) -> "ReverseGeocodeBase":
+        """Returns an index over all cities which supports any `k`, used by `_query_exact`."""
+
+        if self._max_k() == len(self.cities):
+            return self
+        if self._full_index is None:
+            self._full_index = self._build_like(self._coords(np.arange(len(self.cities))), self.cities)
+        self._full_index.stats = self.stats
+        return self._full_index
+
+    def query_track(
+        self,
+        points: np.ndarray,
+        k: int = 1,
+        form: str = "radians",
+        return_distance: bool = True,
+        return_coords: bool = True,
+    ) -> QueryResult:
+        """Like `query` for the points of a track, like a GPS trace, where consecutive points are close to each
+        other and usually share their nearest cities. The results are the same as those of `query`.
+
+        At first only every `TRACK_STRIDE`-th point (an anchor) is queried using the index, for `TRACK_CANDIDATES`
+        times k cities. The other points compute their distances to the candidates of the preceding anchor only
+        (see `_track_distances`). By the triangle inequality, every other city is at least the distance of the last
+        candidate to the anchor minus the distance between the point and the anchor away. If the k-th nearest
+        candidate is closer than that, it's the result of the point. Otherwise the first point of every run of
+        such points becomes an anchor and the rest are checked again. If fewer than half of the points pass,
+        all remaining ones are queried using the index.
+        Indices which don't implement `_track_distances` use `query` instead.
+        """
+
+        if type(self)._track_distances is ReverseGeocodeBase._track_distances:
+            return self.query(points, k, form, return_distance, return_coords=return_coords)
+
+        with stage(self.stats, "query", points.shape[0]):
+            query_arr = _check_input(points, k, form, "radians")
+            max_k = self._max_k()
+            if k > max_k:
+                raise ValueError(f"k must be <= {max_k}, not {k}")
+
+            n = query_arr.shape[0]
+            m = min(k * TRACK_CANDIDATES, max_k)
+            all_candidates = m == len(self.cities)
+            vectors = self._points(query_arr)
+            out_distances = np.empty((n, k), dtype=np.float64)
+            out_indices = np.empty((n, k), dtype=np.intp)
+
+            anchors = np.arange(0, n, TRACK_STRIDE)
+            pending = np.flatnonzero(np.arange(n) % TRACK_STRIDE != 0)
+            known = np.empty(0, dtype=np.intp)  # all anchors, sorted
+            known_distances = np.empty((0, m), dtype=np.float64)
+            known_indices = np.empty((0, m), dtype=np.intp)
+            while anchors.size > 0:
+                _, distances, cities = self._query(query_arr[anchors], m, "radians", True, return_coords=False)
+                out_distances[anchors] = distances[:, :k]
+                out_indices[anchors] = cities.indices[:, :k]
+                if pending.size == 0:
+                    break
+
+                order = np.argsort(np.concatenate([known, anchors]), kind="stable")
+                known = np.concatenate([known, anchors])[order]
+                known_distances = np.concatenate([known_distances, distances])[order]
+                known_indices = np.concatenate([known_indices, cities.indices])[order]
+
+                rows = np.searchsorted(known, pending, side="right") - 1
+                candidates = known_indices[rows]
+                distances = self._track_distances(query_arr[pending], candidates)
+                if k == 1:  # much faster than sorting, ties resolve to the smallest index as well
+                    nearest = distances.min(axis=1, keepdims=True)
+                    indices = np.where(distances == nearest, candidates, len(self.cities)).min(axis=1, keepdims=True)
+                    distances = nearest
+                else:
+                    order = np.lexsort((candidates, distances), axis=1)[:, :k]
+                    distances = np.take_along_axis(distances, order, axis=1)
+                    indices = np.take_along_axis(candidates, order, axis=1)
+
+                offsets = self._from_chords(_euclidean(vectors[pending], vectors[known[rows]]))
+                bounds = known_distances[rows, -1]
+                valid = (distances[:, -1] + offsets + CHORD_MARGIN) * (1.0 + TRACK_SLACK) < bounds
+                if all_candidates:
+                    valid[:] = True
+                out_distances[pending[valid]] = distances[valid]
+                out_indices[pending[valid]] = indices[valid]
+
+                invalid = pending[~valid]
+                if 2 * invalid.size > pending.size:
+                    anchors, pending = invalid, invalid[:0]
+                else:
+                    starts = np.diff(invalid, prepend=-1) > 1
+                    anchors, pending = invalid[starts], invalid[~starts]
+
+            cities = self.cities.take(out_indices)
+            coords = self._coords(out_indices) if return_coords else None
+            if return_distance:
+                return coords, out_distances, cities
+            else:
+                return coords, cities
+
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        """Returns the distances between `query_arr` of shape (n, 2) in radians and the cities `indices`
+        of shape (n, m) rounded exactly like the index computes them, so that `query_track` can mix them
+        with the results of the index.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} doesn't support track queries")
+
+    def query_stream(
+        self,
+        points: Iterable[Any],
+        k: int = 2,
+        form: str = "radians",
+        return_distance: bool = True,
+        chunk_size: int = 65536,
+        n_jobs: int = 1,
+        prefetch_chunks: int = 1,
+    ) -> Iterator[QueryResult]:
+        """Queries an unbounded stream of points with constant memory usage.
+
+        points: iterable of single points (latitude, longitude) and/or arrays of points with shape (x, 2),
+            in any mix. They are converted to float32 and collected into chunks of `chunk_size` points.
+        prefetch_chunks: number of chunks which are read from `points` in a background thread
+            while the current chunk is queried. Use 0 to disable.
+
+        Yields the results of `query` for each chunk in order.
+        """
+
+        chunks = _rechunk(points, chunk_size)
+        if prefetch_chunks > 0:
+            chunks = prefetch(chunks, prefetch_chunks)
+
+        for chunk in chunks:
+            yield self.query(chunk, k, form, return_distance, n_jobs)
+
+    def query_radius(
+        self, query_arr: np.ndarray, radius: Union[float, np.ndarray], form: str = "radians"
+    ) -> RangeResult:
+        """Finds all cities within `radius` meters of each point of `query_arr`.
+        Distances are great-circle distances on a sphere with radius `self.radius`, for all backends.
+
+        query_arr: float32 array of shape (n, 2) with latitude and longitude
+        radius: radius in meters, or array of shape (n,) with one radius per point
+        form: "radians" or "degrees"
+        """
+
+        query_arr = _check_input(query_arr, 1, form, "radians")
+        angles = np.broadcast_to(np.asarray(radius, dtype=np.float64) / self.radius, query_arr.shape[:1])
+        if not np.all(angles >= 0):
+            raise ValueError("radius must be >= 0")
+
+        # backends return candidates using a slightly larger radius, which are filtered exactly here
+        offsets, indices = self._query_radius(query_arr, angles * (1.0 + 1e-9))
+        return self._range_result(
+            query_arr, offsets, indices, lambda rows, coords, distances: distances <= angles[rows]
+        )
+
+    def query_bbox(self, boxes: np.ndarray, form: str = "radians") -> RangeResult:
+        """Finds all cities within the bounding boxes.
+
+        boxes: float32 array of shape (n, 4) with (min_lat, min_lon, max_lat, max_lon).
+            Boxes with min_lon > max_lon cross the antimeridian.
+        form: "radians" or "degrees"
+
+        The results are sorted by their great-circle distance in meters to the center of the box.
+        """
+
+        boxes = _check_boxes(boxes, form).astype(np.float64)
+        min_lat, min_lon, max_lat, max_lon = boxes.T
+        width = max_lon - min_lon
+        width[width < 0] += 2 * np.pi
+
+        centers = np.stack([(min_lat + max_lat) * 0.5, min_lon + width * 0.5], axis=-1)
+        # for boxes less than half way around the earth, the corners are the points farthest from the center
+        angles = np.maximum(
+            haversine(centers, np.stack([min_lat, min_lon], axis=-1)),
+            haversine(centers, np.stack([max_lat, min_lon], axis=-1)),
+        )
+        angles[width > np.pi] = np.pi
+
+        def in_box(rows: np.ndarray, coords: np.ndarray, distances: np.ndarray) -> np.ndarray:
+            lat = coords[:, 0].astype(np.float64)
+            lon = coords[:, 1].astype(np.float64)
+            return (
+                (min_lat[rows] <= lat)
+                & (lat <= max_lat[rows])
+                & (np.mod(lon - min_lon[rows], 2 * np.pi) <= width[rows])
+            )
+
+        offsets, indices = self._query_radius(centers, angles * (1.0 + 1e-9) + 1e-9)
+        return self._range_result(centers, offsets, indices, in_box)
+
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns offsets and indices (see `RangeResult`) of at least all cities within the great-circle
+        angles `angles` (in radians) of `query_arr` (in radians). Additional cities are filtered out later.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} doesn't support range queries")
+
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        """Returns the coordinates (latitude, longitude) in radians of the cities at `indices`.
+        They are gathered from the source coordinates, so the ECEF backends don't need to convert them back.
+        """
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
         raise NotImplementedError
 
+    def _range_result(
+        self,
+        query_arr: np.ndarray,
+        offsets: np.ndarray,
+        indices: np.ndarray,
+        keep: Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray],
+    ) -> RangeResult:
+        """Filters the candidates using `keep(rows, coords, distances)` and sorts them by distance."""
+
+        rows = np.repeat(np.arange(query_arr.shape[0]), np.diff(offsets))
+        coords = self._coords(indices)
+        distances = haversine(query_arr[rows], coords)
+
+        mask = keep(rows, coords, distances)
+        rows, indices, coords, distances = rows[mask], indices[mask], coords[mask], distances[mask]
+        order = np.lexsort((indices, distances, rows))
+        offsets = np.zeros(query_arr.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=query_arr.shape[0]), out=offsets[1:])
+        indices = indices[order]
+
+        return RangeResult(
+            offsets, indices, distances[order] * self.radius, coords[order], _select_cities(self.cities, indices)
+        )
+
+    def _query_parallel(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, n_jobs: int, return_coords: bool
+    ) -> QueryResult:
+        """Splits the batch into chunks and queries them on a thread pool.
+        The tree queries and distance computations release the GIL.
+        """
+
+        with ThreadPoolExecutor(n_jobs) as executor:
+            results = list(
+                executor.map(
+                    lambda sl: self._query(query_arr[sl], k, form, return_distance, return_coords),
+                    _split_batch(query_arr.shape[0], n_jobs),
+                )
+            )
+
+        return _merge_results(self.cities, results, return_distance)
+
 
 class ReverseGeocodeKdScipy(ReverseGeocodeBase):
-    def __init__(self, path: Optional[str] = None) -> None:
-        from scipy.spatial import KDTree
+    library = "scipy"
 
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
 
-        arr, self.cities = get_data(path)
-        arr = WGS84.geodetic2ecef(arr)
+    def _build(self, data: Dataset) -> None:
+        from scipy.spatial import KDTree
+
+        arr, self.cities = data.ecef, data.info
+        self.coords = data.coords  # geodetic coordinates of the results
         assert arr.dtype == np.float32
         self.tree = KDTree(arr)
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
-
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, items = _dump_state("tree", self.tree.__getstate__())
+        arrays["coords"] = self.coords
+        return arrays, {"tree": items}
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "ecef")
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from scipy.spatial import KDTree
 
-        distances, indices = self.tree.query(query_arr, k)
+        self.coords = arrays["coords"]
+        self.tree = KDTree.__new__(KDTree)
+        self.tree.__setstate__(_load_state(arrays, meta["tree"]))
+
+    def _query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: bool,
+        return_coords: bool = True,
+        workers: int = 1,
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "ecef")
+
+        with stage(self.stats, "index", n):
+            distances, indices = self.tree.query(query_arr, k, workers=workers)
         if k == 1:
             distances = distances[..., None]
             indices = indices[..., None]
-        cities = _select_cities(self.cities, indices)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
 
-        coords = self.tree.data[indices].astype(np.float32)
-        coords = WGS84.ecef2geodetic(coords)
-        coords = coords[..., :2]  # ignore altitude
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _query_parallel(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, n_jobs: int, return_coords: bool
+    ) -> QueryResult:
+        return self._query(query_arr, k, form, return_distance, return_coords, workers=n_jobs)
 
-class ReverseGeocodeVpTreePython(ReverseGeocodeBase):
-    """https://github.com/RickardSjogren/vptree"""
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        ecef = WGS84.geodetic2ecef(query_arr.astype(np.float64))
+        return ragged_to_csr(self.tree.query_ball_point(ecef, _chord_bound(angles), return_sorted=False))
 
-    @staticmethod
-    def _euclidean(p1, p2):
-        diff = p2[1] - p1[1]
-        return np.sqrt(np.sum(diff * diff, axis=-1))
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        ecef = WGS84.geodetic2ecef(query_arr)
+        return _euclidean(ecef[:, None, :], self.tree.data[indices])
 
-    def __init__(self, path: Optional[str] = None) -> None:
-        from vptree import VPTree
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
 
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
 
-        arr, self.cities = get_data(path)
-        arr = WGS84.geodetic2ecef(arr)
-        assert arr.dtype == np.float32
-        arr_with_index = [(i, v) for i, v in zip(range(len(arr)), arr)]
-        try:
-            self.tree = VPTree(arr_with_index, self._euclidean)
-        except ValueError as e:
-            if str(e).startswith("setting an array element with a sequence"):
-                raise ImportError("vptree version is too old. currently git master branch is required")
+class ReverseGeocodeVpTreePython(ReverseGeocodeBase):
+    """Vantage-point tree implemented using numpy, see `houtu.vptree.VpTree`.
+    It has no dependencies and traverses the tree for many points at once.
+    """
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    def _build(self, data: Dataset) -> None:
+        from .vptree import VpTree
+
+        self.coords, self.cities = data.coords, data.info
+        self.tree = VpTree.build(data.ecef)
+
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, meta = self.tree.get_state()
+        return {"coords": self.coords, **{f"tree.{name}": arr for name, arr in arrays.items()}}, {"tree": meta}
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "ecef")
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": self.coords.nbytes, "index": self.tree.nbytes}
 
-        indices = []
-        coords = []
-        distances = []
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from .vptree import VpTree
 
-        for query in query_arr:
-            query = (0, query)
-            neighbors = self.tree.get_n_nearest_neighbors(query, k)
-            _distances, pairs = zip(*neighbors)
-            _indices, _coords = zip(*pairs)
-            indices.append(_indices)
-            coords.append(_coords)
-            distances.append(_distances)
+        prefix = "tree."
+        self.coords = arrays["coords"]
+        self.tree = VpTree.from_state(
+            {name[len(prefix) :]: arr for name, arr in arrays.items() if name.startswith(prefix)}, meta["tree"]
+        )
 
-        indices = np.array(indices, dtype=np.int64)
-        coords = np.array(coords, dtype=np.float32)
-        distances = np.array(distances, dtype=np.float32)
-        cities = _select_cities(self.cities, indices)
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "ecef")
 
-        coords = WGS84.ecef2geodetic(coords)
-        coords = coords[..., :2]  # ignore altitude
+        with stage(self.stats, "index", n):
+            distances, indices = self.tree.query(query_arr, k)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
+
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
+
 
 class ReverseGeocodeVpTreeSimd(ReverseGeocodeBase):
     """https://github.com/pablocael/pynear"""
 
-    def __init__(self, path: Optional[str] = None) -> None:
-        from pynear import VPTreeL2Index
+    library = "pynear"
 
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
 
-        arr, self.cities = get_data(path)
-        self.arr = WGS84.geodetic2ecef(arr)
+    def _build(self, data: Dataset) -> None:
+        from pynear import VPTreeL2Index
+
+        arr, self.cities = data.ecef, data.info
+        self.coords = data.coords
         assert arr.dtype == np.float32
         self.tree = VPTreeL2Index()
-        self.tree.set(self.arr)
+        self.tree.set(arr)
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, items = _dump_state("tree", self.tree.__getstate__())
+        arrays["coords"] = self.coords
+        return arrays, {"tree": items}
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from pynear import VPTreeL2Index
+
+        self.coords = arrays["coords"]
+        self.tree = VPTreeL2Index.__new__(VPTreeL2Index)
+        self.tree.__setstate__(_load_state(arrays, meta["tree"]))  # pynear always copies the tree
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "ecef")
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "ecef")
 
-        indices, distances = self.tree.searchKNN(query_arr, k)
+        with stage(self.stats, "index", n):
+            indices, distances = self.tree.searchKNN(query_arr, k)
         indices = np.array(indices, dtype=np.int64)[:, ::-1]
         distances = np.array(distances, dtype=np.float32)[:, ::-1]
-        cities = _select_cities(self.cities, indices)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
 
-        coords = self.arr[indices]
-        coords = WGS84.ecef2geodetic(coords)
-        coords = coords[..., :2]  # ignore altitude
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
+
 
 class ReverseGeocodeKdLearn(ReverseGeocodeBase):
-    def __init__(self, path: Optional[str] = None) -> None:
-        from sklearn.neighbors import KDTree
+    library = "scikit-learn"
 
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
 
-        arr, self.cities = get_data(path)
-        arr = WGS84.geodetic2ecef(arr)
+    def _build(self, data: Dataset) -> None:
+        from sklearn.neighbors import KDTree
+
+        arr, self.cities = data.ecef, data.info
+        self.coords = data.coords  # geodetic coordinates of the results
         assert arr.dtype == np.float32
         self.tree = KDTree(arr)  # copy is made here since input is float32 and float64 is needed
         # assert self.tree.data.base is arr
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, items = _dump_state("tree", self.tree.__getstate__())
+        arrays["coords"] = self.coords
+        return arrays, {"tree": items}
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": self.coords.nbytes, "index": sum(arr.nbytes for arr in self.tree.get_arrays())}
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "ecef")
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from sklearn.neighbors import KDTree
 
-        if return_distance:
-            distances, indices = self.tree.query(query_arr, k, return_distance)
-        else:
-            indices = self.tree.query(query_arr, k, return_distance)
+        self.coords = arrays["coords"]
+        self.tree = KDTree.__new__(KDTree)
+        self.tree.__setstate__(_load_state(arrays, meta["tree"]))
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "ecef")
 
-        cities = _select_cities(self.cities, indices)
+        with stage(self.stats, "index", n):
+            if return_distance:
+                distances, indices = self.tree.query(query_arr, k, return_distance)
+            else:
+                indices = self.tree.query(query_arr, k, return_distance)
 
-        coords = np.asarray(self.tree.data)
-        assert self.tree.data.base is coords.base.obj.base, "array was copied"
-        coords = coords[indices].astype(np.float32)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
 
-        coords = WGS84.ecef2geodetic(coords)
-        coords = coords[..., :2]  # ignore altitude
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        ecef = WGS84.geodetic2ecef(query_arr.astype(np.float64))
+        return ragged_to_csr(self.tree.query_radius(ecef, _chord_bound(angles)))
+
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        ecef = WGS84.geodetic2ecef(query_arr)
+        return _euclidean(ecef[:, None, :], np.asarray(self.tree.data)[indices])
+
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
+
 
 class ReverseGeocodeBruteEuclidic(ReverseGeocodeBase):
-    def __init__(self, path: Optional[str] = None) -> None:
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
+    """Exact brute force search with memory usage bounded by the block sizes, see `houtu.brute.BlockedKnn`."""
 
-        arr, self.cities = get_data(path)
-        self.arr = WGS84.geodetic2ecef(arr)
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+    def _build(self, data: Dataset) -> None:
+        from .brute import EuclideanKnn
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+        arr, self.cities = data.ecef, data.info
+        self.arr = arr
+        self.coords = data.coords  # geodetic coordinates of the results
+        self.knn = EuclideanKnn(self.arr)
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "ecef")
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        return {"arr": self.arr, "coords": self.coords}, {}
 
-        distances = euclidean_distances(query_arr, self.arr, squared=True)
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": self.arr.nbytes + self.coords.nbytes, "index": self.knn.nbytes}
 
-        indices = np.argpartition(distances, range(k), axis=-1)[:, :k]
-        cities = _select_cities(self.cities, indices)
-        if return_distance:
-            distances = np.take_along_axis(distances, indices, axis=-1)
-            distances = np.sqrt(distances)  # distance matrix is squared
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from .brute import EuclideanKnn
+
+        self.arr = arrays["arr"]
+        self.coords = arrays["coords"]
+        self.knn = EuclideanKnn(self.arr)
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "ecef")
+
+        with stage(self.stats, "index", n):
+            distances, indices = self.knn.query(query_arr, k)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
 
-        coords = self.arr[indices]
-        coords = WGS84.ecef2geodetic(coords)
-        coords = coords[..., :2]  # ignore altitude
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        ecef = WGS84.geodetic2ecef(query_arr.astype(np.float64))
+        offsets, indices, _ = self.knn.query_radius(ecef, _chord_bound(angles))
+        return offsets, indices
 
-class ReverseGeocodeBruteHaversine(ReverseGeocodeBase):
-    radius = earth_radii["Spherical Earth Approx. of Radius (RE)"]  # see opt_geocoding.py
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        return self.knn._distances(WGS84.geodetic2ecef(query_arr)[:, None, :], self.arr[indices])
 
-    def __init__(self, path: Optional[str] = None) -> None:
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
 
-        self.arr, self.cities = get_data(path)
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+class ReverseGeocodeHaversineBase(ReverseGeocodeBase):
+    """Base class of the indices which rank cities by their great-circle distance on a sphere with `radius`."""
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    metric = "haversine"
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "radians")
+    def _min_geodesic(self, distances: np.ndarray) -> np.ndarray:
+        # the ellipsoid's radius of curvature is at least b^2 / a
+        return distances / self.radius * (WGS84.B**2 / WGS84.A)
+
+    def _points(self, coords: np.ndarray) -> np.ndarray:
+        return unit_vectors(coords)
+
+    def _from_chords(self, chords: np.ndarray) -> np.ndarray:
+        return 2.0 * np.arcsin(np.minimum(chords * 0.5, 1.0)) * self.radius
+
+
+class ReverseGeocodeBruteHaversine(ReverseGeocodeHaversineBase):
+    """Exact brute force search with memory usage bounded by the block sizes, see `houtu.brute.BlockedKnn`."""
+
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
+
+    def _build(self, data: Dataset) -> None:
+        from .brute import HaversineKnn
+
+        self.arr, self.cities = data.coords, data.info
+        self.knn = HaversineKnn(self.arr)
 
-        distances = haversine_distances(query_arr, self.arr)
-        indices = np.argpartition(distances, range(k), axis=-1)[:, :k]
-        cities = _select_cities(self.cities, indices)
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        return {"arr": self.arr}, {}
+
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": self.arr.nbytes, "index": self.knn.nbytes}
+
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from .brute import HaversineKnn
+
+        self.arr = arrays["arr"]
+        self.knn = HaversineKnn(self.arr)
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "radians")
+
+        with stage(self.stats, "index", n):
+            distances, indices = self.knn.query(query_arr, k)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
         if return_distance:
-            distances = np.take_along_axis(distances, indices, axis=-1)
             distances *= self.radius
 
-        coords = self.arr[indices]
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        offsets, indices, _ = self.knn.query_radius(query_arr, angles)
+        return offsets, indices
 
-class ReverseGeocodeBallHaversine(ReverseGeocodeBase):
-    radius = earth_radii["Spherical Earth Approx. of Radius (RE)"]  # see opt_geocoding.py
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        return self.knn._distances(query_arr[:, None, :], self.arr[indices]) * self.radius
 
-    def __init__(self, path: Optional[str] = None) -> None:
-        from sklearn.neighbors import BallTree
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.arr[indices]
 
-        if path is None:
-            path = files(__package__).joinpath("data/cities1000.txt.xz")
 
-        arr, self.cities = get_data(path)
+class ReverseGeocodeBallHaversine(ReverseGeocodeHaversineBase):
+    library = "scikit-learn"
+
+    def __init__(self, path: Optional[PathType] = None, cache: bool = True) -> None:
+        self._build(load_data(path, cache=cache))
+
+    def _build(self, data: Dataset) -> None:
+        from sklearn.neighbors import BallTree
+
+        arr, self.cities = data.coords, data.info
         self.bt = BallTree(arr, metric="haversine")
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[True]
-    ) -> Tuple[np.ndarray, np.ndarray, List[List[City]]]: ...
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, items = _dump_state("tree", self.bt.__getstate__())
+        return arrays, {"tree": items}
 
-    @overload
-    def query(
-        self, query_arr: np.ndarray, k: int, form: str, return_distance: Literal[False]
-    ) -> Tuple[np.ndarray, List[List[City]]]: ...
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": 0, "index": sum(arr.nbytes for arr in self.bt.get_arrays())}
 
-    def query(self, query_arr, k=2, form="radians", return_distance=True):
-        query_arr = _check_input(query_arr, k, form, "radians")
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from sklearn.neighbors import BallTree
 
-        if return_distance:
-            distances, indices = self.bt.query(query_arr, k, return_distance)
-        else:
-            indices = self.bt.query(query_arr, k, return_distance)
-        cities = _select_cities(self.cities, indices)
+        self.bt = BallTree.__new__(BallTree)
+        self.bt.__setstate__(_load_state(arrays, meta["tree"]))
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "radians")
+
+        with stage(self.stats, "index", n):
+            if return_distance:
+                distances, indices = self.bt.query(query_arr, k, return_distance)
+            else:
+                indices = self.bt.query(query_arr, k, return_distance)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
 
         if return_distance:
             distances *= self.radius
 
-        coords = np.asarray(self.bt.data)
-        assert self.bt.data.base is coords.base.obj.base, "array was copied"
-        coords = coords[indices]
+        coords = self._coords(indices) if return_coords else None
 
         if return_distance:
             return coords, distances, cities
         else:
             return coords, cities
 
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return ragged_to_csr(self.bt.query_radius(query_arr, angles))
+
+    def _track_distances(self, query_arr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        return haversine(query_arr[:, None, :], self._coords(indices)) * self.radius
+
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        coords = np.asarray(self.bt.data)
+        assert self.bt.data.base is coords.base.obj.base, "array was copied"  # type: ignore[union-attr]
+        return coords[indices]
+
     def lat_lon(self, lat: float, lon: float, form: str) -> Tuple[List[float], float, City]:
         query_arr = np.array([[lat, lon]], dtype=np.float32)
         coords, distances, cities = self.query(query_arr, 1, form, True)
         return coords[0, 0].tolist(), distances[0, 0], cities[0][0]
 
 
+class ReverseGeocodeGrid(ReverseGeocodeHaversineBase):
+    """Precomputed lookup table of the nearest cities, see `houtu.grid.SphereGrid`.
+    Queries compute the cell of each point and the haversine distances to the few candidates of that cell.
+    The results are the same as those of `ReverseGeocodeBallHaversine`.
+
+    max_k: largest `k` which can be queried. Larger values increase the number of candidates per cell.
+    lat_cells: number of latitude bands of the initial grid
+    leaf_size: cells with more candidates are split. Smaller values use more memory for faster queries.
+    """
+
+    def __init__(
+        self,
+        path: Optional[PathType] = None,
+        cache: bool = True,
+        max_k: int = 1,
+        lat_cells: int = 64,
+        leaf_size: int = 16,
+    ) -> None:
+        self._build(load_data(path, cache=cache), max_k, lat_cells, leaf_size)
+
+    def _build(self, data: Dataset, max_k: int = 1, lat_cells: int = 64, leaf_size: int = 16) -> None:
+        from .grid import SphereGrid
+
+        self.arr, self.cities = data.coords, data.info
+        self.grid = SphereGrid.build(self.arr, max_k, lat_cells, leaf_size)
+
+    def _build_like(self, coords: np.ndarray, cities: CityTable) -> ReverseGeocodeBase:
+        # cells far away from clustered subsets (like a single country) would store all of its cities
+        # and `max_k` limits the number of neighbours. the ball tree uses the same distances,
+        # so the results are the same.
+        obj = ReverseGeocodeBallHaversine.__new__(ReverseGeocodeBallHaversine)
+        obj._build(Dataset(coords, WGS84.geodetic2ecef(coords), cities))
+        return obj
+
+    def _get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, meta = self.grid.get_state()
+        return {"arr": self.arr, **{f"grid.{name}": arr for name, arr in arrays.items()}}, {"grid": meta}
+
+    def _nbytes(self) -> Dict[str, int]:
+        return {"coords": self.arr.nbytes, "index": self.grid.nbytes}
+
+    def _set_state(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        from .grid import SphereGrid
+
+        prefix = "grid."
+        self.arr = arrays["arr"]
+        self.grid = SphereGrid.from_state(
+            {name[len(prefix) :]: arr for name, arr in arrays.items() if name.startswith(prefix)}, meta["grid"]
+        )
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        n = query_arr.shape[0]
+        with stage(self.stats, "convert", n):
+            query_arr = _check_input(query_arr, k, form, "radians")
+
+        with stage(self.stats, "index", n):
+            distances, indices = self.grid.query(self.arr, query_arr, k)
+        with stage(self.stats, "cities", n):
+            cities = _select_cities(self.cities, indices)
+        coords = self._coords(indices) if return_coords else None
+
+        if return_distance:
+            return coords, distances * self.radius, cities
+        else:
+            return coords, cities
+
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.arr[indices]
+
+    def _max_k(self) -> int:
+        return min(self.grid.max_k, len(self.cities))
+
+
 ReverseGeocode = ReverseGeocodeBallHaversine
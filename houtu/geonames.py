@@ -0,0 +1,202 @@
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from .cities import ELEVATION_MISSING, STRING_COLUMNS, code_dtype, pack_strings
+from .storage import PathType
+from .utils import prefetch, ragged_positions
+
+NUM_FIELDS = 19  # columns of the GeoNames dump format
+BLOCK_SIZE = 2**24  # bytes of decompressed text which are parsed at once
+
+# column of the GeoNames file of each `City` field
+NAME_COLUMN = 1
+LAT_COLUMN = 4
+LON_COLUMN = 5
+STRING_FIELDS = dict(zip(STRING_COLUMNS, (6, 7, 8, 10, 11, 12, 13, 17)))
+POPULATION_COLUMN = 14
+ELEVATION_COLUMN = 15
+FIXED_WIDTH_COLUMNS = [LAT_COLUMN, LON_COLUMN, POPULATION_COLUMN, ELEVATION_COLUMN, *STRING_FIELDS.values()]
+
+
+def read_blocks(path: PathType, block_size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    """Decompresses the xz file `path` and yields blocks of complete lines. The blocks are validated as utf-8."""
+
+    import lzma
+
+    with lzma.open(path, "rb") as fr:
+        rest = b""
+        while True:
+            chunk = fr.read(block_size)
+            if not chunk:
+                break
+            data = rest + chunk
+            end = data.rfind(b"\n") + 1
+            block, rest = data[:end], data[end:]
+            if block:
+                block.decode("utf-8")
+                yield block
+        if rest:
+            rest.decode("utf-8")
+            yield rest + b"\n"
+
+
+def _fixed_width(buf: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Returns the byte ranges `starts` to `ends` of `buf` as a bytes array padded to the longest one.
+    `buf` must extend at least that many bytes past the last range.
+    """
+
+    lengths = ends - starts
+    width = max(int(lengths.max(initial=0)), 1)
+    chars = np.lib.stride_tricks.sliding_window_view(buf, width)[starts]
+    chars *= np.arange(width) < lengths[:, None]
+    return chars.view(f"S{width}").ravel()
+
+
+def _ragged(buf: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the concatenated byte ranges `starts` to `ends` of `buf` and their offsets."""
+
+    lengths = ends - starts
+    offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return buf[ragged_positions(starts, lengths)], offsets
+
+
+def parse_block(block: bytes, first_line: int = 1) -> Dict[str, np.ndarray]:
+    """Parses a block of complete GeoNames lines into columns. Latitude and longitude are returned
+    in degrees as float64 (like `float()`) and the string columns as (padded) bytes arrays.
+    """
+
+    buf = np.frombuffer(block, dtype=np.uint8)
+    separators = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+    fields = np.diff(np.flatnonzero(buf[separators] == ord("\n")), prepend=-1)
+    if np.any(fields != NUM_FIELDS):
+        line = int(np.argmax(fields != NUM_FIELDS))
+        raise ValueError(f"Line {first_line + line} has {fields[line]} fields instead of {NUM_FIELDS}")
+
+    ends = separators.reshape(-1, NUM_FIELDS)
+    starts = np.empty_like(ends)
+    starts[:, 1:] = ends[:, :-1] + 1
+    starts[:1, 0] = 0
+    starts[1:, 0] = ends[:-1, -1] + 1
+
+    # the padding allows reading every field with the width of the longest one without bounds checks
+    width = int((ends - starts)[:, FIXED_WIDTH_COLUMNS].max(initial=0))
+    padded = np.concatenate([buf, np.zeros(max(width, 1), dtype=np.uint8)])
+
+    def field(col: int) -> np.ndarray:
+        return _fixed_width(padded, starts[:, col], ends[:, col])
+
+    out = {
+        "lat": field(LAT_COLUMN).astype(np.float64),
+        "lon": field(LON_COLUMN).astype(np.float64),
+        "population": field(POPULATION_COLUMN).astype(np.int64),
+    }
+
+    elevation = field(ELEVATION_COLUMN)
+    missing = ends[:, ELEVATION_COLUMN] == starts[:, ELEVATION_COLUMN]
+    elevation[missing] = b"0"
+    elevation = elevation.astype(np.int64)
+    elevation[missing] = ELEVATION_MISSING
+    out["elevation"] = elevation.astype(np.int32)
+
+    out["name.data"], out["name.offsets"] = _ragged(buf, starts[:, NAME_COLUMN], ends[:, NAME_COLUMN])
+    for name, col in STRING_FIELDS.items():
+        out[name] = field(col)
+
+    return out
+
+
+def _select_ragged(data: np.ndarray, offsets: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Like `_ragged` for the sorted `rows` of ragged `data`, using a byte mask instead of indices."""
+
+    lengths = np.diff(offsets)
+    mask = np.zeros(lengths.size, dtype=np.bool_)
+    mask[rows] = True
+    selected = np.zeros(rows.size + 1, dtype=np.int64)
+    np.cumsum(lengths[rows], out=selected[1:])
+    return data[np.repeat(mask, lengths)], selected
+
+
+def _encode(values: np.ndarray, vocab: Dict[bytes, int]) -> np.ndarray:
+    """Returns the codes of the bytes array `values` into `vocab`, which is extended by the new values."""
+
+    uniques, inverse = np.unique(values, return_inverse=True)
+    remap = np.array([vocab.setdefault(value, len(vocab)) for value in uniques.tolist()], dtype=np.int32)
+    return remap[inverse.ravel()]
+
+
+def _dict_encode(codes: np.ndarray, vocab: List[bytes]) -> Tuple[np.ndarray, List[str]]:
+    """Like `houtu.cities.dict_encode` for `codes` into the list of bytes `vocab`. The unused values are dropped
+    and the remaining ones are ordered by first appearance.
+    """
+
+    used, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(order.size)
+    values = [vocab[code].decode("utf-8") for code in used[order].tolist()]
+    return ranks[inverse.ravel()].astype(code_dtype(len(values))), values
+
+
+def read_geonames(path: PathType, keep_dups: bool = False) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Reads a xz compressed GeoNames file and returns the (latitude, longitude) coordinates in degrees as float64
+    and the arrays of a `houtu.cities.CityTable`.
+
+    The file is decompressed in a background thread while the previous block is parsed.
+    The string columns of each block are dictionary-encoded right away and the columns are merged one at a time,
+    so about 60 bytes per line plus the names are kept in memory and the peak is less than twice that.
+    When `keep_dups` is False, cities with the same coordinates as a previous one are skipped.
+    """
+
+    parts: Dict[str, List[np.ndarray]] = {"name.offsets": [np.zeros(1, dtype=np.int64)]}
+    vocabs: Dict[str, Dict[bytes, int]] = {col: {} for col in STRING_COLUMNS}
+    num_rows = 0
+    num_bytes = 0
+
+    def add(columns: Dict[str, np.ndarray]) -> None:
+        nonlocal num_rows, num_bytes
+        for col in STRING_COLUMNS:
+            columns[col] = _encode(columns[col], vocabs[col])
+        columns["name.offsets"] = columns["name.offsets"][1:] + num_bytes
+        num_rows += columns["lat"].size
+        num_bytes += columns["name.data"].size
+        for name, arr in columns.items():
+            parts.setdefault(name, []).append(arr)
+
+    for block in prefetch(read_blocks(path)):
+        add(parse_block(block, num_rows + 1))
+    if num_rows == 0:
+        add(parse_block(b""))
+
+    def merge(name: str) -> np.ndarray:
+        return np.concatenate(parts.pop(name))
+
+    lat, lon = merge("lat"), merge("lon")
+    if keep_dups:
+        rows = np.arange(num_rows)
+    else:
+        # complex numbers compare like (lat, lon) tuples, so -0.0 equals 0.0 like in a set
+        _, rows = np.unique(lat + 1j * lon, return_index=True)
+        rows.sort()
+    coords = np.empty((rows.size, 2), dtype=np.float64)
+    coords[:, 0] = lat[rows]
+    coords[:, 1] = lon[rows]
+    del lat, lon
+
+    arrays = {}
+    name_data, name_offsets = merge("name.data"), merge("name.offsets")
+    if keep_dups:
+        arrays["name.data"], arrays["name.offsets"] = name_data, name_offsets
+    else:
+        arrays["name.data"], arrays["name.offsets"] = _select_ragged(name_data, name_offsets, rows)
+    del name_data, name_offsets
+
+    for col in STRING_COLUMNS:
+        vocab = list(vocabs.pop(col))
+        arrays[f"{col}.codes"], values = _dict_encode(merge(col)[rows], vocab)
+        arrays[f"{col}.vocab.data"], arrays[f"{col}.vocab.offsets"] = pack_strings(values)
+    arrays["population"] = merge("population")[rows]
+    arrays["elevation"] = merge("elevation")[rows]
+
+    return coords, arrays
@@ -0,0 +1,232 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .utils import haversine, ragged_positions, ragged_to_csr, unit_vectors
+
+SLACK = 1e-9  # radians, covers rounding errors in the cell geometry and the assignment of points to cells
+
+
+def _cell_geometry(z0: np.ndarray, z1: np.ndarray, lon0: np.ndarray, lon1: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the centers of cells and the largest angle between the center and any point in the cell.
+    For cells less than half way around the earth, the corners are the points farthest from the center.
+    """
+
+    lat0 = np.arcsin(z0)
+    lat1 = np.arcsin(z1)
+    centers = np.stack([(lat0 + lat1) * 0.5, (lon0 + lon1) * 0.5], axis=-1)
+    radii = np.maximum(
+        haversine(centers, np.stack([lat0, lon0], axis=-1)), haversine(centers, np.stack([lat1, lon0], axis=-1))
+    )
+    return centers, radii
+
+
+class SphereGrid:
+    """Lookup table of the candidates for the `max_k` nearest points of every location on the sphere.
+
+    The sphere is divided into `lat_cells` bands of equal height in `sin(latitude)` and `2 * lat_cells` columns
+    of equal width in longitude, so all cells have the same area. Cells with more than `leaf_size` candidates are
+    recursively split into four cells of equal area, up to `max_depth` times.
+    A point `p` is a candidate for a cell with center `c` and radius `r` if `d(p, c) <= d_k(c) + 2r`,
+    where `d_k(c)` is the distance from `c` to its k-th nearest point. This includes the k nearest points
+    of all locations in the cell.
+
+    The candidates of a split cell are a superset of the candidates of its children, so only the initial grid
+    is queried using a ball tree. Splitting uses chord lengths of unit vectors which are cheaper than haversine.
+    """
+
+    def __init__(
+        self,
+        lat_cells: int,
+        max_k: int,
+        children: np.ndarray,
+        offsets: np.ndarray,
+        candidates: np.ndarray,
+    ) -> None:
+        self.lat_cells = lat_cells
+        self.lon_cells = 2 * lat_cells
+        self.max_k = max_k
+        self.children = children  # index of the first of the four children of each cell, or -1 for leaves
+        self.offsets = offsets  # candidates of cell `i` are `candidates[offsets[i] : offsets[i + 1]]`
+        self.candidates = candidates
+
+    @classmethod
+    def build(
+        cls, coords: np.ndarray, max_k: int = 1, lat_cells: int = 64, leaf_size: int = 16, max_depth: int = 12
+    ) -> "SphereGrid":
+        """Builds the grid for `coords` (latitude, longitude) in radians."""
+
+        from sklearn.neighbors import BallTree
+
+        n = coords.shape[0]
+        if not 1 <= max_k <= n:
+            raise ValueError(f"max_k must be in [1, {n}], not {max_k}")
+
+        coords = coords.astype(np.float64)
+        unit = unit_vectors(coords)
+
+        lon_cells = 2 * lat_cells
+        iz, ilon = np.divmod(np.arange(lat_cells * lon_cells), lon_cells)
+        z0 = -1.0 + 2.0 * iz / lat_cells
+        z1 = -1.0 + 2.0 * (iz + 1) / lat_cells
+        lon0 = -np.pi + 2.0 * np.pi * ilon / lon_cells
+        lon1 = -np.pi + 2.0 * np.pi * (ilon + 1) / lon_cells
+
+        centers, radii = _cell_geometry(z0, z1, lon0, lon1)
+        tree = BallTree(coords, metric="haversine")
+        distances, _ = tree.query(centers, max_k)
+        rows = tree.query_radius(centers, (distances[:, -1] + 2 * radii) * (1.0 + SLACK) + SLACK)
+        offsets, candidates = ragged_to_csr(rows)
+        candidates = candidates.astype(np.int64, copy=False)
+
+        num_cells = lat_cells * lon_cells
+        cells = np.arange(num_cells)
+        children = [np.full(num_cells, -1, dtype=np.int64)]
+        levels: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []  # cells, counts and candidates of leaves
+
+        for depth in range(max_depth + 1):
+            counts = np.diff(offsets)
+            split = counts > leaf_size if depth < max_depth else np.zeros(counts.shape, dtype=np.bool_)
+            leaves = np.flatnonzero(~split)
+            levels.append(
+                (cells[leaves], counts[leaves], candidates[ragged_positions(offsets[leaves], counts[leaves])])
+            )
+
+            parents = np.flatnonzero(split)
+            if parents.size == 0:
+                break
+
+            first_child = num_cells + 4 * np.arange(parents.size)
+            all_children = np.concatenate(children)
+            all_children[cells[parents]] = first_child
+            children = [all_children, np.full(4 * parents.size, -1, dtype=np.int64)]
+            cells = num_cells + np.arange(4 * parents.size)
+            num_cells += 4 * parents.size
+
+            # children in the order (low z, low lon), (low z, high lon), (high z, low lon), (high z, high lon)
+            zm = (z0[parents] + z1[parents]) * 0.5
+            lonm = (lon0[parents] + lon1[parents]) * 0.5
+            z0, z1 = (
+                np.stack([z0[parents], z0[parents], zm, zm], axis=1).ravel(),
+                np.stack([zm, zm, z1[parents], z1[parents]], axis=1).ravel(),
+            )
+            lon0, lon1 = (
+                np.stack([lon0[parents], lonm, lon0[parents], lonm], axis=1).ravel(),
+                np.stack([lonm, lon1[parents], lonm, lon1[parents]], axis=1).ravel(),
+            )
+
+            parent_counts = np.repeat(counts[parents], 4)
+            candidates = candidates[ragged_positions(np.repeat(offsets[parents], 4), parent_counts)]
+            offsets = np.zeros(parent_counts.size + 1, dtype=np.int64)
+            np.cumsum(parent_counts, out=offsets[1:])
+
+            centers, radii = _cell_geometry(z0, z1, lon0, lon1)
+            offsets, candidates = cls._filter(unit, centers, radii, offsets, candidates, max_k)
+
+        all_children = np.concatenate(children)
+        leaf_counts = np.zeros(num_cells, dtype=np.int64)
+        for leaf_cells, counts, _ in levels:
+            leaf_counts[leaf_cells] = counts
+        offsets = np.zeros(num_cells + 1, dtype=np.int64)
+        np.cumsum(leaf_counts, out=offsets[1:])
+
+        out = np.empty(offsets[-1], dtype=np.int32)
+        for leaf_cells, counts, level_candidates in levels:
+            out[ragged_positions(offsets[leaf_cells], counts)] = level_candidates
+
+        # sorting the candidates of each cell makes ties resolve to the smallest index
+        rows = np.repeat(np.arange(num_cells), leaf_counts)
+        out = out[np.lexsort((out, rows))]
+
+        return cls(lat_cells, max_k, all_children.astype(np.int32), offsets, out)
+
+    @staticmethod
+    def _filter(
+        unit: np.ndarray, centers: np.ndarray, radii: np.ndarray, offsets: np.ndarray, candidates: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Removes candidates which are too far from the cell centers."""
+
+        counts = np.diff(offsets)
+        rows = np.repeat(np.arange(counts.size), counts)
+        diff = unit[candidates] - unit_vectors(centers)[rows]
+        chords = np.einsum("ij,ij->i", diff, diff)  # squared chord lengths
+
+        # removing all points which are as close as the nearest one k-1 times overestimates d_k if there are ties,
+        # which only adds candidates
+        remaining = chords
+        for _ in range(k - 1):
+            nearest = np.minimum.reduceat(remaining, offsets[:-1])
+            remaining = np.where(remaining <= nearest[rows], np.inf, remaining)
+        chord_k = np.sqrt(np.minimum.reduceat(remaining, offsets[:-1]))
+        distances_k = 2.0 * np.arcsin(np.minimum(chord_k * 0.5, 1.0))
+
+        bounds = np.minimum((distances_k + 2.0 * radii) * (1.0 + SLACK) + SLACK, np.pi)
+        bounds = (2.0 * np.sin(bounds * 0.5)) ** 2 * (1.0 + SLACK)
+        keep = chords <= bounds[rows]
+
+        rows = rows[keep]
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=counts.size), out=offsets[1:])
+        return offsets, candidates[keep]
+
+    def cells(self, queries: np.ndarray) -> np.ndarray:
+        """Returns the leaf cells of `queries` (latitude, longitude) in radians."""
+
+        u = (np.sin(queries[:, 0].astype(np.float64)) + 1.0) * 0.5 * self.lat_cells
+        v = (queries[:, 1].astype(np.float64) + np.pi) / (2.0 * np.pi) * self.lon_cells
+        iu = np.clip(np.floor(u), 0, self.lat_cells - 1)
+        iv = np.floor(v)
+        # position within the cell in [0, 1), which is doubled for every level. this is exact in floating point.
+        fu = u - iu
+        fv = v - iv
+        cells = (iu * self.lon_cells + np.mod(iv, self.lon_cells)).astype(np.intp)
+
+        while True:
+            first_child = self.children[cells]
+            inner = np.flatnonzero(first_child >= 0)
+            if inner.size == 0:
+                return cells
+            fu[inner] *= 2.0
+            fv[inner] *= 2.0
+            upper = fu[inner] >= 1.0
+            right = fv[inner] >= 1.0
+            fu[inner] -= upper
+            fv[inner] -= right
+            cells[inner] = first_child[inner] + 2 * upper + right
+
+    def query(self, coords: np.ndarray, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted great-circle angles and indices of the `k` nearest points of `coords` for each query."""
+
+        if k > self.max_k:
+            raise ValueError(f"k must be <= {self.max_k} (the `max_k` of the grid), not {k}")
+
+        cells = self.cells(queries)
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+        row_starts = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(queries.shape[0]), counts)
+        candidates = self.candidates[ragged_positions(starts, counts)]
+        distances = haversine(queries[rows], coords[candidates])
+
+        if k == 1:
+            nearest = np.minimum.reduceat(distances, row_starts)
+            hits = np.flatnonzero(distances == nearest[rows])
+            _, first = np.unique(rows[hits], return_index=True)
+            selected = hits[first][:, None]
+        else:
+            order = np.lexsort((candidates, distances, rows))
+            selected = order[row_starts[:, None] + np.arange(k)]
+
+        return distances[selected], candidates[selected].astype(np.intp)
+
+    def get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, int]]:
+        arrays = {"children": self.children, "offsets": self.offsets, "candidates": self.candidates}
+        return arrays, {"lat_cells": self.lat_cells, "max_k": self.max_k}
+
+    @classmethod
+    def from_state(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, int]) -> "SphereGrid":
+        return cls(meta["lat_cells"], meta["max_k"], arrays["children"], arrays["offsets"], arrays["candidates"])
+
+    @property
+    def nbytes(self) -> int:
+        return self.children.nbytes + self.offsets.nbytes + self.candidates.nbytes
@@ -0,0 +1,101 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from typing import List, Literal, Optional, Tuple, Type, overload
+
+import numpy as np
+
+from .cities import CityTable
+from .geocoding import QueryResult, ReverseGeocodeBase, _check_input, _merge_results, _num_jobs, _split_batch
+
+_worker_geo: Optional[ReverseGeocodeBase] = None
+
+
+def _init_worker(cls: Type[ReverseGeocodeBase], name: str) -> None:
+    global _worker_geo
+    _worker_geo = cls.attach(name)
+
+
+def _query_worker(query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool) -> tuple:
+    assert _worker_geo is not None
+    result = _worker_geo.query(query_arr, k, form, return_distance, return_coords=return_coords)
+    # only send the indices back, the parent has the same city table
+    return result[:-1] + (result[-1].indices,)
+
+
+class QueryPool:
+    """Process pool which answers queries using a shared copy of a built index.
+
+    The index is copied into shared memory once (see `ReverseGeocodeBase.share`) and every worker process
+    attaches to it without copying. Large batches are split into chunks which are queried in parallel
+    and the results are returned in order.
+
+    Example:
+    >>> with QueryPool(ReverseGeocode(), processes=4) as pool:
+    ...     coords, distances, cities = pool.query(query_arr, k=2)
+    """
+
+    def __init__(self, geo: ReverseGeocodeBase, processes: int = -1, mp_context: Optional[BaseContext] = None) -> None:
+        self.geo = geo
+        self.processes = _num_jobs(processes)
+        self.shm = geo.share()
+        try:
+            self.executor = ProcessPoolExecutor(
+                self.processes, mp_context, initializer=_init_worker, initargs=(type(geo), self.shm.name)
+            )
+        except BaseException:
+            self.shm.close()
+            self.shm.unlink()
+            raise
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[True],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[False],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult: ...
+
+    def query(self, query_arr, k=2, form="radians", return_distance=True, return_coords=True):
+        """See `ReverseGeocodeBase.query`."""
+
+        _check_input(query_arr, k, form, form)
+
+        futures = [
+            self.executor.submit(_query_worker, query_arr[sl], k, form, return_distance, return_coords)
+            for sl in _split_batch(query_arr.shape[0], self.processes)
+        ]
+
+        results: List[QueryResult] = []
+        for future in futures:
+            *arrays, indices = future.result()
+            results.append((*arrays, self.geo.cities.take(indices)))
+
+        return _merge_results(self.geo.cities, results, return_distance)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self) -> "QueryPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
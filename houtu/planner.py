@@ -0,0 +1,329 @@
+import json
+import logging
+import math
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from .cities import CityTable
+from .geocoding import (
+    Dataset,
+    QueryResult,
+    ReverseGeocodeBase,
+    ReverseGeocodeBruteEuclidic,
+    ReverseGeocodeBruteHaversine,
+    ReverseGeocodeKdLearn,
+    ReverseGeocodeKdScipy,
+    ReverseGeocodeVpTreePython,
+    load_data,
+)
+from .storage import PathType
+from .utils import rand_lat_lon
+
+logger = logging.getLogger(__name__)
+
+PROFILE_VERSION = 1  # increase when the format of saved profiles or the cost model changes
+CALIBRATION_BATCHES = (1, 16, 256, 4096)  # batch sizes which are timed, in increasing order
+CALIBRATION_K = (1, 8)  # values of k which are timed
+CALIBRATION_REPEAT = 3  # the fastest of this many runs is used
+CALIBRATION_SECONDS = 0.1  # larger batches are skipped once a run is expected to take longer
+
+# these return the same float64 distances and cities. `ReverseGeocodeVpTreeSimd` computes float32 distances,
+# which can rank near ties differently.
+DEFAULT_ENGINES: Tuple[Type[ReverseGeocodeBase], ...] = (
+    ReverseGeocodeKdScipy,
+    ReverseGeocodeKdLearn,
+    ReverseGeocodeVpTreePython,
+    ReverseGeocodeBruteEuclidic,
+)
+
+# the query time of these engines grows linearly with the number of cities, logarithmically for the others
+LINEAR_ENGINES: Tuple[Type[ReverseGeocodeBase], ...] = (ReverseGeocodeBruteEuclidic, ReverseGeocodeBruteHaversine)
+
+
+class CostModel(NamedTuple):
+    """Cost of an engine. A query of `n` points for `k` neighbours is expected to take
+    `c0 + c1 * k + n * (c2 + c3 * k)` seconds, where `coefficients` are `(c0, c1, c2, c3)`.
+    """
+
+    build_seconds: float
+    coefficients: Tuple[float, float, float, float]
+
+    def predict(self, n: int, k: int) -> float:
+        c0, c1, c2, c3 = self.coefficients
+        return c0 + c1 * k + n * (c2 + c3 * k)
+
+    @classmethod
+    def fit(cls, build_seconds: float, samples: Sequence[Tuple[int, int, float]]) -> "CostModel":
+        """Fits non-negative coefficients to the `(n, k, seconds)` samples, minimizing the relative errors
+        so that small batches are predicted as well as large ones.
+        """
+
+        from scipy.optimize import nnls
+
+        n, k, seconds = np.array(samples, dtype=np.float64).T
+        features = np.stack([np.ones_like(n), k, n, n * k], axis=1)
+        weights = 1.0 / np.maximum(seconds, 1e-9)
+        coefficients, _ = nnls(features * weights[:, None], seconds * weights)
+        c0, c1, c2, c3 = coefficients.tolist()
+        return cls(build_seconds, (c0, c1, c2, c3))
+
+    def scaled(self, build_seconds: float, factor: float) -> "CostModel":
+        """Returns the model with the per-point costs `c2` and `c3` multiplied by `factor`."""
+
+        c0, c1, c2, c3 = self.coefficients
+        return CostModel(build_seconds, (c0, c1, c2 * factor, c3 * factor))
+
+
+class QueryPlan(NamedTuple):
+    engine: str  # class name of the chosen engine
+    seconds: float  # its predicted time
+    estimates: Dict[str, float]  # predicted time of every eligible engine
+
+
+def _time_query(geo: ReverseGeocodeBase, query_arr: np.ndarray, k: int) -> float:
+    best = float("inf")
+    for _ in range(CALIBRATION_REPEAT):
+        start = time.perf_counter()
+        geo._query(query_arr, k, "radians", True, return_coords=False)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate(geo: ReverseGeocodeBase, build_seconds: float = 0.0) -> CostModel:
+    """Times queries of random points using `geo` for `CALIBRATION_BATCHES` and `CALIBRATION_K`
+    and fits a `CostModel`. At least the two smallest batches are timed for every k.
+    """
+
+    query_arr = rand_lat_lon(CALIBRATION_BATCHES[-1])
+    geo._query(query_arr[:1], 1, "radians", True, return_coords=False)  # first calls can be slower
+
+    samples: List[Tuple[int, int, float]] = []
+    for k in sorted({min(k, geo._max_k()) for k in CALIBRATION_K}):
+        for i, n in enumerate(CALIBRATION_BATCHES):
+            if i >= 2 and seconds * n / CALIBRATION_BATCHES[i - 1] > CALIBRATION_SECONDS:
+                break
+            seconds = _time_query(geo, query_arr[:n], k)
+            samples.append((n, k, seconds))
+
+    return CostModel.fit(build_seconds, samples)
+
+
+def size_factor(geo: ReverseGeocodeBase, num_cities: int, calibrated_cities: int) -> float:
+    """Returns the factor by which the per-point query time of `geo` changes from `calibrated_cities`
+    to `num_cities` cities, see `LINEAR_ENGINES`.
+    """
+
+    if isinstance(geo, LINEAR_ENGINES):
+        return num_cities / calibrated_cities
+    return math.log2(num_cities + 1) / math.log2(calibrated_cities + 1)
+
+
+def load_profile(path: PathType, engines: Sequence[str], num_cities: int) -> Optional[Dict[str, CostModel]]:
+    """Loads the cost models saved by `save_profile`. Returns None if the file doesn't exist or
+    was saved for other engines or a different number of cities.
+    """
+
+    try:
+        with open(path, encoding="utf-8") as fr:
+            profile = json.load(fr)
+    except FileNotFoundError:
+        return None
+
+    if (
+        profile.get("version") != PROFILE_VERSION
+        or profile.get("num_cities") != num_cities
+        or sorted(profile.get("engines", {})) != sorted(engines)
+    ):
+        logger.info("Ignoring outdated profile %s", path)
+        return None
+
+    return {
+        name: CostModel(model["build_seconds"], tuple(model["coefficients"]))
+        for name, model in profile["engines"].items()
+    }
+
+
+def save_profile(path: PathType, models: Dict[str, CostModel], num_cities: int) -> None:
+    profile = {
+        "version": PROFILE_VERSION,
+        "num_cities": num_cities,
+        "engines": {name: model._asdict() for name, model in models.items()},
+    }
+    with open(path, "w", encoding="utf-8") as fw:
+        json.dump(profile, fw, indent=2)
+
+
+class ReverseGeocodeAuto(ReverseGeocodeBase):
+    """Builds several indices (engines) over the same cities and answers every query using the one which
+    is expected to be the fastest for its batch size and `k`.
+
+    After building, every engine is timed for a few batch sizes and values of k (see `calibrate`) to fit its
+    `CostModel`. With `profile`, the models are loaded from that json file instead, as long as it was saved for
+    the same engines and number of cities, or saved to it after calibrating. Profiles depend on the machine.
+    Engines whose library isn't installed are skipped. All engines must use the same `metric`. The results of
+    the default engines don't depend on the chosen engine. Other engines, like `ReverseGeocodeVpTreeSimd`,
+    can return other dtypes or rank near ties differently.
+
+    `plan(n, k)` returns the plan for a query of `n` points, `last_plan` is the plan of the last query.
+    Filtered queries build the engines for the matching cities and scale the cost models to the size of
+    the subset (see `size_factor`) instead of calibrating them again, so brute force search can win for small
+    subsets. `from_cache` isn't supported, `profile` caches the cost models.
+
+    engines: classes of the engines
+    profile: path of a json file with the cost models
+    """
+
+    def __init__(
+        self,
+        path: Optional[PathType] = None,
+        cache: bool = True,
+        engines: Sequence[Type[ReverseGeocodeBase]] = DEFAULT_ENGINES,
+        profile: Optional[PathType] = None,
+    ) -> None:
+        self._build(load_data(path, cache=cache), engines, profile)
+
+    def _build(
+        self,
+        data: Dataset,
+        engines: Sequence[Type[ReverseGeocodeBase]] = DEFAULT_ENGINES,
+        profile: Optional[PathType] = None,
+    ) -> None:
+        metrics = {cls.metric for cls in engines}
+        if len(metrics) != 1:
+            raise ValueError(f"All engines must use the same metric, not {sorted(metrics)}")
+
+        self.coords, self.cities = data.coords, data.info
+        built = {}
+        build_seconds = {}
+        for cls in engines:
+            start = time.perf_counter()
+            try:
+                geo = cls.__new__(cls)
+                geo._build(data)
+            except ImportError as e:
+                logger.info("Skipping %s: %s", cls.__name__, e)
+                continue
+            build_seconds[cls.__name__] = time.perf_counter() - start
+            built[cls.__name__] = geo
+
+        self._set_engines(built, build_seconds, profile)
+
+    def _set_engines(
+        self,
+        engines: Dict[str, ReverseGeocodeBase],
+        build_seconds: Dict[str, float],
+        profile: Optional[PathType],
+        models: Optional[Dict[str, CostModel]] = None,
+    ) -> None:
+        if not engines:
+            raise ValueError("None of the engines is available")
+
+        self.engines = engines
+        self.metric = next(iter(engines.values())).metric
+        self.last_plan: Optional[QueryPlan] = None
+
+        if models is None and profile is not None:
+            try:
+                models = load_profile(profile, list(engines), len(self.cities))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Ignoring invalid profile: %s", e)
+
+        if models is None:
+            models = {name: calibrate(geo, build_seconds[name]) for name, geo in engines.items()}
+            if profile is not None:
+                try:
+                    save_profile(profile, models, len(self.cities))
+                except OSError as e:
+                    logger.warning("Could not write profile %s: %s", profile, e)
+
+        self.models = models
+
+    def _build_like(self, coords: np.ndarray, cities: CityTable) -> ReverseGeocodeBase:
+        obj = type(self).__new__(type(self))
+        obj.coords, obj.cities = coords, cities
+        engines = {}
+        models = {}
+        for name, geo in self.engines.items():
+            start = time.perf_counter()
+            engines[name] = geo._build_like(coords, cities)
+            factor = size_factor(geo, len(cities), len(self.cities))
+            models[name] = self.models[name].scaled(time.perf_counter() - start, factor)
+
+        obj._set_engines(engines, {}, None, models)
+        return obj
+
+    @classmethod
+    def from_cache(cls, path: Optional[PathType] = None) -> "ReverseGeocodeAuto":
+        raise NotImplementedError(
+            f"{cls.__name__} doesn't support saving, use `profile` to cache the cost models and `from_cache` of "
+            "the engines"
+        )
+
+    def plan(self, n: int, k: int) -> QueryPlan:
+        """Returns the engine with the smallest predicted time for a query of `n` points for `k` neighbours
+        out of the engines which support `k`.
+        """
+
+        estimates = {name: self.models[name].predict(n, k) for name, geo in self.engines.items() if k <= geo._max_k()}
+        if not estimates:
+            raise ValueError(f"k must be <= {self._max_k()}, not {k}")
+
+        engine = min(estimates, key=estimates.__getitem__)
+        return QueryPlan(engine, estimates[engine], estimates)
+
+    def _dispatch(self, n: int, k: int) -> ReverseGeocodeBase:
+        self.last_plan = self.plan(n, k)
+        geo = self.engines[self.last_plan.engine]
+        geo.stats = self.stats
+        return geo
+
+    def _query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult:
+        geo = self._dispatch(query_arr.shape[0], k)
+        return geo._query(query_arr, k, form, return_distance, return_coords)
+
+    def _query_parallel(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, n_jobs: int, return_coords: bool
+    ) -> QueryResult:
+        geo = self._dispatch(query_arr.shape[0], k)
+        return geo._query_parallel(query_arr, k, form, return_distance, n_jobs, return_coords)
+
+    def query_track(
+        self,
+        points: np.ndarray,
+        k: int = 1,
+        form: str = "radians",
+        return_distance: bool = True,
+        return_coords: bool = True,
+    ) -> QueryResult:
+        """See `ReverseGeocodeBase.query_track`. Uses the engine which is planned for a query of all points."""
+
+        geo = self._dispatch(points.shape[0], k)
+        return geo.query_track(points, k, form, return_distance, return_coords)
+
+    def _query_radius(self, query_arr: np.ndarray, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        for geo in self.engines.values():
+            if type(geo)._query_radius is not ReverseGeocodeBase._query_radius:
+                return geo._query_radius(query_arr, angles)
+        return super()._query_radius(query_arr, angles)
+
+    def _max_k(self) -> int:
+        return max(geo._max_k() for geo in self.engines.values())
+
+    def _reference(self) -> ReverseGeocodeBase:
+        return next(iter(self.engines.values()))
+
+    def _min_geodesic(self, distances: np.ndarray) -> np.ndarray:
+        return self._reference()._min_geodesic(distances)
+
+    def _points(self, coords: np.ndarray) -> np.ndarray:
+        return self._reference()._points(coords)
+
+    def _from_chords(self, chords: np.ndarray) -> np.ndarray:
+        return self._reference()._from_chords(chords)
+
+    def _coords(self, indices: np.ndarray) -> np.ndarray:
+        return self.coords[indices]
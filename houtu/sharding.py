@@ -0,0 +1,328 @@
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from typing import TYPE_CHECKING, Any, List, Literal, Optional, Tuple, Type, Union, overload
+
+import numpy as np
+
+from .cities import CityTable
+from .geocoding import (
+    CHORD_MARGIN,
+    Dataset,
+    QueryResult,
+    ReverseGeocodeBase,
+    ReverseGeocodeKdScipy,
+    _check_input,
+    load_data,
+)
+from .storage import PathType
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+
+ROUTING_MARGIN = 2 * CHORD_MARGIN  # meters, covers the rounding errors of the shards' and the routing distances
+
+
+def partition(points: np.ndarray, num_shards: int) -> List[np.ndarray]:
+    """Splits the rows of `points` of shape (n, d) into `num_shards` spatially compact parts of (almost) equal size
+    by splitting them at the median of the axis with the largest extent recursively, like the top levels of a kd-tree.
+    The rows of each part are sorted.
+    """
+
+    if not 1 <= num_shards <= points.shape[0]:
+        raise ValueError(f"num_shards must be in [1, {points.shape[0]}], not {num_shards}")
+
+    def _split(rows: np.ndarray, num: int) -> List[np.ndarray]:
+        if num == 1:
+            return [rows]
+        values = points[rows]
+        axis = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
+        left = num // 2
+        cut = rows.size * left // num
+        order = np.argpartition(values[:, axis], cut)
+        return _split(np.sort(rows[order[:cut]]), left) + _split(np.sort(rows[order[cut:]]), num - left)
+
+    return _split(np.arange(points.shape[0]), num_shards)
+
+
+def _build_shard(cls: Type[ReverseGeocodeBase], data: Dataset, rows: np.ndarray, kwargs: dict) -> ReverseGeocodeBase:
+    """Builds an index of class `cls` over `rows` of `data`. Its cities are a view of `data.info`,
+    so the cities of its results refer to the rows of the whole dataset.
+    """
+
+    geo = cls.__new__(cls)
+    geo._build(Dataset(data.coords[rows], data.ecef[rows], data.info.take(rows)), **kwargs)
+    return geo
+
+
+def _query_shard(geo: ReverseGeocodeBase, query_arr: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    _, distances, cities = geo.query(query_arr, k, "radians", True, return_coords=False)
+    return distances, cities.indices
+
+
+def serve(conn: "Connection", geo: ReverseGeocodeBase) -> None:
+    """Answers the queries of a `RemoteShard` using `geo` until the connection is closed.
+    Requests are `(query_arr, k)` tuples with radians and responses `(True, (distances, indices))`
+    or `(False, exception)`.
+
+    `conn` can be any `multiprocessing.connection.Connection`, for example one accepted by a
+    `multiprocessing.connection.Listener` on another machine.
+    """
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        query_arr, k = request
+        try:
+            response: Tuple[bool, Any] = (True, _query_shard(geo, query_arr, k))
+        except Exception as e:
+            response = (False, e)
+        conn.send(response)
+
+    conn.close()
+
+
+def _shard_worker(
+    conn: "Connection",
+    cls: Type[ReverseGeocodeBase],
+    path: Optional[PathType],
+    cache: bool,
+    rows: np.ndarray,
+    kwargs: dict,
+) -> None:
+    try:
+        geo = _build_shard(cls, load_data(path, cache=cache), rows, kwargs)
+    except BaseException as e:
+        conn.send((False, e))
+        conn.close()
+        return
+
+    conn.send((True, None))
+    serve(conn, geo)
+
+
+class LocalShard:
+    """Shard which is queried in the calling process."""
+
+    def __init__(self, geo: ReverseGeocodeBase) -> None:
+        self.geo = geo
+        self._result: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def submit(self, query_arr: np.ndarray, k: int) -> None:
+        self._result = _query_shard(self.geo, query_arr, k)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        assert self._result is not None
+        result, self._result = self._result, None
+        return result
+
+    def close(self) -> None:
+        pass
+
+
+class RemoteShard:
+    """Shard which is queried over the connection `conn` to a process running `serve`.
+    `submit` only sends the request, so all shards work in parallel until their `result` is received.
+    """
+
+    def __init__(self, conn: "Connection") -> None:
+        self.conn = conn
+
+    def submit(self, query_arr: np.ndarray, k: int) -> None:
+        self.conn.send((query_arr, k))
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        success, value = self.conn.recv()
+        if not success:
+            raise value
+        return value
+
+    def close(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:  # the worker is gone already
+            pass
+        self.conn.close()
+
+
+Shard = Union[LocalShard, RemoteShard]
+
+
+class ShardedReverseGeocode:
+    """Index which is split into spatial shards with an independent index of class `cls` each.
+
+    The cities are partitioned by their ECEF coordinates (see `partition`). Each shard is bounded by the
+    axis-aligned box of its cities in the point space of `cls` (see `ReverseGeocodeBase._points`), so the distance
+    to the box is a lower bound of the distance to any of its cities. Every query point is first sent to the
+    shard whose box contains it or is closest. Its k-th distance bounds the distance of the true k-th neighbour,
+    so only the shards whose box is closer than that are queried as well. The results are merged
+    and are the same as those of one index of class `cls` over all cities (ties resolve to the smallest index).
+
+    With `processes=True` every shard is built and queried in its own worker process, which loads the
+    memory-mapped data cache and keeps only its shard in memory. The processes communicate over pipes
+    (`multiprocessing.connection`), so a shard can also run on another machine using `serve`.
+
+    kwargs: passed to `cls._build`, for example `max_k` for `ReverseGeocodeGrid`
+
+    Example:
+    >>> with ShardedReverseGeocode(ReverseGeocodeKdScipy, num_shards=8, processes=True) as geo:
+    ...     coords, distances, cities = geo.query(query_arr, k=2)
+    """
+
+    def __init__(
+        self,
+        cls: Type[ReverseGeocodeBase] = ReverseGeocodeKdScipy,
+        path: Optional[PathType] = None,
+        num_shards: int = 8,
+        processes: bool = False,
+        cache: bool = True,
+        mp_context: Optional[BaseContext] = None,
+        **kwargs: Any,
+    ) -> None:
+        data = load_data(path, cache=cache)
+        self.coords = data.coords
+        self.cities = data.info
+        self.rows = partition(data.ecef, num_shards)
+        self.sizes = np.array([rows.size for rows in self.rows])
+
+        # the distances of `cls` don't depend on the built index
+        self._metric = cls.__new__(cls)
+        self.lower = np.empty((num_shards, 3), dtype=np.float64)
+        self.upper = np.empty((num_shards, 3), dtype=np.float64)
+        for i, rows in enumerate(self.rows):
+            points = self._metric._points(data.coords[rows])
+            self.lower[i] = points.min(axis=0)
+            self.upper[i] = points.max(axis=0)
+
+        self.shards: List[Shard] = []
+        self._processes: List[BaseProcess] = []
+        try:
+            if processes:
+                self._start_workers(cls, path, cache, mp_context, kwargs)
+            else:
+                self.shards = [LocalShard(_build_shard(cls, data, rows, kwargs)) for rows in self.rows]
+        except BaseException:
+            self.close()
+            raise
+
+    def _start_workers(
+        self,
+        cls: Type[ReverseGeocodeBase],
+        path: Optional[PathType],
+        cache: bool,
+        mp_context: Optional[BaseContext],
+        kwargs: dict,
+    ) -> None:
+        import multiprocessing
+
+        ctx = mp_context or multiprocessing.get_context()
+        for rows in self.rows:
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_shard_worker, args=(child_conn, cls, path, cache, rows, kwargs), daemon=True)
+            p.start()
+            child_conn.close()
+            self._processes.append(p)
+            self.shards.append(RemoteShard(parent_conn))
+
+        for shard in self.shards:  # wait until all shards are built
+            assert isinstance(shard, RemoteShard)
+            success, error = shard.conn.recv()
+            if not success:
+                raise error
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[True],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[False],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult: ...
+
+    def query(self, query_arr, k=2, form="radians", return_distance=True, return_coords=True):
+        """See `ReverseGeocodeBase.query`."""
+
+        query_arr = _check_input(query_arr, k, form, "radians")
+        if k > len(self.cities):
+            raise ValueError(f"k must be <= {len(self.cities)}, not {k}")
+
+        n = query_arr.shape[0]
+        points = self._metric._points(query_arr)[:, None, :]
+        gaps = np.maximum(self.lower - points, 0.0) + np.maximum(points - self.upper, 0.0)
+        lower = self._metric._from_chords(np.sqrt(np.sum(gaps * gaps, axis=-1)))
+        home = np.argmin(lower, axis=1)
+
+        candidates = self._query_shards(query_arr, k, [np.flatnonzero(home == i) for i in range(len(self.shards))])
+        kth = np.full(n, np.inf)
+        for i, (rows, distances, _) in enumerate(candidates):
+            if self.sizes[i] >= k:
+                kth[rows] = distances[:, k - 1]
+
+        others = (lower <= (kth + ROUTING_MARGIN)[:, None]) & (np.arange(len(self.shards)) != home[:, None])
+        candidates += self._query_shards(query_arr, k, [np.flatnonzero(others[:, i]) for i in range(len(self.shards))])
+
+        rows = np.concatenate([np.repeat(rows, distances.shape[1]) for rows, distances, _ in candidates])
+        distances = np.concatenate([distances.ravel() for _, distances, _ in candidates])
+        indices = np.concatenate([indices.ravel() for _, _, indices in candidates])
+        order = np.lexsort((indices, distances, rows))
+        counts = np.bincount(rows, minlength=n)
+        selected = order[(np.cumsum(counts) - counts)[:, None] + np.arange(k)]
+
+        indices = indices[selected]
+        coords = self.coords[indices] if return_coords else None
+        if return_distance:
+            return coords, distances[selected], self.cities.take(indices)
+        else:
+            return coords, self.cities.take(indices)
+
+    def _query_shards(
+        self, query_arr: np.ndarray, k: int, rows: List[np.ndarray]
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Queries shard `i` for the points `rows[i]` and returns the (rows, distances, indices) of each shard
+        which was queried. All shards are sent their points before the results are received.
+        """
+
+        queried = []
+        for i, shard in enumerate(self.shards):
+            if rows[i].size > 0:
+                shard.submit(query_arr[rows[i]], min(k, int(self.sizes[i])))
+                queried.append(i)
+
+        return [(rows[i], *self.shards[i].result()) for i in queried]
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        for p in self._processes:
+            p.join()
+        self.shards = []
+        self._processes = []
+
+    def __enter__(self) -> "ShardedReverseGeocode":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,120 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Sequence
+
+# upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+_NULL_STAGE: ContextManager[None] = nullcontext()
+
+
+class StageStats:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.count = 0
+        self.points = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(buckets) + 1)  # the last one is +Inf
+
+
+class QueryStats:
+    """Collects the number of calls, points and a latency histogram for every stage of the queries.
+
+    Assign an instance to the `stats` attribute of a `ReverseGeocode*` object to enable it.
+    Subclasses can override `observe` to forward the measurements somewhere else.
+    The stages are:
+    - query: the whole `query` call
+    - convert: conversion of the input coordinates (`_check_input`)
+    - index: the nearest neighbour search of the backend
+    - cities: selecting the city metadata of the results
+    - geodesic: computing geodesic distances for `query(exact=True)`
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.bucket_bounds = tuple(buckets)
+        self.stages: Dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, points: int) -> None:
+        with self._lock:
+            try:
+                stats = self.stages[stage]
+            except KeyError:
+                stats = self.stages[stage] = StageStats(self.bucket_bounds)
+            stats.count += 1
+            stats.points += points
+            stats.seconds += seconds
+            stats.buckets[bisect_left(self.bucket_bounds, seconds)] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the count, number of points, total and mean seconds of every stage."""
+
+        with self._lock:
+            return {
+                stage: {
+                    "count": stats.count,
+                    "points": stats.points,
+                    "seconds": stats.seconds,
+                    "mean_seconds": stats.seconds / stats.count,
+                }
+                for stage, stats in self.stages.items()
+            }
+
+    def to_prometheus(self, prefix: str = "houtu", memory: Optional[Dict[str, int]] = None) -> str:
+        """Returns the statistics in the Prometheus text exposition format.
+        `memory` is a result of `ReverseGeocodeBase.memory_usage` which is exported as a gauge.
+        """
+
+        lines: List[str] = []
+        with self._lock:
+            lines.append(f"# HELP {prefix}_stage_seconds Time spent in each query stage")
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for stage, stats in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.bucket_bounds + (float("inf"),), stats.buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats.seconds!r}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats.count}')
+
+            lines.append(f"# HELP {prefix}_stage_points_total Number of points processed by each query stage")
+            lines.append(f"# TYPE {prefix}_stage_points_total counter")
+            for stage, stats in sorted(self.stages.items()):
+                lines.append(f'{prefix}_stage_points_total{{stage="{stage}"}} {stats.points}')
+
+        if memory is not None:
+            lines.append(f"# HELP {prefix}_memory_bytes Size of the arrays of the index")
+            lines.append(f"# TYPE {prefix}_memory_bytes gauge")
+            for part, nbytes in sorted(memory.items()):
+                lines.append(f'{prefix}_memory_bytes{{part="{part}"}} {nbytes}')
+
+        return "\n".join(lines) + "\n"
+
+
+class _StageTimer:
+    __slots__ = ("stats", "stage", "points", "start")
+
+    def __init__(self, stats: QueryStats, stage: str, points: int) -> None:
+        self.stats = stats
+        self.stage = stage
+        self.points = points
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args) -> None:
+        self.stats.observe(self.stage, time.perf_counter() - self.start, self.points)
+
+
+def stage(stats: Optional[QueryStats], name: str, points: int) -> ContextManager[None]:
+    """Returns a context manager which measures the stage `name` if `stats` is not None."""
+
+    if stats is None:
+        return _NULL_STAGE
+    return _StageTimer(stats, name, points)
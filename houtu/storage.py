@@ -0,0 +1,220 @@
+import os
+import sys
+from typing import TYPE_CHECKING, Any, Dict, Tuple, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from multiprocessing.shared_memory import SharedMemory
+    from pathlib import Path
+
+MAGIC = b"HOUTU\x00\x00\x00"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+PathType = Union[str, "os.PathLike[str]"]
+
+
+class StorageError(ValueError):
+    pass
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def get_cache_dir() -> "Path":
+    """Returns the directory used for houtu cache files.
+    It can be overridden using the `HOUTU_CACHE_DIR` environment variable.
+    """
+
+    from pathlib import Path
+
+    path = os.environ.get("HOUTU_CACHE_DIR")
+    if path:
+        return Path(path)
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(base) / "houtu"
+
+
+def file_hash(path: PathType, chunksize: int = 1024 * 1024) -> str:
+    """Returns the hex encoded sha256 hash of the file at `path`."""
+
+    import hashlib
+
+    m = hashlib.sha256()
+    with open(path, "rb") as fr:
+        while True:
+            data = fr.read(chunksize)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+def dumps_header(arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> Tuple[bytes, Dict[str, np.ndarray], int]:
+    """Returns the encoded file header, the contiguous arrays which follow it and the total size in bytes."""
+
+    import json
+
+    contiguous = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+
+    # offsets are relative to the end of the header so they don't depend on its length
+    offset = 0
+    toc = {}
+    for name, arr in contiguous.items():
+        offset = _align(offset)
+        toc[name] = {"dtype": np.lib.format.dtype_to_descr(arr.dtype), "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+
+    header = json.dumps({"meta": meta, "arrays": toc}, sort_keys=True).encode("utf-8")
+    prefix = MAGIC + np.array([FORMAT_VERSION, len(header)], dtype="<u4").tobytes() + header
+    prefix += b"\x00" * (_align(len(prefix)) - len(prefix))
+
+    return prefix, contiguous, len(prefix) + offset
+
+
+def write_arrays(path: PathType, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+    """Writes `arrays` and the json serializable `meta` dict to `path`.
+    The file is written to a temporary file first and then atomically moved into place,
+    so concurrent readers never see partially written files.
+    """
+
+    import tempfile
+
+    prefix, contiguous, _ = dumps_header(arrays, meta)
+    dirname = os.path.dirname(os.fspath(path)) or "."
+
+    fd, tmppath = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+    try:
+        with open(fd, "wb") as fw:
+            fw.write(prefix)
+            pos = 0
+            for arr in contiguous.values():
+                padding = _align(pos) - pos
+                fw.write(b"\x00" * padding)
+                fw.write(arr.tobytes())
+                pos += padding + arr.nbytes
+        os.chmod(tmppath, 0o644)  # mkstemp creates files which are only readable by the owner
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def loads_arrays(buffer: Any) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Creates arrays which share memory with `buffer` (anything supporting the buffer protocol).
+    No data is copied, so the arrays are only valid as long as the buffer is.
+    """
+
+    import json
+
+    view = memoryview(buffer)
+    if bytes(view[: len(MAGIC)]) != MAGIC:
+        raise StorageError("Not a houtu storage file")
+
+    version, header_len = np.frombuffer(view, dtype="<u4", count=2, offset=len(MAGIC)).tolist()
+    if version != FORMAT_VERSION:
+        raise StorageError(f"Unsupported storage format version {version}")
+
+    header_start = len(MAGIC) + 8
+    header = json.loads(bytes(view[header_start : header_start + header_len]).decode("utf-8"))
+    data_start = _align(header_start + header_len)
+
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.lib.format.descr_to_dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        arr = np.frombuffer(view, dtype=dtype, count=count, offset=data_start + info["offset"])
+        arr.flags.writeable = False
+        arrays[name] = arr.reshape(shape)
+
+    return arrays, header["meta"]
+
+
+def dump_arrays(buffer: Any, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+    """Writes `arrays` and `meta` to the writable `buffer` in the same format as `write_arrays`.
+    The buffer must be at least as large as the size returned by `dumps_header`.
+    """
+
+    prefix, contiguous, size = dumps_header(arrays, meta)
+    out = np.frombuffer(buffer, dtype=np.uint8, count=size)
+    out[: len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+
+    pos = len(prefix)
+    for arr in contiguous.values():
+        pos = len(prefix) + _align(pos - len(prefix))
+        out[pos : pos + arr.nbytes] = arr.reshape(-1).view(np.uint8)
+        pos += arr.nbytes
+
+
+def _tracker_id() -> str:
+    """Identifies the resource tracker of this process, which processes started by multiprocessing share
+    with their parent.
+    """
+
+    from multiprocessing import resource_tracker
+
+    resource_tracker.ensure_running()
+    stat = os.fstat(resource_tracker._resource_tracker._fd)  # type: ignore[attr-defined]
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+
+def create_shared_memory(arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "SharedMemory":
+    """Copies `arrays` and `meta` into a new shared memory block.
+    The caller owns the block and is responsible for calling `close()` and `unlink()` on it.
+    """
+
+    from multiprocessing.shared_memory import SharedMemory
+
+    if os.name == "posix":
+        meta = {**meta, "resource_tracker": _tracker_id()}
+    _, _, size = dumps_header(arrays, meta)
+    shm = SharedMemory(create=True, size=size)
+    try:
+        dump_arrays(shm.buf, arrays, meta)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+def attach_shared_memory(name: str) -> Tuple["SharedMemory", Dict[str, np.ndarray], Dict[str, Any]]:
+    """Attaches to the shared memory block `name` created by `create_shared_memory`.
+    The returned arrays are read-only views of the block, which must be kept alive as long as they are used.
+
+    Only the creator of a block should unlink it. Before Python 3.13 attaching always registers the block
+    with the resource tracker, which unlinks it when the attaching process exits, so the block is unregistered
+    again unless the tracker is the one of the creator (where registering it again was a no-op).
+    See https://github.com/python/cpython/issues/82300
+    """
+
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+
+    if sys.version_info >= (3, 13):
+        shm = SharedMemory(name=name, track=False)
+    else:
+        shm = SharedMemory(name=name)
+    arrays, meta = loads_arrays(shm.buf)
+    tracker = meta.pop("resource_tracker", None)
+    if sys.version_info < (3, 13) and os.name == "posix" and tracker != _tracker_id():
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+
+    return shm, arrays, meta
+
+
+def read_arrays(path: PathType) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Memory-maps the file at `path` read-only and returns the arrays and meta dict stored in it.
+    Processes which map the same file share the same physical pages.
+    """
+
+    import mmap
+
+    with open(path, "rb") as fr:
+        mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return loads_arrays(mm)
@@ -0,0 +1,290 @@
+import logging
+import threading
+from typing import List, Literal, NamedTuple, Optional, Sequence, Tuple, Union, overload
+
+import numpy as np
+
+from .cities import City, CityTable
+from .geocoding import QueryResult, ReverseGeocodeBase, ReverseGeocodeGrid, _check_input
+
+logger = logging.getLogger(__name__)
+
+DELTA_BLOCK_SIZE = 2**16  # number of distances between query points and the delta which are computed at once
+
+
+class _IndexState(NamedTuple):
+    main: ReverseGeocodeBase  # index over the rows `main_rows` of `cities`
+    main_rows: np.ndarray
+    main_removed: int  # number of removed rows which are still in `main`
+    delta_rows: np.ndarray  # rows added after `main` was built
+    removed: np.ndarray  # boolean mask of the removed rows
+    coords: np.ndarray  # coordinates of all rows in radians
+    cities: CityTable  # rows which were ever added. ids are the rows of this table followed by `pending`.
+    pending: Tuple[CityTable, ...]  # added tables which weren't concatenated to `cities` yet
+
+
+class UpdatableIndex:
+    """Index which supports adding and removing cities without rebuilding the index.
+
+    Added cities are kept in a small delta which is searched by brute force and merged with the results
+    of the main index. Their tables are concatenated to `cities` when it's accessed, a query returns one of them
+    or the index is compacted, so adding single cities doesn't copy all cities. Removed cities are masked, the main index is queried for as many more neighbours
+    as it contains removed cities. Once the delta and the removed cities of the main index grow past
+    `compact_threshold`, a new main index is built in a background thread.
+    Updates are visible immediately and never block queries. Queries use an immutable snapshot of the state,
+    which updates and compactions replace.
+
+    Cities are identified by their row in `cities`. Ids stay valid after compactions, removed ids are not reused.
+
+    Example:
+    >>> index = UpdatableIndex(ReverseGeocodeKdScipy())
+    >>> ids = index.add(points, pois, "degrees")
+    >>> index.remove(ids[:10])
+    >>> coords, distances, cities = index.query(query_arr, k=1, form="degrees")
+    """
+
+    def __init__(self, geo: ReverseGeocodeBase, compact_threshold: int = 1024) -> None:
+        if geo.cities.indices is not None:
+            raise ValueError("The cities of the index can't be a view")
+
+        rows = np.arange(len(geo.cities))
+        coords = geo._coords(rows).astype(np.float32)
+        self.geo = geo
+        self.compact_threshold = compact_threshold
+        self._state = _IndexState(
+            geo if not isinstance(geo, ReverseGeocodeGrid) else geo._build_like(coords, geo.cities),
+            rows,
+            0,
+            np.empty(0, dtype=rows.dtype),
+            np.zeros(rows.size, dtype=np.bool_),
+            coords,
+            geo.cities,
+            (),
+        )
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()  # compactions run one at a time, so newer ones are installed last
+        self._compaction: Optional[threading.Thread] = None
+
+    @property
+    def cities(self) -> CityTable:
+        return self._all_cities(self._state)
+
+    def __len__(self) -> int:
+        """Number of cities which weren't removed."""
+
+        state = self._state
+        return state.removed.size - int(np.count_nonzero(state.removed))
+
+    def add(self, coords: np.ndarray, cities: Union[CityTable, Sequence[City]], form: str = "radians") -> np.ndarray:
+        """Adds `cities` at the coordinates `coords` of shape (n, 2) and returns their ids."""
+
+        coords = _check_input(coords, 1, form, "radians").astype(np.float32)
+        if not isinstance(cities, CityTable):
+            cities = CityTable.from_cities(cities)
+        if coords.shape[0] != len(cities):
+            raise ValueError(f"Got {coords.shape[0]} coordinates for {len(cities)} cities")
+
+        with self._lock:
+            state = self._state
+            start = state.removed.size
+            ids = np.arange(start, start + coords.shape[0])
+            self._state = state._replace(
+                delta_rows=np.concatenate([state.delta_rows, ids]),
+                removed=np.concatenate([state.removed, np.zeros(ids.size, dtype=np.bool_)]),
+                coords=np.concatenate([state.coords, coords]),
+                pending=state.pending + (cities,),
+            )
+            self._maybe_compact()
+
+        return ids
+
+    def remove(self, ids: Union[Sequence[int], np.ndarray]) -> None:
+        """Removes the cities `ids`. Removing a city twice is a no-op."""
+
+        ids = np.unique(np.asarray(ids, dtype=np.intp))
+        with self._lock:
+            state = self._state
+            if ids.size and (ids[0] < 0 or ids[-1] >= state.removed.size):
+                raise ValueError(f"ids must be in [0, {state.removed.size})")
+
+            removed = state.removed.copy()
+            new = ids[~removed[ids]]
+            removed[new] = True
+            main_removed = state.main_removed + int(np.count_nonzero(np.isin(new, state.main_rows)))
+            self._state = state._replace(removed=removed, main_removed=main_removed)
+            self._maybe_compact()
+
+    def _all_cities(self, state: _IndexState) -> CityTable:
+        """Returns a table with all rows of `state`. Its pending tables are concatenated to the table of
+        the index once, instead of on every `add`.
+        """
+
+        if not state.pending:
+            return state.cities
+
+        cities = state.cities.concat(*state.pending)
+        with self._lock:
+            current = self._state
+            if current.cities is state.cities:
+                self._state = current._replace(cities=cities, pending=current.pending[len(state.pending) :])
+        return cities
+
+    def _maybe_compact(self) -> None:
+        state = self._state
+        if state.delta_rows.size + state.main_removed < self.compact_threshold:
+            return
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+
+        self._compaction = threading.Thread(target=self._compact_background, name="houtu-compaction", daemon=True)
+        self._compaction.start()
+
+    def _compact_background(self) -> None:
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("Compacting the index failed")
+
+    def compact(self) -> None:
+        """Builds a new main index over all cities which weren't removed. Updates which happen during the build
+        remain in the delta. Concurrent calls wait for each other.
+        """
+
+        with self._compact_lock:
+            state = self._state
+            rows = np.flatnonzero(~state.removed)
+            if rows.size == 0:
+                return
+
+            main = self.geo._build_like(state.coords[rows], self._all_cities(state).take(rows))
+            main.stats = self.geo.stats
+
+            with self._lock:
+                current = self._state
+                self._state = current._replace(
+                    main=main,
+                    main_rows=rows,
+                    main_removed=int(np.count_nonzero(current.removed[rows])),
+                    delta_rows=current.delta_rows[current.delta_rows >= state.removed.size],
+                )
+
+    def wait(self) -> None:
+        """Waits for a running background compaction."""
+
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[True],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self,
+        query_arr: np.ndarray,
+        k: int,
+        form: str,
+        return_distance: Literal[False],
+        return_coords: Literal[True] = True,
+    ) -> Tuple[np.ndarray, CityTable]: ...
+
+    @overload
+    def query(
+        self, query_arr: np.ndarray, k: int, form: str, return_distance: bool, return_coords: bool = True
+    ) -> QueryResult: ...
+
+    def query(self, query_arr, k=2, form="radians", return_distance=True, return_coords=True):
+        """See `ReverseGeocodeBase.query`. The distances of the added cities are computed by `_distances` of the index
+        using a matrix product, so they can differ from the distances of the index by rounding errors.
+        """
+
+        state = self._state
+        query_arr = _check_input(query_arr, k, form, "radians")
+        num_cities = state.removed.size - int(np.count_nonzero(state.removed))
+        if k > num_cities:
+            raise ValueError(f"k must be <= {num_cities} (the number of cities), not {k}")
+
+        distances, ids = self._query_main(state, query_arr, k)
+        delta_rows = state.delta_rows[~state.removed[state.delta_rows]]
+        if delta_rows.size:
+            delta_distances, delta_ids = self._query_delta(state, query_arr, k, delta_rows)
+            distances = np.concatenate([distances, delta_distances], axis=1)
+            ids = np.concatenate([ids, delta_ids], axis=1)
+
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        ids = np.take_along_axis(ids, order, axis=1)
+
+        coords = state.coords[ids] if return_coords else None
+        if ids.size and ids.max() >= len(state.cities):
+            cities = self._all_cities(state).take(ids)
+        else:
+            cities = state.cities.take(ids)
+        if return_distance:
+            return coords, distances, cities
+        else:
+            return coords, cities
+
+    def _query_main(self, state: _IndexState, query_arr: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the distances and ids of the `k` nearest cities of the main index which weren't removed.
+        Points whose neighbours include removed cities are queried again with twice as many neighbours.
+        Missing neighbours (if the main index has less than `k` cities left) have infinite distances.
+        """
+
+        n = query_arr.shape[0]
+        num_main = state.main_rows.size
+        distances = np.full((n, k), np.inf, dtype=np.float64)
+        ids = np.zeros((n, k), dtype=np.intp)
+
+        rows = np.arange(n)
+        num = min(2 * k if state.main_removed else k, num_main)
+        while True:
+            _, found_distances, cities = state.main.query(query_arr[rows], num, "radians", True, return_coords=False)
+            found_ids = cities.indices
+            found_removed = state.removed[found_ids]
+            found_distances[found_removed] = np.inf
+            order = np.argsort(found_distances, axis=1, kind="stable")[:, :k]
+            distances[rows, : order.shape[1]] = np.take_along_axis(found_distances, order, axis=1)
+            ids[rows, : order.shape[1]] = np.take_along_axis(found_ids, order, axis=1)
+
+            if num == num_main:
+                break
+            rows = rows[np.count_nonzero(found_removed, axis=1) > num - k]
+            if rows.size == 0:
+                break
+            num = min(2 * num, num_main)
+
+        return distances, ids
+
+    def _query_delta(
+        self, state: _IndexState, query_arr: np.ndarray, k: int, delta_rows: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the distances and ids of the (unsorted) `k` nearest cities of the delta for each point."""
+
+        num = min(k, delta_rows.size)
+        distances = np.empty((query_arr.shape[0], num), dtype=np.float64)
+        ids = np.empty((query_arr.shape[0], num), dtype=delta_rows.dtype)
+        delta_coords = state.coords[delta_rows]
+        block = max(1, DELTA_BLOCK_SIZE // delta_rows.size)
+        for start in range(0, query_arr.shape[0], block):
+            sl = slice(start, start + block)
+            block_distances = state.main._distances(query_arr[sl], delta_coords)
+            if num < delta_rows.size:
+                part = np.argpartition(block_distances, num - 1, axis=1)[:, :num]
+            else:
+                part = np.broadcast_to(np.arange(num), block_distances.shape)
+            distances[sl] = np.take_along_axis(block_distances, part, axis=1)
+            ids[sl] = delta_rows[part]
+        return distances, ids
+
+    def lat_lon(self, lat: float, lon: float, form: str) -> Tuple[List[float], float, City]:
+        query_arr = np.array([[lat, lon]], dtype=np.float32)
+        coords, distances, cities = self.query(query_arr, 1, form, True)
+        return coords[0, 0].tolist(), distances[0, 0], cities[0][0]
@@ -1,8 +1,14 @@
 import math
-from typing import Callable, Iterator, Tuple
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, Sequence, Tuple, TypeVar
 
 import numpy as np
 
+T = TypeVar("T")
+
+PREFETCH_JOIN_TIMEOUT = 1.0  # seconds to wait for the prefetch thread when the caller stops iterating
+
 
 def rand_lat_lon(samples: int, form: str = "radians", dtype=np.float32) -> np.ndarray:
     """Sample a list of random GPS coordinates, assuming the earth is a perfect sphere."""
@@ -42,6 +48,44 @@ def rand_sphere_points_2(samples: int, dtype=np.float32) -> np.ndarray:
 rand_sphere_points = rand_sphere_points_2
 
 
+def haversine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Great-circle angles (in radians) between broadcastable arrays of (latitude, longitude) in radians."""
+
+    lat1 = a[..., 0].astype(np.float64)
+    lon1 = a[..., 1].astype(np.float64)
+    lat2 = b[..., 0].astype(np.float64)
+    lon2 = b[..., 1].astype(np.float64)
+    sin_dlat = np.sin((lat2 - lat1) * 0.5)
+    sin_dlon = np.sin((lon2 - lon1) * 0.5)
+    h = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    return 2.0 * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def unit_vectors(coords: np.ndarray) -> np.ndarray:
+    """Converts (latitude, longitude) in radians to float64 unit vectors (x, y, z) of shape (n, 3)."""
+
+    lat = coords[:, 0].astype(np.float64)
+    lon = coords[:, 1].astype(np.float64)
+    coslat = np.cos(lat)
+    return np.stack([coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def ragged_to_csr(rows: Sequence[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Converts a sequence of index lists to offsets and indices."""
+
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    indices = np.concatenate([np.asarray(row, dtype=np.intp) for row in rows])
+    return offsets, indices
+
+
+def ragged_positions(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Returns the concatenation of `range(start, start + count)` for all starts and counts."""
+
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if ends.size else 0) + np.repeat(starts - (ends - counts), counts)
+
+
 def golden_section_search(
     func: Callable[[float], float], a: float, b: float, tol: float
 ) -> Iterator[Tuple[float, float]]:
@@ -99,3 +143,48 @@ def golden_section_search(
             yield (a, d)
         else:
             yield (c, b)
+
+
+def prefetch(it: Iterable[T], size: int = 1) -> Iterator[T]:
+    """Consumes `it` in a background thread, staying up to `size` items ahead of the caller.
+    Exceptions raised by `it` are re-raised in the caller's thread.
+    If the caller stops early while `it` blocks (like reading from stdin), the daemon thread is abandoned
+    after `PREFETCH_JOIN_TIMEOUT` seconds and exits once `it` returns.
+    """
+
+    q: "queue.Queue[Tuple[bool, object]]" = queue.Queue(size)
+    stop = threading.Event()
+
+    def _put(item: Tuple[bool, object]) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker() -> None:
+        try:
+            for item in it:
+                if not _put((False, item)):
+                    return
+        except BaseException as e:  # noqa: B036
+            _put((True, e))
+        else:
+            _put((True, None))
+
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            done, item = q.get()
+            if done:
+                if item is not None:
+                    raise item  # type: ignore[misc]
+                break
+            yield item  # type: ignore[misc]
+    finally:
+        stop.set()
+        thread.join(PREFETCH_JOIN_TIMEOUT)
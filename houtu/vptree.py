@@ -0,0 +1,254 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+SLACK = 1e-9  # relative, covers rounding errors of the triangle inequality
+CANDIDATES = 8  # number of points which are considered as vantage point of each node
+SAMPLES = 64  # number of points used to evaluate the candidates
+QUERY_BLOCK = 1024  # number of queries which are traversed at once, bounds the memory usage
+BUILD_BLOCK = 1024  # number of nodes whose vantage point candidates are evaluated at once
+
+
+def _distances(queries: np.ndarray, points: np.ndarray) -> np.ndarray:
+    diff = queries - points
+    return np.sqrt(np.sum(diff * diff, axis=-1))
+
+
+def _merge_nearest(
+    best: np.ndarray, best_positions: np.ndarray, rows: np.ndarray, distances: np.ndarray, positions: np.ndarray
+) -> None:
+    """Merges the candidates `distances` and `positions` of the queries `rows` into the sorted `best` distances
+    and positions of shape (n, k) in place. Candidates which are already part of `best` are skipped.
+    """
+
+    hits = distances < best[rows, -1]
+    if not hits.any():
+        return
+
+    k = best.shape[1]
+    targets = np.unique(rows[hits])
+    all_rows = np.concatenate([np.repeat(targets, k), rows[hits]])
+    all_distances = np.concatenate([best[targets].ravel(), distances[hits]])
+    all_positions = np.concatenate([best_positions[targets].ravel(), positions[hits]])
+
+    order = np.lexsort((all_positions, all_rows))
+    dup = (all_rows[order[1:]] == all_rows[order[:-1]]) & (all_positions[order[1:]] == all_positions[order[:-1]])
+    unique = order[np.concatenate([[True], ~dup])]
+
+    order = unique[np.lexsort((all_distances[unique], all_rows[unique]))]
+    counts = np.bincount(np.searchsorted(targets, all_rows[order]), minlength=targets.size)
+    selected = order[(np.cumsum(counts) - counts)[:, None] + np.arange(k)]
+    best[targets] = all_distances[selected]
+    best_positions[targets] = all_positions[selected]
+
+
+class VpTree:
+    """Vantage-point tree stored in flat arrays, which is queried for many points at once.
+
+    The tree is balanced: every node splits its points at the median distance to its vantage point,
+    so node `i` has the children `2i + 1` (inner) and `2i + 2` (outer) and all leaves are at the same depth.
+    The points are stored in tree order, so every node covers a contiguous range of them.
+    Inner nodes store the position of their vantage point and the smallest and largest distance to it
+    of both children, so each child is bounded by a spherical shell around the vantage point.
+
+    Queries are answered for blocks of queries at once. The distances to the k nearest points of the subtree of
+    each query which contains at least k points are the initial bound. Then all nodes which could contain a point
+    within the bound are traversed level by level for all (query, node) pairs at once. Vantage points are points
+    of the tree, so their distances tighten the bound while descending. Finally the distances to the points of
+    the leaves which were reached are computed.
+    Distances are euclidean and computed in float64 like `houtu.brute.EuclideanKnn`, ties resolve to the
+    smallest index. float32 points are stored as float32 and only converted for the distance computations,
+    which gives the same results with half the memory.
+    """
+
+    def __init__(
+        self,
+        depth: int,
+        points: np.ndarray,
+        indices: np.ndarray,
+        vantage: np.ndarray,
+        radii: np.ndarray,
+        offsets: np.ndarray,
+    ) -> None:
+        self.depth = depth  # number of levels of inner nodes
+        self.points = points  # points in tree order, float32 or float64 like the input
+        self.indices = indices  # original index of each point
+        self.vantage = vantage  # positions of the vantage points of the inner nodes in `points`
+        self.radii = radii  # distance ranges (inner min, inner max, outer min, outer max) to the vantage points
+        self.offsets = offsets  # points of leaf `i` are `points[offsets[i] : offsets[i + 1]]`
+
+    @classmethod
+    def build(cls, points: np.ndarray, leaf_size: int = 16, seed: int = 0) -> "VpTree":
+        """Builds the tree for `points` of shape (n, d). The vantage points are chosen randomly using `seed`
+        out of `CANDIDATES` points of each node, as the one whose distances to `SAMPLES` other points spread
+        the most (Yianilos 1993).
+        """
+
+        n = points.shape[0]
+        if n < 1:
+            raise ValueError("Cannot build a tree without points")
+
+        rng = np.random.default_rng(seed)
+        depth = int(np.ceil(np.log2(n / leaf_size))) if n > leaf_size else 0
+        if points.dtype != np.float32:
+            points = points.astype(np.float64)
+        coords = points.astype(np.float64)  # in the current order, which keeps the memory accesses local
+        order = np.arange(n)
+        starts = np.zeros(1, dtype=np.int64)
+        ends = np.full(1, n, dtype=np.int64)
+        vantage = np.empty(2**depth - 1, dtype=np.int64)
+        radii = np.empty((2**depth - 1, 4), dtype=np.float64)
+
+        for level in range(depth):
+            lengths = ends - starts
+            nodes = np.arange(2**level - 1, 2 ** (level + 1) - 1)
+
+            candidates = starts[:, None] + (rng.random((lengths.size, CANDIDATES)) * lengths[:, None]).astype(int)
+            sample = starts[:, None] + (rng.random((lengths.size, SAMPLES)) * lengths[:, None]).astype(int)
+            best = np.empty(lengths.size, dtype=np.int64)
+            for start in range(0, lengths.size, BUILD_BLOCK):
+                sl = slice(start, start + BUILD_BLOCK)
+                a, b = coords[candidates[sl]], coords[sample[sl]]
+                # only used to rank the candidates, so the less exact matrix product formula is good enough
+                squared = (
+                    np.sum(a * a, axis=2)[:, :, None] + np.sum(b * b, axis=2)[:, None, :] - 2.0 * a @ b.swapaxes(1, 2)
+                )
+                best[sl] = np.argmax(np.std(np.sqrt(np.maximum(squared, 0.0)), axis=2), axis=1)
+            vp = candidates[np.arange(lengths.size), best]
+
+            segments = np.repeat(np.arange(lengths.size), lengths)
+            distances = _distances(coords, np.repeat(coords[vp], lengths, axis=0))
+
+            # sorts every range by distance using one key, which is much faster than `np.lexsort`.
+            # Distances are scaled to [0, 1) per range, so rounding can only swap nearly equal distances.
+            scale = np.maximum.reduceat(distances, starts) * (1.0 + 2.0**-20)
+            scale[scale == 0.0] = 1.0
+            perm = np.argsort(segments + distances / scale[segments])
+            vantage[nodes] = order[vp]
+            order = order[perm]
+            coords = coords[perm]
+            distances = distances[perm]
+
+            # the ranges are computed from the distances, so they are exact even if rounding changed the order
+            mids = starts + lengths // 2
+            halves = np.stack([starts, mids], axis=1).ravel()
+            radii[nodes] = np.stack(
+                [np.minimum.reduceat(distances, halves), np.maximum.reduceat(distances, halves)], axis=1
+            ).reshape(-1, 4)
+            starts, ends = halves, np.stack([mids, ends], axis=1).ravel()
+
+        positions = np.empty(n, dtype=np.int64)
+        positions[order] = np.arange(n)
+        offsets = np.append(starts, n)
+        if points.dtype == np.float32:
+            coords = points[order]
+        return cls(depth, coords, order.astype(np.int32), positions[vantage].astype(np.int32), radii, offsets)
+
+    def _node_ranges(self, level: int, nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the start and end positions of the points of `nodes` at `level`."""
+
+        span = 2 ** (self.depth - level)
+        first = (nodes - (2**level - 1)) * span
+        return self.offsets[first], self.offsets[first + span]
+
+    def _gather(
+        self, queries: np.ndarray, rows: np.ndarray, starts: np.ndarray, ends: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the distances of `queries[rows]` to the points in the ranges `starts` to `ends` and their
+        positions, padded with infinite distances to the longest range.
+        """
+
+        width = int((ends - starts).max())
+        positions = starts[:, None] + np.arange(width)
+        valid = positions < ends[:, None]
+        positions = np.minimum(positions, ends[:, None] - 1)
+        distances = _distances(queries[rows, None, :], self.points[positions])
+        distances[~valid] = np.inf
+        return distances, positions
+
+    def _initial(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted distances and positions of the k nearest points of the subtree of each query
+        which contains at least k points.
+        """
+
+        n = self.points.shape[0]
+        level = min(self.depth, int(np.floor(np.log2(n // k))))  # nodes at this level have at least k points
+        nodes = np.zeros(queries.shape[0], dtype=np.int64)
+        for _ in range(level):
+            radii = self.radii[nodes]
+            distances = _distances(queries, self.points[self.vantage[nodes]])
+            nodes = 2 * nodes + 1 + (2.0 * distances > radii[:, 1] + radii[:, 2])
+
+        distances, positions = self._gather(queries, np.arange(queries.shape[0]), *self._node_ranges(level, nodes))
+        part = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        part = np.take_along_axis(part, np.argsort(np.take_along_axis(distances, part, axis=1), axis=1), axis=1)
+        return np.take_along_axis(distances, part, axis=1), np.take_along_axis(positions, part, axis=1)
+
+    def _query_block(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best, best_positions = self._initial(queries, k)
+
+        rows = np.arange(queries.shape[0])
+        nodes = np.zeros(rows.size, dtype=np.int64)
+        for _ in range(self.depth):
+            vantage = self.vantage[nodes]
+            distances = _distances(queries[rows], self.points[vantage])
+            _merge_nearest(best, best_positions, rows, distances, vantage)
+
+            bounds = best[rows, -1]
+            lower = (distances - bounds) * (1.0 - SLACK)
+            upper = (distances + bounds) * (1.0 + SLACK)
+            radii = self.radii[nodes]
+            inner = (lower <= radii[:, 1]) & (upper >= radii[:, 0])
+            outer = (lower <= radii[:, 3]) & (upper >= radii[:, 2])
+            rows = np.concatenate([rows[inner], rows[outer]])
+            nodes = np.concatenate([2 * nodes[inner] + 1, 2 * nodes[outer] + 2])
+
+        distances, positions = self._gather(queries, rows, *self._node_ranges(self.depth, nodes))
+        bounds = best[rows, -1:] * (1.0 + SLACK)
+        if k < distances.shape[1]:
+            # keeps all points at the distance of the k-th nearest one of the leaf, so ties resolve to the smallest index
+            bounds = np.minimum(bounds, np.partition(distances, k - 1, axis=1)[:, k - 1 : k])
+        keep = distances <= bounds
+        rows = np.broadcast_to(rows[:, None], keep.shape)[keep]
+        distances = distances[keep]
+        indices = self.indices[positions[keep]]
+
+        order = np.lexsort((indices, distances, rows))
+        counts = np.bincount(rows, minlength=queries.shape[0])
+        selected = order[(np.cumsum(counts) - counts)[:, None] + np.arange(k)]
+        return distances[selected], indices[selected].astype(np.intp)
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted distances and indices of the `k` nearest points for each query."""
+
+        n = self.points.shape[0]
+        if not 1 <= k <= n:
+            raise ValueError(f"k must be in [1, {n}], not {k}")
+
+        queries = queries.astype(np.float64)
+        distances = np.empty((queries.shape[0], k), dtype=np.float64)
+        indices = np.empty((queries.shape[0], k), dtype=np.intp)
+        for start in range(0, queries.shape[0], QUERY_BLOCK):
+            sl = slice(start, start + QUERY_BLOCK)
+            distances[sl], indices[sl] = self._query_block(queries[sl], k)
+        return distances, indices
+
+    def get_state(self) -> Tuple[Dict[str, np.ndarray], Dict[str, int]]:
+        arrays = {
+            "points": self.points,
+            "indices": self.indices,
+            "vantage": self.vantage,
+            "radii": self.radii,
+            "offsets": self.offsets,
+        }
+        return arrays, {"depth": self.depth}
+
+    @classmethod
+    def from_state(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, int]) -> "VpTree":
+        return cls(
+            meta["depth"], arrays["points"], arrays["indices"], arrays["vantage"], arrays["radii"], arrays["offsets"]
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return sum(arr.nbytes for arr in self.get_state()[0].values())
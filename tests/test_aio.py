@@ -0,0 +1,60 @@
+import asyncio
+import time
+import unittest
+
+import numpy as np
+
+from houtu.aio import AsyncReverseGeocoder
+from houtu.geocoding import ReverseGeocodeBallHaversine
+from houtu.utils import rand_lat_lon
+
+
+class AsyncReverseGeocoderTest(unittest.TestCase):
+    def test_lookup(self):
+        geo = ReverseGeocodeBallHaversine()
+        query = rand_lat_lon(100, "degrees")
+        coords_truth, distances_truth, cities_truth = geo.query(query, 1, "degrees")
+
+        async def lookup_all():
+            async with AsyncReverseGeocoder(geo, max_batch=40, max_latency=0.01) as geocoder:
+                results = await asyncio.gather(*(geocoder.lookup(float(lat), float(lon)) for lat, lon in query))
+                single = await geocoder.lookup(float(query[0, 0]), float(query[0, 1]))
+            return geocoder, results, single
+
+        geocoder, results, single = asyncio.run(lookup_all())
+
+        self.assertEqual(4, geocoder.batches)  # 40 + 40 + 20 (after max_latency) + 1
+        for i, (coords, distance, city) in enumerate(results):
+            np.testing.assert_allclose(coords_truth[i, 0], coords)
+            self.assertAlmostEqual(distances_truth[i, 0], distance)
+            self.assertEqual(cities_truth[i][0], city)
+        self.assertEqual(results[0], single)
+
+    def test_error(self):
+        geo = ReverseGeocodeBallHaversine()
+
+        async def lookup():
+            async with AsyncReverseGeocoder(geo, form="invalid") as geocoder:
+                return await geocoder.lookup(0.0, 0.0)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(lookup())
+
+    def test_cancel(self):
+        geo = ReverseGeocodeBallHaversine()
+
+        class SlowGeocoder(AsyncReverseGeocoder):
+            def _query(self, query_arr):
+                time.sleep(0.5)
+                return super()._query(query_arr)
+
+        async def lookup():
+            geocoder = SlowGeocoder(geo, max_batch=1)
+            task = asyncio.ensure_future(geocoder.lookup(0.0, 0.0))
+            await asyncio.sleep(0.1)
+            for batch in list(geocoder._tasks):
+                batch.cancel()
+            return await asyncio.wait_for(task, 5.0)
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(lookup())
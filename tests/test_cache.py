@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+
+from houtu.cache import QueryCache
+from houtu.geocoding import ReverseGeocodeKdScipy, ReverseGeocodeVpTreeSimd
+from houtu.utils import rand_lat_lon
+
+
+class QueryCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.geo = ReverseGeocodeKdScipy()
+
+    def test_query(self):
+        points = np.round(rand_lat_lon(50, "degrees"), 2)
+        query = points[np.random.randint(0, 50, 500)]
+        cached = QueryCache(self.geo, decimals=2)
+
+        coords_truth, distances_truth, cities_truth = self.geo.query(query, 3, "degrees")
+        for _ in range(2):
+            coords, distances, cities = cached.query(query, 3, "degrees")
+            np.testing.assert_allclose(coords_truth, coords, rtol=1e-06)
+            np.testing.assert_allclose(distances_truth, distances, atol=2.0)  # float32 ECEF coordinates
+            np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+        info = cached.cache_info()
+        misses = len(np.unique(query, axis=0))
+        self.assertEqual(misses, info.misses)
+        self.assertEqual(1000 - misses, info.hits)
+        self.assertEqual(misses, info.currsize)
+
+        coords, cities = cached.query(np.deg2rad(query), 3, return_distance=False)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+        self.assertEqual(misses, cached.cache_info().misses)
+
+        _, _, city = cached.lat_lon(float(query[0, 0]), float(query[0, 1]), "degrees")
+        self.assertEqual(cities_truth[0][0], city)
+
+    def test_dtypes(self):
+        query = rand_lat_lon(10, "degrees")
+        for geo in (self.geo, ReverseGeocodeVpTreeSimd()):
+            with self.subTest(cls=type(geo).__name__):
+                cached = QueryCache(geo)
+                coords_truth, distances_truth, _ = geo.query(query, 2, "degrees")
+                for _ in range(2):  # misses and hits
+                    coords, distances, _ = cached.query(query, 2, "degrees")
+                    self.assertEqual(coords_truth.dtype, coords.dtype)
+                    self.assertEqual(distances_truth.dtype, distances.dtype)
+                self.assertEqual(10, cached.cache_info().hits)
+
+    def test_wrapped_longitudes(self):
+        query = np.array([[10.0, 300.0], [-45.0, 250.0], [60.0, 359.9999999], [0.0, -180.0]], dtype=np.float32)
+        cached = QueryCache(self.geo, decimals=7)
+
+        wrapped = query.astype(np.float64)
+        wrapped[:, 1] = (wrapped[:, 1] + 180.0) % 360.0 - 180.0
+        np.testing.assert_allclose(
+            np.deg2rad(wrapped), cached._dequantize(cached._quantize(query, "degrees")), atol=1e-7
+        )
+
+        _, cities_truth = self.geo.query(query, 2, "degrees", return_distance=False)
+        _, cities = cached.query(query, 2, "degrees", return_distance=False)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+    def test_eviction(self):
+        query = np.array([[10.0, 20.0], [30.0, 40.0], [50.0, 60.0]], dtype=np.float32)
+        cached = QueryCache(self.geo, decimals=3, maxsize=2)
+
+        cached.query(query, 1, "degrees")
+        self.assertEqual(2, cached.cache_info().currsize)
+        cached.query(query[2:], 1, "degrees")  # most recently used, still cached
+        self.assertEqual(1, cached.cache_info().hits)
+        cached.query(query[:1], 1, "degrees")  # least recently used, was evicted
+        self.assertEqual(1, cached.cache_info().hits)
+        self.assertEqual(4, cached.cache_info().misses)
+
+        cached.cache_clear()
+        self.assertEqual((0, 0, 2, 0), cached.cache_info())
+
+        with self.assertRaises(ValueError):
+            QueryCache(self.geo, decimals=8)
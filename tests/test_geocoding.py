@@ -1,20 +1,189 @@
-import logging
+import lzma
+import multiprocessing
+import os
+import pickle
+import subprocess  # nosec B404
+import sys
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
 import numpy as np
 from genutility.cache import cache
 
+from houtu.cities import City, CityFilter, CityTable
 from houtu.geocoding import (
+    WGS84,
+    Dataset,
     ReverseGeocodeBallHaversine,
     ReverseGeocodeBruteEuclidic,
     ReverseGeocodeBruteHaversine,
+    ReverseGeocodeGrid,
     ReverseGeocodeKdLearn,
     ReverseGeocodeKdScipy,
     ReverseGeocodeVpTreePython,
     ReverseGeocodeVpTreeSimd,
+    default_data_path,
+    get_data,
+    load_data,
+    toint,
 )
-from houtu.utils import rand_lat_lon
+from houtu.storage import (
+    StorageError,
+    attach_shared_memory,
+    create_shared_memory,
+    loads_arrays,
+    read_arrays,
+    write_arrays,
+)
+from houtu.utils import haversine, rand_lat_lon
+
+
+def _query_shared(cls, name, query, k):
+    geo = cls.attach(name)
+    assert not geo.cities.arrays["population"].flags.writeable
+    coords, distances, cities = geo.query(query, k)
+    return coords, distances, cities.tolist()
+
+
+class StorageTest(unittest.TestCase):
+    def test_roundtrip(self):
+        arrays = {
+            "a": np.arange(10, dtype=np.float32).reshape(5, 2),
+            "b": np.array([1, 2, 3], dtype=np.int64),
+            "empty": np.zeros((0, 3), dtype=np.float64),
+        }
+        meta = {"version": 1, "name": "test"}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "arrays.bin")
+            write_arrays(path, arrays, meta)
+            truth_arrays, truth_meta = read_arrays(path)
+
+            self.assertEqual(meta, truth_meta)
+            self.assertEqual(arrays.keys(), truth_arrays.keys())
+            for name, arr in arrays.items():
+                self.assertEqual(arr.dtype, truth_arrays[name].dtype)
+                np.testing.assert_array_equal(arr, truth_arrays[name])
+                self.assertFalse(truth_arrays[name].flags.writeable)
+            del truth_arrays
+
+    def test_invalid(self):
+        with self.assertRaises(StorageError):
+            loads_arrays(b"not a storage file")
+
+    def test_shared_memory_untracked(self):
+        arrays = {"a": np.arange(10, dtype=np.int64)}
+        shm = create_shared_memory(arrays, {"name": "test"})
+        try:
+            # an unrelated process has its own resource tracker, which must not unlink the block when it exits
+            code = f"from houtu.storage import attach_shared_memory; print(attach_shared_memory({shm.name!r})[2])"
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)  # nosec B603
+            self.assertEqual("{'name': 'test'}", out.stdout.strip())
+            self.assertNotIn("leaked", out.stderr)
+
+            attached, truth_arrays, meta = attach_shared_memory(shm.name)
+            self.assertEqual({"name": "test"}, meta)
+            np.testing.assert_array_equal(arrays["a"], truth_arrays["a"])
+            del truth_arrays
+            attached.close()
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+class CityTableTest(unittest.TestCase):
+    def test_table(self):
+        cities = [
+            City("Taipei", "P", "PPLC", "TW", "04", "TPE", "", "", 7871900, None, "Asia/Taipei"),
+            City("Munich", "P", "PPLA", "DE", "02", "091", "09162", "09162000", 1260391, 519, "Europe/Berlin"),
+            City("Neihu", "P", "PPL", "TW", "04", "TPE", "A14", "63000100010", 271594, None, "Asia/Taipei"),
+        ]
+        table = CityTable.from_cities(cities)
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(cities, table)
+        self.assertEqual(cities[1], table[1])
+        self.assertEqual(cities[-1], table[-1])
+        with self.assertRaises(IndexError):
+            table[3]
+
+        view = table.take(np.array([[2, 0], [1, 1]]))
+        self.assertEqual(view.shape, (2, 2))
+        self.assertEqual([[cities[2], cities[0]], [cities[1], cities[1]]], view)
+        self.assertEqual(cities[0], view[0][1])
+        self.assertEqual([cities[1], cities[1]], view[1])
+        np.testing.assert_array_equal(view.column("name"), [["Neihu", "Taipei"], ["Munich", "Munich"]])
+        np.testing.assert_array_equal(view.column("country_code"), [["TW", "TW"], ["DE", "DE"]])
+        np.testing.assert_array_equal(view.column("population"), [[271594, 7871900], [1260391, 1260391]])
+
+    def test_compact_codes(self):
+        cities = [City(f"City {i}", "P", "PPL", "DE", "", "", "", str(i), 0, None, "") for i in range(300)]
+        table = CityTable.from_cities(cities[:200])
+        self.assertEqual(np.uint8, table.arrays["country_code.codes"].dtype)
+        self.assertEqual(np.uint8, table.arrays["admin4_code.codes"].dtype)
+
+        merged = table.concat(CityTable.from_cities(cities[200:]))
+        self.assertEqual(np.uint16, merged.arrays["admin4_code.codes"].dtype)
+        self.assertEqual(cities, merged)
+
+        merged = table.concat(*(CityTable.from_cities(cities[i : i + 30]) for i in range(200, 300, 30)))
+        self.assertEqual(np.uint16, merged.arrays["admin4_code.codes"].dtype)
+        self.assertEqual(cities, merged)
+
+
+def _geonames_line(name, lat, lon, elevation="", timezone="Europe/Berlin", population="1000"):
+    fields = ["1", name, name, "", lat, lon, "P", "PPL", "DE", "", "02", "091", "", "", population]
+    fields += [elevation, "500", timezone, "2024-01-01"]
+    return "\t".join(fields)
+
+
+class GetDataTest(unittest.TestCase):
+    def test_parse(self):
+        lines = [
+            _geonames_line("München", "48.13743", "11.57549", "519"),
+            _geonames_line("Duplicate", "48.13743", "11.57549"),
+            _geonames_line("Equator", "0.0", "-0.0", "", "Africa/Libreville", "0"),
+            _geonames_line("Negative zero", "-0.0", "0.0"),
+            _geonames_line("臺北", "25.04776", "121.53185", "-3", "Asia/Taipei", "7871900"),
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cities.txt.xz")
+            for keep_dups, rows in ((False, [0, 2, 4]), (True, [0, 1, 2, 3, 4])):
+                with self.subTest(keep_dups=keep_dups):
+                    with lzma.open(path, "wt", encoding="utf-8") as fw:
+                        fw.write("\n".join(lines))  # no newline after the last line
+
+                    cities = get_data(path, keep_dups)
+                    truth = [
+                        City(row[1], "P", "PPL", "DE", "02", "091", "", "", int(row[14]), toint(row[15]), row[17])
+                        for row in (lines[i].split("\t") for i in rows)
+                    ]
+                    self.assertEqual(truth, cities.info)
+                    coords = np.array([[float(lines[i].split("\t")[j]) for j in (4, 5)] for i in rows])
+                    np.testing.assert_array_equal(np.deg2rad(coords.astype(np.float32)), cities.coords)
+
+            with lzma.open(path, "wt", encoding="utf-8") as fw:
+                fw.write("\n".join(lines[:2] + ["1\tBroken"]))
+            with self.assertRaisesRegex(ValueError, "Line 3"):
+                get_data(path)
+
+
+class DataCacheTest(unittest.TestCase):
+    def test_load_data(self):
+        truth = get_data(default_data_path())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ, {"HOUTU_CACHE_DIR": tmpdir}):
+                for _ in range(2):  # first call creates cache, second one reads it
+                    data = load_data()
+                    self.assertIsInstance(data, Dataset)
+                    np.testing.assert_array_equal(truth.coords, data.coords)
+                    self.assertEqual(truth.info, data.info)
+                    self.assertEqual(len(os.listdir(tmpdir)), 1)
+                del data
 
 
 class ReverseGeocodeTest(unittest.TestCase):
@@ -22,20 +191,15 @@ class ReverseGeocodeTest(unittest.TestCase):
     def setUpClass(cls):
         cls.geo_hav1 = cache(Path("cache/brute-haversine"), serializer="pickle")(ReverseGeocodeBruteHaversine)()
         cls.geo_hav2 = cache(Path("cache/ball-haversine"), serializer="pickle")(ReverseGeocodeBallHaversine)()
+        cls.geo_grid = cache(Path("cache/grid"), serializer="pickle")(ReverseGeocodeGrid)()
 
         cls.geo_euc1 = cache(Path("cache/brute-euclidic"), serializer="pickle")(ReverseGeocodeBruteEuclidic)()
         cls.geo_euc2 = cache(Path("cache/kd-learn"), serializer="pickle")(ReverseGeocodeKdLearn)()
         cls.geo_euc3 = cache(Path("cache/kd-scipy"), serializer="pickle")(ReverseGeocodeKdScipy)()
         cls.geo_euc4 = ReverseGeocodeVpTreeSimd()
-        try:
-            cls.geo_euc5 = cache(Path("cache/vp-python"), serializer="pickle")(ReverseGeocodeVpTreePython)()
-        except ImportError as e:
-            logging.error("Skipping ReverseGeocodeVpTreePython: %s", e)
-            cls.geo_euc5 = None
+        cls.geo_euc5 = ReverseGeocodeVpTreePython()
 
-        cls.geo_all = [cls.geo_hav1, cls.geo_hav2, cls.geo_euc1, cls.geo_euc2, cls.geo_euc3, cls.geo_euc4]
-        if cls.geo_euc5 is not None:
-            cls.geo_all.append(("geo_euc5", cls.geo_euc5))
+        cls.geo_all = [cls.geo_hav1, cls.geo_hav2, cls.geo_euc1, cls.geo_euc2, cls.geo_euc3, cls.geo_euc4, cls.geo_euc5]
 
         cls.geo_hav_2_to_n = [
             ("geo_hav2", cls.geo_hav2),
@@ -45,9 +209,8 @@ class ReverseGeocodeTest(unittest.TestCase):
             ("geo_euc2", cls.geo_euc2),
             ("geo_euc3", cls.geo_euc3),
             ("geo_euc4", cls.geo_euc4),
+            ("geo_euc5", cls.geo_euc5),
         ]
-        if cls.geo_euc5 is not None:
-            cls.geo_euc_2_to_n.append(("geo_euc5", cls.geo_euc5))
 
     def test_wrong_inputs(self):
         empty = np.zeros((0, 2), dtype=np.float32)
@@ -139,6 +302,309 @@ class ReverseGeocodeTest(unittest.TestCase):
         for name, obj in self.geo_euc_2_to_n:
             with self.subTest(name=name):
                 coords, distances, cities = obj.query(large, 5)
+                if obj is self.geo_euc4:
+                    # pynear computes float32 distances, whose rounding errors are up to a few meters, so near ties
+                    # can be ranked differently. the cities must still be at the same distances.
+                    ecef = load_data().ecef
+                    chords = np.linalg.norm(WGS84.geodetic2ecef(large)[:, None, :] - ecef[cities.indices], axis=-1)
+                    np.testing.assert_allclose(distances_e1, chords, atol=2.0)
+                    np.testing.assert_allclose(distances_e1, distances, atol=2.0)
+                    continue
                 np.testing.assert_allclose(coords_e1, coords)
                 self.assertEqual(cities_e1, cities)
                 np.testing.assert_allclose(distances_e1, distances, rtol=1e-06)
+
+    def test_grid(self):
+        query = np.concatenate(
+            [
+                rand_lat_lon(2000, "radians"),
+                np.array([[np.pi / 2, 0.0], [-np.pi / 2, 1.0], [0.0, np.pi], [0.0, -np.pi]], dtype=np.float32),
+            ]
+        )
+
+        coords_truth, distances_truth, cities_truth = self.geo_hav2.query(query, 1)
+        coords, distances, cities = self.geo_grid.query(query, 1)
+        np.testing.assert_allclose(coords_truth, coords)
+        np.testing.assert_array_equal(distances_truth, distances)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+        with self.assertRaises(ValueError):
+            self.geo_grid.query(query, 2)
+
+    def test_save_load(self):
+        query = rand_lat_lon(100, "radians")
+
+        for geo in (
+            self.geo_hav1,
+            self.geo_hav2,
+            self.geo_euc1,
+            self.geo_euc2,
+            self.geo_euc3,
+            self.geo_euc4,
+            self.geo_euc5,
+            self.geo_grid,
+        ):
+            name = type(geo).__name__
+            k = 1 if geo is self.geo_grid else 3
+            with self.subTest(name=name), tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "index.bin")
+                geo.save(path)
+                loaded = type(geo).load(path)
+
+                coords_truth, distances_truth, cities_truth = geo.query(query, k)
+                coords, distances, cities = loaded.query(query, k)
+                np.testing.assert_array_equal(coords_truth, coords)
+                np.testing.assert_array_equal(distances_truth, distances)
+                self.assertEqual(cities_truth, cities)
+
+                other = ReverseGeocodeKdScipy if geo is self.geo_euc5 else ReverseGeocodeVpTreePython
+                with self.assertRaises(StorageError):
+                    other.load(path)
+                del loaded, coords, distances, cities
+
+    def test_shared_memory(self):
+        query = rand_lat_lon(100, "radians")
+
+        for geo in (self.geo_hav2, self.geo_euc3):
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                coords_truth, distances_truth, cities_truth = geo.query(query, 3)
+                shm = geo.share()
+                try:
+                    with multiprocessing.get_context("spawn").Pool(2) as pool:
+                        results = pool.starmap(_query_shared, [(type(geo), shm.name, query, 3)] * 2)
+                    for coords, distances, cities in results:
+                        np.testing.assert_array_equal(coords_truth, coords)
+                        np.testing.assert_array_equal(distances_truth, distances)
+                        self.assertEqual(cities_truth, cities)
+
+                    # the block must still exist after the workers exited
+                    attached = type(geo).attach(shm.name)
+                    self.assertEqual(cities_truth, attached.query(query, 3)[2])
+                    del attached
+                finally:
+                    shm.close()
+                    shm.unlink()
+
+    def test_n_jobs(self):
+        query = rand_lat_lon(3000, "radians")
+
+        for name, obj in self.geo_hav_2_to_n + self.geo_euc_2_to_n:
+            with self.subTest(name=name):
+                coords_truth, distances_truth, cities_truth = obj.query(query, 2)
+                coords, distances, cities = obj.query(query, 2, n_jobs=3)
+                np.testing.assert_array_equal(coords_truth, coords)
+                np.testing.assert_array_equal(distances_truth, distances)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+                coords, cities = obj.query(query, 2, return_distance=False, n_jobs=3)
+                np.testing.assert_array_equal(coords_truth, coords)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+        with self.assertRaises(ValueError):
+            self.geo_hav2.query(query, 2, n_jobs=0)
+
+    def test_query_stream(self):
+        query = rand_lat_lon(1000, "radians")
+        coords_truth, distances_truth, cities_truth = self.geo_hav2.query(query, 2)
+
+        def points():
+            yield query[:10]  # chunk
+            for point in query[10:20]:
+                yield point.tolist()  # single points
+            yield query[20:900]
+            yield query[900:].astype(np.float64)
+
+        for prefetch_chunks in (0, 2):
+            with self.subTest(prefetch_chunks=prefetch_chunks):
+                results = list(self.geo_hav2.query_stream(points(), 2, chunk_size=300, prefetch_chunks=prefetch_chunks))
+                self.assertEqual([300, 300, 300, 100], [len(coords) for coords, distances, cities in results])
+                np.testing.assert_array_equal(coords_truth, np.concatenate([r[0] for r in results]))
+                np.testing.assert_array_equal(distances_truth, np.concatenate([r[1] for r in results]))
+                np.testing.assert_array_equal(cities_truth.indices, np.concatenate([r[2].indices for r in results]))
+
+        def invalid():
+            yield query[:10]
+            yield np.zeros((3, 3), dtype=np.float32)
+
+        with self.assertRaises(ValueError):
+            list(self.geo_hav2.query_stream(invalid(), chunk_size=4))
+
+    def test_query_radius(self):
+        query = rand_lat_lon(100, "radians")
+        radius = np.random.uniform(0, 200000, 100)
+        radius[0] = 0.0
+        coords = load_data().coords
+        scale = self.geo_hav1.radius
+
+        for geo in (self.geo_hav1, self.geo_hav2, self.geo_euc1, self.geo_euc2, self.geo_euc3):
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                result = geo.query_radius(query, radius)
+                self.assertEqual((101,), result.offsets.shape)
+                self.assertEqual(result.indices.shape, result.distances.shape)
+                np.testing.assert_array_equal(result.indices, result.cities.indices)
+                for i in range(len(query)):
+                    distances = haversine(query[i], coords) * scale
+                    truth = set(np.flatnonzero(distances <= radius[i]).tolist())
+                    indices = result.indices[result.row(i)]
+                    self.assertTrue(np.all(np.diff(result.distances[result.row(i)]) >= 0))
+                    self.assertEqual(truth, set(indices.tolist()))
+
+        with self.assertRaises(ValueError):
+            self.geo_hav2.query_radius(query, -1.0)
+        with self.assertRaises(NotImplementedError):
+            self.geo_euc4.query_radius(query, 1000.0)
+
+    def test_query_bbox(self):
+        boxes = np.array(
+            [
+                [47.0, 10.0, 49.0, 13.0],
+                [-20.0, 170.0, -10.0, -170.0],  # crosses the antimeridian
+                [10.0, 20.0, 10.0, 20.0],  # empty
+            ],
+            dtype=np.float32,
+        )
+        coords = load_data().coords
+        lat, lon = coords[:, 0], coords[:, 1]
+        b = np.deg2rad(boxes)
+        truths = [
+            (lat >= b[0, 0]) & (lat <= b[0, 2]) & (lon >= b[0, 1]) & (lon <= b[0, 3]),
+            (lat >= b[1, 0]) & (lat <= b[1, 2]) & ((lon >= b[1, 1]) | (lon <= b[1, 3])),
+        ]
+
+        for geo in (self.geo_hav1, self.geo_hav2, self.geo_euc3):
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                result = geo.query_bbox(boxes, "degrees")
+                for i, truth in enumerate(truths):
+                    self.assertEqual(set(np.flatnonzero(truth).tolist()), set(result.indices[result.row(i)].tolist()))
+                self.assertEqual(0, len(result.indices[result.row(2)]))
+
+    def test_query_exact(self):
+        query = rand_lat_lon(20, "radians")
+        coords = load_data().coords
+        geodesic = np.stack([WGS84.geodesic_distance(point, coords) for point in query])
+        truth = np.argsort(geodesic, axis=1, kind="stable")[:, :3]
+
+        for geo in (
+            self.geo_hav1,
+            self.geo_hav2,
+            self.geo_grid,
+            self.geo_euc1,
+            self.geo_euc2,
+            self.geo_euc3,
+            self.geo_euc4,
+        ):
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                _, distances, cities = geo.query(query, 3, exact=True)
+                np.testing.assert_array_equal(truth, cities.indices)
+                np.testing.assert_allclose(np.take_along_axis(geodesic, truth, axis=1), distances)
+
+        # the grid only stores the nearest city, so this needs more candidates than it can return
+        _, distances, cities = self.geo_grid.query(query, 1, exact=True)
+        np.testing.assert_array_equal(truth[:, :1], cities.indices)
+
+    def test_geodesic_distance(self):
+        a = np.deg2rad(np.array([[50.06632, -5.71475], [0.0, 0.0], [10.0, 20.0]]))
+        b = np.deg2rad(np.array([[58.64402, -3.07009], [0.0, 1.0], [10.0, 20.0]]))
+        # reference values from geographiclib
+        np.testing.assert_allclose([969954.1663, 111319.4908, 0.0], WGS84.geodesic_distance(a, b), atol=1e-3)
+
+    def test_return_coords(self):
+        query = rand_lat_lon(100, "radians")
+        coords_truth = load_data().coords
+
+        for geo in self.geo_all:
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                coords, distances, cities = geo.query(query, 3)
+                np.testing.assert_array_equal(coords_truth[cities.indices], coords)
+
+                coords, distances_2, cities_2 = geo.query(query, 3, return_coords=False)
+                self.assertIsNone(coords)
+                np.testing.assert_array_equal(distances, distances_2)
+                np.testing.assert_array_equal(cities.indices, cities_2.indices)
+
+    def test_filter(self):
+        query = rand_lat_lon(50, "radians")
+        data = load_data()
+        filters = [
+            CityFilter(min_population=100000),
+            CityFilter(feature_codes=("PPLC", "PPLA")),
+            CityFilter(country_codes=("DE",), feature_classes=("P",)),
+        ]
+
+        for city_filter in filters:
+            rows = np.flatnonzero(city_filter.mask(data.info))
+            hav = haversine(query[:, None, :], data.coords[rows])
+            chord = np.linalg.norm(WGS84.geodetic2ecef(query)[:, None, :] - data.ecef[rows], axis=-1)
+
+            for geo, distances, k in ((self.geo_hav2, hav, 3), (self.geo_grid, hav, 1), (self.geo_euc3, chord, 3)):
+                name = type(geo).__name__
+                with self.subTest(name=name, filter=city_filter):
+                    truth = rows[np.argsort(distances, axis=1, kind="stable")[:, :k]]
+                    coords, _, cities = geo.query(query, k, filter=city_filter)
+                    np.testing.assert_array_equal(truth, cities.indices)
+                    np.testing.assert_array_equal(data.coords[truth], coords)
+
+        self.assertIs(
+            self.geo_hav2._filtered(CityFilter(country_codes=["DE"], feature_classes="P"), 1),
+            self.geo_hav2._filtered(filters[2], 1),
+        )
+        self.assertIsNot(self.geo_hav2._filter_lock, self.geo_euc3._filter_lock)
+        with self.assertRaises(ValueError):
+            self.geo_hav2.query(query, 1, filter=CityFilter(country_codes=("XX",)))
+
+    def test_pickle_filtered(self):
+        query = rand_lat_lon(50, "radians")
+        city_filter = CityFilter(country_codes=("DE",))
+
+        for geo in (self.geo_hav2, self.geo_grid, self.geo_euc3):
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                coords_truth, distances_truth, cities_truth = geo.query(query, 1, filter=city_filter, exact=True)
+                restored = pickle.loads(pickle.dumps(geo))
+                self.assertIsNone(restored._filter_indices)
+                self.assertIsNone(restored._full_index)
+
+                coords, distances, cities = restored.query(query, 1, filter=city_filter, exact=True)
+                np.testing.assert_array_equal(coords_truth, coords)
+                np.testing.assert_array_equal(distances_truth, distances)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+    def test_filter_parallel(self):
+        query = rand_lat_lon(3000, "radians")  # split into several chunks
+        city_filter = CityFilter(country_codes=("DE",))
+
+        for geo in self.geo_all + [self.geo_grid]:
+            k = min(2, geo._max_k())
+            name = type(geo).__name__
+            with self.subTest(name=name):
+                coords_truth, distances_truth, cities_truth = geo.query(query, k, filter=city_filter)
+                coords, distances, cities = geo.query(query, k, n_jobs=3, filter=city_filter)
+                np.testing.assert_array_equal(coords_truth, coords)
+                np.testing.assert_array_equal(distances_truth, distances)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                self.assertEqual(["DE"], np.unique(cities.column("country_code")).tolist())
+
+    def test_query_track(self):
+        # random walks with steps of about 100 meters, starting at random points
+        rng = np.random.default_rng(0)
+        starts = np.repeat(rand_lat_lon(4, "radians").astype(np.float64), 500, axis=0)
+        steps = rng.normal(scale=100.0 / 6371000.0, size=starts.shape)
+        steps[::500] = 0.0
+        query = (starts + np.cumsum(steps.reshape(4, 500, 2), axis=1).reshape(-1, 2)).astype(np.float32)
+
+        for geo in self.geo_all + [self.geo_grid]:
+            for k in (1, 3):
+                if k > geo._max_k():
+                    continue
+                name = type(geo).__name__
+                with self.subTest(name=name, k=k):
+                    coords_truth, distances_truth, cities_truth = geo.query(query, k)
+                    coords, distances, cities = geo.query_track(query, k)
+                    np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                    np.testing.assert_array_equal(distances_truth, distances)
+                    np.testing.assert_array_equal(coords_truth, coords)
@@ -0,0 +1,102 @@
+import pickle
+import subprocess  # nosec B404
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+from houtu.geocoding import ReverseGeocodeKdScipy
+from houtu.utils import rand_lat_lon
+
+# modules which are only needed by some backends or features and must be imported when they are used
+LAZY_MODULES = (
+    "sklearn",
+    "scipy",
+    "pynear",
+    "importlib.metadata",
+    "importlib_resources",
+    "csv",
+    "hashlib",
+    "json",
+    "mmap",
+    "pathlib",
+    "tempfile",
+    "multiprocessing.shared_memory",
+    "houtu.brute",
+    "houtu.geonames",
+    "houtu.grid",
+    "houtu.vptree",
+)
+
+
+def _imported_modules(code: str) -> list:
+    out = subprocess.check_output(  # nosec B603
+        [sys.executable, "-c", f"import sys; {code}; print('\\n'.join(sys.modules))"], text=True
+    )
+    return out.split()
+
+
+class ImportTest(unittest.TestCase):
+    def test_import(self):
+        modules = _imported_modules("import houtu")
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_lazy_construction(self):
+        modules = _imported_modules("from houtu.geocoding import ReverseGeocodeKdScipy; ReverseGeocodeKdScipy.lazy()")
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+
+class LazyTest(unittest.TestCase):
+    def test_lazy(self):
+        query = rand_lat_lon(100)
+        geo = ReverseGeocodeKdScipy.lazy()
+        self.assertNotIn("tree", vars(geo))
+
+        _, distances_truth, cities_truth = ReverseGeocodeKdScipy().query(query, 2)
+        _, distances, cities = geo.query(query, 2)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+        np.testing.assert_allclose(distances_truth, distances)
+        self.assertIn("tree", vars(geo))
+
+        tree = geo.tree
+        geo.warmup()
+        self.assertIs(tree, geo.tree)
+
+        with self.assertRaises(AttributeError):
+            geo.missing  # noqa: B018
+
+    def test_warmup_threads(self):
+        geo = ReverseGeocodeKdScipy.lazy()
+        threads = [threading.Thread(target=geo.warmup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(geo.cities), geo.tree.n)
+
+    def test_pickle(self):
+        query = rand_lat_lon(100)
+        geo = ReverseGeocodeKdScipy.lazy()
+
+        restored = pickle.loads(pickle.dumps(geo))  # not built yet
+        self.assertNotIn("tree", vars(restored))
+        _, distances_truth, cities_truth = restored.query(query, 2)
+
+        restored = pickle.loads(pickle.dumps(restored))
+        _, distances, cities = restored.query(query, 2)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+        np.testing.assert_array_equal(distances_truth, distances)
+
+    def test_failed_warmup(self):
+        geo = ReverseGeocodeKdScipy.lazy("missing.txt.xz")
+        with self.assertRaises(FileNotFoundError):
+            geo.warmup()
+        with self.assertRaises(FileNotFoundError):  # tried again
+            geo.cities  # noqa: B018
+
+
+if __name__ == "__main__":
+    unittest.main()
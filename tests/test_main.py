@@ -0,0 +1,76 @@
+import csv
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from houtu.__main__ import main
+from houtu.geocoding import ReverseGeocodeBallHaversine
+from houtu.utils import rand_lat_lon
+
+
+class MainTest(unittest.TestCase):
+    def test_csv(self):
+        geo = ReverseGeocodeBallHaversine()
+        query = rand_lat_lon(100, "degrees")
+        _, distances, cities = geo.query(query, 1, "degrees")
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(os.environ, {"HOUTU_CACHE_DIR": tmpdir}):
+            inpath = os.path.join(tmpdir, "in.csv")
+            outpath = os.path.join(tmpdir, "out.tsv.gz")
+            with open(inpath, "w", encoding="utf-8", newline="") as fw:
+                writer = csv.writer(fw)
+                writer.writerow(["id", "latitude", "longitude"])
+                for i, (lat, lon) in enumerate(query.tolist()):
+                    writer.writerow([i, repr(lat), repr(lon)])
+                writer.writerow([100, "", "invalid"])
+
+            for processes in (1, 2):
+                with self.subTest(processes=processes):
+                    args = [
+                        "--lat",
+                        "latitude",
+                        "--lon",
+                        "longitude",
+                        "--chunk-size",
+                        "30",
+                        "--processes",
+                        str(processes),
+                    ]
+                    main([inpath, "-o", outpath] + args)
+
+                    with gzip.open(outpath, "rt", encoding="utf-8", newline="") as fr:
+                        rows = list(csv.reader(fr, delimiter="\t"))
+
+                    self.assertEqual(["id", "latitude", "longitude", "name", "country_code"], rows[0][:5])
+                    self.assertEqual("distance", rows[0][-1])
+                    self.assertEqual(102, len(rows))
+                    for i, row in enumerate(rows[1:101]):
+                        self.assertEqual(str(i), row[0])
+                        self.assertEqual(cities[i][0].name, row[3])
+                        self.assertEqual(cities[i][0].timezone, row[9])
+                        self.assertAlmostEqual(distances[i, 0], float(row[10]), delta=0.1)
+                    self.assertEqual(["100", "", "invalid"] + [""] * 8, rows[101])
+
+    def test_empty_input(self):
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(os.environ, {"HOUTU_CACHE_DIR": tmpdir}):
+            inpath = os.path.join(tmpdir, "in.csv")
+            open(inpath, "w").close()
+            with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as cm:
+                main([inpath, "-o", os.path.join(tmpdir, "out.csv")])
+            self.assertEqual(2, cm.exception.code)
+
+    def test_invalid_header_keeps_output(self):
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(os.environ, {"HOUTU_CACHE_DIR": tmpdir}):
+            inpath = os.path.join(tmpdir, "in.csv")
+            outpath = os.path.join(tmpdir, "out.csv")
+            with open(inpath, "w") as f:
+                f.write("id,latitude,longitude\n0,48.1,11.5\n")
+            with open(outpath, "w") as f:
+                f.write("previous results\n")
+            with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as cm:
+                main([inpath, "-o", outpath])
+            self.assertEqual(2, cm.exception.code)
+            with open(outpath) as f:
+                self.assertEqual("previous results\n", f.read())
@@ -0,0 +1,26 @@
+import multiprocessing
+import unittest
+
+import numpy as np
+
+from houtu.geocoding import ReverseGeocodeKdScipy
+from houtu.parallel import QueryPool
+from houtu.utils import rand_lat_lon
+
+
+class QueryPoolTest(unittest.TestCase):
+    def test_query(self):
+        geo = ReverseGeocodeKdScipy()
+        query = rand_lat_lon(5000, "radians")
+        coords_truth, distances_truth, cities_truth = geo.query(query, 3)
+
+        with QueryPool(geo, 2, multiprocessing.get_context("spawn")) as pool:
+            coords, distances, cities = pool.query(query, 3)
+            np.testing.assert_array_equal(coords_truth, coords)
+            np.testing.assert_array_equal(distances_truth, distances)
+            self.assertEqual(cities_truth.shape, cities.shape)
+            np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+            coords, cities = pool.query(query[:10], 3, return_distance=False)
+            np.testing.assert_array_equal(coords_truth[:10], coords)
+            self.assertEqual(cities_truth[:10], cities)
@@ -0,0 +1,92 @@
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from houtu.cities import CityFilter
+from houtu.geocoding import (
+    ReverseGeocodeBallHaversine,
+    ReverseGeocodeBruteEuclidic,
+    ReverseGeocodeKdScipy,
+    ReverseGeocodeVpTreePython,
+)
+from houtu.planner import DEFAULT_ENGINES, CostModel, ReverseGeocodeAuto
+from houtu.utils import rand_lat_lon
+
+ENGINES = (ReverseGeocodeKdScipy, ReverseGeocodeVpTreePython, ReverseGeocodeBruteEuclidic)
+
+
+class CostModelTest(unittest.TestCase):
+    def test_fit(self):
+        coefficients = (1e-4, 1e-5, 2e-6, 3e-7)
+        samples = [(n, k, CostModel(0.0, coefficients).predict(n, k)) for n in (1, 16, 256) for k in (1, 8)]
+        model = CostModel.fit(1.0, samples)
+        self.assertEqual(1.0, model.build_seconds)
+        np.testing.assert_allclose(coefficients, model.coefficients, rtol=1e-6)
+
+
+class ReverseGeocodeAutoTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.geo_kd = ReverseGeocodeKdScipy()
+
+    def test_same_results(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile = os.path.join(tmpdir, "profile.json")
+            geo = ReverseGeocodeAuto(engines=ENGINES, profile=profile)
+            self.assertEqual([cls.__name__ for cls in ENGINES], list(geo.models))
+            self.assertEqual(geo.models, ReverseGeocodeAuto(engines=ENGINES, profile=profile).models)
+
+        for n in (1, 100):
+            query = rand_lat_lon(n)
+            for k in (1, 3):
+                with self.subTest(n=n, k=k):
+                    coords_truth, distances_truth, cities_truth = self.geo_kd.query(query, k)
+                    coords, distances, cities = geo.query(query, k)
+                    np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                    np.testing.assert_array_equal(distances_truth, distances)
+                    np.testing.assert_array_equal(coords_truth, coords)
+                    self.assertEqual(geo.plan(n, k), geo.last_plan)
+
+        city_filter = CityFilter(country_codes=("LI",))
+        _, cities_truth = self.geo_kd.query(query, 2, return_distance=False, filter=city_filter)
+        with mock.patch("houtu.planner.calibrate", side_effect=AssertionError("calibrated the subset")):
+            _, cities = geo.query(query, 2, return_distance=False, filter=city_filter)
+        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+
+        # the cost models of the subset are scaled from the models of all cities
+        sub = geo._filtered(city_filter, 2)
+        for name, model in sub.models.items():
+            self.assertEqual(geo.models[name].coefficients[:2], model.coefficients[:2])
+            self.assertLessEqual(model.coefficients[2], geo.models[name].coefficients[2])
+
+        with self.assertRaises(ValueError):
+            geo.plan(1, len(geo.cities) + 1)
+
+    def test_default_engines(self):
+        geo = ReverseGeocodeAuto()
+        self.assertEqual([cls.__name__ for cls in DEFAULT_ENGINES], list(geo.engines))
+
+        query = rand_lat_lon(10000)
+        coords_truth, distances_truth, cities_truth = self.geo_kd.query(query, 5)
+        for name, engine in geo.engines.items():
+            with self.subTest(name=name):
+                coords, distances, cities = engine.query(query, 5)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                np.testing.assert_array_equal(distances_truth, distances)
+                self.assertEqual(distances_truth.dtype, distances.dtype)
+                np.testing.assert_array_equal(coords_truth, coords)
+
+    def test_from_cache(self):
+        with self.assertRaises(NotImplementedError):
+            ReverseGeocodeAuto.from_cache()
+
+    def test_same_metric(self):
+        with self.assertRaises(ValueError):
+            ReverseGeocodeAuto(engines=(ReverseGeocodeKdScipy, ReverseGeocodeBallHaversine))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import multiprocessing
+import unittest
+
+import numpy as np
+
+from houtu.geocoding import ReverseGeocodeBallHaversine, ReverseGeocodeKdScipy
+from houtu.sharding import ShardedReverseGeocode, partition
+from houtu.utils import rand_lat_lon
+
+
+class PartitionTest(unittest.TestCase):
+    def test_sizes(self):
+        points = np.random.default_rng(0).normal(size=(1001, 3))
+        parts = partition(points, 5)
+        self.assertEqual([200, 200, 200, 200, 201], sorted(part.size for part in parts))
+        np.testing.assert_array_equal(np.arange(1001), np.sort(np.concatenate(parts)))
+        for part in parts:
+            np.testing.assert_array_equal(np.sort(part), part)
+
+        with self.assertRaises(ValueError):
+            partition(points, 0)
+
+
+class ShardedReverseGeocodeTest(unittest.TestCase):
+    def test_same_results(self):
+        query = rand_lat_lon(1000)
+        for cls in (ReverseGeocodeKdScipy, ReverseGeocodeBallHaversine):
+            truth = cls()
+            with ShardedReverseGeocode(cls, num_shards=5) as geo:
+                for k in (1, 3):
+                    with self.subTest(cls=cls.__name__, k=k):
+                        coords_truth, distances_truth, cities_truth = truth.query(query, k)
+                        coords, distances, cities = geo.query(query, k)
+                        np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                        np.testing.assert_array_equal(distances_truth, distances)
+                        np.testing.assert_array_equal(coords_truth, coords)
+
+    def test_processes(self):
+        query = rand_lat_lon(100)
+        truth = ReverseGeocodeKdScipy()
+        with ShardedReverseGeocode(
+            num_shards=2, processes=True, mp_context=multiprocessing.get_context("spawn")
+        ) as geo:
+            _, distances, cities = geo.query(query, 2)
+            _, distances_truth, cities_truth = truth.query(query, 2)
+            np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+            np.testing.assert_array_equal(distances_truth, distances)
+
+            with self.assertRaises(ValueError):
+                geo.query(query, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from houtu.geocoding import (
+    ReverseGeocodeBase,
+    ReverseGeocodeBruteEuclidic,
+    ReverseGeocodeGrid,
+    ReverseGeocodeKdLearn,
+    ReverseGeocodeKdScipy,
+    ReverseGeocodeVpTreePython,
+)
+from houtu.stats import QueryStats
+from houtu.utils import rand_lat_lon
+
+
+class QueryStatsTest(unittest.TestCase):
+    def test_query(self):
+        geo = ReverseGeocodeKdScipy()
+        query = rand_lat_lon(100, "radians")
+
+        geo.query(query, 2)
+        self.assertIsNone(geo.stats)
+
+        geo.stats = QueryStats()
+        geo.query(query, 2)
+        geo.query(query[:10], 2, exact=True)
+
+        summary = geo.stats.summary()
+        self.assertEqual({"query", "convert", "index", "cities", "geodesic"}, set(summary))
+        self.assertEqual(2, summary["query"]["count"])
+        self.assertEqual(110, summary["query"]["points"])
+        self.assertGreaterEqual(summary["index"]["count"], 2)
+
+        text = geo.stats.to_prometheus(memory=geo.memory_usage())
+        self.assertIn('houtu_stage_seconds_bucket{stage="query",le="+Inf"} 2\n', text)
+        self.assertIn('houtu_stage_seconds_count{stage="index"}', text)
+        self.assertIn('houtu_stage_points_total{stage="query"} 110\n', text)
+        self.assertIn('houtu_memory_bytes{part="cities"}', text)
+
+        geo.stats.reset()
+        self.assertEqual({}, geo.stats.summary())
+
+    def test_memory_usage(self):
+        geo = ReverseGeocodeKdScipy()
+        usage = geo.memory_usage()
+        self.assertEqual({"coords", "index", "cities"}, set(usage))
+        self.assertEqual(geo.coords.nbytes, usage["coords"])
+        self.assertGreater(usage["index"], geo.tree.data.nbytes)
+
+    def test_memory_usage_arrays(self):
+        for cls in (ReverseGeocodeBruteEuclidic, ReverseGeocodeGrid, ReverseGeocodeKdLearn, ReverseGeocodeVpTreePython):
+            with self.subTest(cls=cls.__name__):
+                geo = cls()
+                usage = geo.memory_usage()
+                if isinstance(geo, ReverseGeocodeBruteEuclidic):
+                    self.assertEqual(geo.knn.vectors.nbytes + geo.knn.order.nbytes, usage["index"])
+                else:
+                    self.assertEqual(ReverseGeocodeBase._nbytes(geo)["coords"], usage["coords"])
+                    self.assertLessEqual(usage["index"], ReverseGeocodeBase._nbytes(geo)["index"])
+                    self.assertGreater(usage["index"], 0)
@@ -0,0 +1,125 @@
+import copy
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from houtu.cities import City
+from houtu.geocoding import ReverseGeocodeBallHaversine, ReverseGeocodeKdScipy
+from houtu.updates import UpdatableIndex
+from houtu.utils import rand_lat_lon
+
+
+class UpdatableIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.geo_ball = ReverseGeocodeBallHaversine()
+        cls.geo_kd = ReverseGeocodeKdScipy()
+
+    def test_unchanged(self):
+        query = rand_lat_lon(100)
+        for geo in (self.geo_ball, self.geo_kd):
+            with self.subTest(cls=type(geo).__name__):
+                index = UpdatableIndex(geo)
+                coords_truth, distances_truth, cities_truth = geo.query(query, 3)
+                coords, distances, cities = index.query(query, 3)
+                np.testing.assert_array_equal(cities_truth.indices, cities.indices)
+                np.testing.assert_allclose(distances_truth, distances)
+                np.testing.assert_allclose(coords_truth, coords)
+
+    def test_add_remove(self):
+        points = np.array([[48.1351, 11.5820], [-33.8688, 151.2093]], dtype=np.float32)
+        pois = [
+            City("POI A", "P", "PPL", "DE", "", "", "", "", 0, None, "Europe/Berlin"),
+            City("POI B", "P", "PPL", "AU", "", "", "", "", 0, None, "Australia/Sydney"),
+        ]
+        query = points + np.float32(0.0001)
+
+        for geo in (self.geo_ball, self.geo_kd):
+            with self.subTest(cls=type(geo).__name__):
+                index = UpdatableIndex(geo, compact_threshold=1000000)
+                num_cities = len(index)
+                ids = index.add(points, pois, "degrees")
+                np.testing.assert_array_equal([num_cities, num_cities + 1], ids)
+                self.assertEqual(num_cities + 2, len(index))
+
+                coords, distances, cities = index.query(query, 2, "degrees")
+                np.testing.assert_array_equal(ids, cities.indices[:, 0])
+                self.assertEqual(pois, [row[0] for row in cities])
+                np.testing.assert_allclose(np.deg2rad(points), coords[:, 0], rtol=1e-6)
+                self.assertTrue(np.all(distances[:, 0] < 20.0))
+
+                # removing the nearest city of the main index exposes the one after it
+                _, _, truth = geo.query(query, 3, "degrees")
+                index.remove([ids[0], truth.indices[0, 0]])
+                index.remove([ids[0]])
+                _, cities = index.query(query, 2, "degrees", False)
+                np.testing.assert_array_equal(truth.indices[0, 1:3], cities.indices[0])
+                np.testing.assert_array_equal([ids[1], truth.indices[1, 0]], cities.indices[1])
+
+                before = index.query(query, 2, "degrees")
+                index.compact()
+                after = index.query(query, 2, "degrees")
+                np.testing.assert_array_equal(before[2].indices, after[2].indices)
+                np.testing.assert_allclose(before[1], after[1], atol=2.0)  # float32 ECEF coordinates
+                self.assertEqual(0, index._state.delta_rows.size)
+                self.assertEqual(0, index._state.main_removed)
+
+                with self.assertRaises(ValueError):
+                    index.remove([len(index.cities)])
+
+    def test_background_compaction(self):
+        index = UpdatableIndex(self.geo_kd, compact_threshold=10)
+        query = rand_lat_lon(10)
+        index.add(query, [City(f"POI {i}", "P", "PPL", "", "", "", "", "", 0, None, "") for i in range(10)])
+        index.wait()
+        self.assertEqual(0, index._state.delta_rows.size)
+
+        coords, distances, cities = index.query(query, 1)
+        np.testing.assert_array_equal(np.arange(len(index) - 10, len(index)), cities.indices[:, 0])
+        self.assertTrue(np.all(distances < 2.0))
+
+    def test_pending(self):
+        index = UpdatableIndex(self.geo_kd, compact_threshold=1000000)
+        query = rand_lat_lon(20)
+        pois = [City(f"POI {i}", "P", "PPL", "DE", "", "", "", str(i), 0, None, "") for i in range(20)]
+        ids = np.concatenate([index.add(query[i : i + 1], pois[i : i + 1]) for i in range(20)])
+        self.assertIs(self.geo_kd.cities, index._state.cities)  # single adds don't copy all cities
+        self.assertEqual(20, len(index._state.pending))
+
+        _, cities = index.query(query, 1, return_distance=False)
+        np.testing.assert_array_equal(ids, cities.indices[:, 0])
+        self.assertEqual(pois, [row[0] for row in cities])
+        self.assertEqual((), index._state.pending)
+        self.assertEqual(len(index), len(index.cities))
+
+    def test_concurrent_compaction(self):
+        index = UpdatableIndex(self.geo_kd, compact_threshold=1000000)
+        index.geo = copy.copy(self.geo_kd)
+        build_like = index.geo._build_like
+        started = threading.Event()
+
+        def slow_build_like(coords, cities):
+            geo = build_like(coords, cities)
+            if not started.is_set():  # the first build finishes after the second one without locking
+                started.set()
+                time.sleep(1.0)
+            return geo
+
+        index.geo._build_like = slow_build_like
+        first = threading.Thread(target=index.compact)
+        first.start()
+        started.wait()
+
+        query = rand_lat_lon(1)
+        ids = index.add(query, [City("POI", "P", "PPL", "", "", "", "", "", 0, None, "")])
+        index.compact()
+        first.join()
+
+        _, cities = index.query(query, 1, return_distance=False)
+        np.testing.assert_array_equal(ids, cities.indices[:, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from houtu.utils import prefetch
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(range(10)), list(prefetch(iter(range(10)), 2)))
+
+        def fail():
+            yield 1
+            raise KeyError("fail")
+
+        with self.assertRaises(KeyError):
+            list(prefetch(fail()))
+
+    def test_blocked_iterator(self):
+        release = threading.Event()
+        timer = threading.Timer(10.0, release.set)  # fails instead of hanging if close waits for the iterator
+        timer.start()
+
+        def blocking():
+            yield 1
+            release.wait()  # like reading from a pipe which has no data
+            yield 2
+
+        with mock.patch("houtu.utils.PREFETCH_JOIN_TIMEOUT", 0.1):
+            items = prefetch(blocking())
+            self.assertEqual(1, next(items))
+            start = time.perf_counter()
+            items.close()
+            self.assertLess(time.perf_counter() - start, 5.0)
+        release.set()
+        timer.cancel()
@@ -0,0 +1,27 @@
+import unittest
+
+import numpy as np
+
+from houtu.vptree import VpTree
+
+
+class VpTreeTest(unittest.TestCase):
+    def test_ties(self):
+        # points on a small lattice have many duplicates and equal distances
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 4, (2000, 3)).astype(np.float64)
+        queries = rng.integers(0, 4, (500, 3)).astype(np.float64) + 0.5
+        distances_truth = np.sqrt(np.sum((queries[:, None, :] - points[None, :, :]) ** 2, axis=-1))
+        indices_truth = np.broadcast_to(np.arange(points.shape[0]), distances_truth.shape)
+
+        tree = VpTree.build(points)
+        for k in (1, 3, 10):
+            with self.subTest(k=k):
+                order = np.lexsort((indices_truth, distances_truth))[:, :k]
+                distances, indices = tree.query(queries, k)
+                np.testing.assert_array_equal(order, indices)
+                np.testing.assert_array_equal(np.take_along_axis(distances_truth, order, axis=1), distances)
+
+
+if __name__ == "__main__":
+    unittest.main()